@@ -4,13 +4,44 @@ More or less static structures with conversion methods between serializati0n
 format and internal representation.
 """
 
+import array
 import json
 import logging
-import urllib
+import math
+import struct
+import sys
+import urllib.parse
 import re
+import zlib
 
 L = logging.getLogger()
 
+JSON = 'json'
+BINARY = 'binary'
+BATCH = 'batch'
+SERIES = 'series'
+WIRE_FORMATS = (JSON, BINARY, BATCH, SERIES)  #: message encodings on the bus
+
+#: Binary message: magic, version, target id, timestamp, http status (-1 for
+#: none), flags (bit 0: match, bit 1: unchanged since follows), length of the
+#: utf-8 network status that follows, then the unchanged since timestamp as
+#: double if flagged. JSON messages always start with '{', so the magic byte tells
+#: the formats apart.
+_MAGIC = 0xae
+_BINARY_V1 = struct.Struct('<BBIdhBH')
+#: Batch message: magic, version 2, number of results, flags (bit 0: unchanged
+#: since column present). See `ResultBatch`.
+_BATCH_V2 = struct.Struct('<BBIB')
+_U16 = struct.Struct('<H')
+_DOUBLE = struct.Struct('<d')
+
+ALL = 'all'
+ANY = 'any'
+MATCH_MODES = (ALL, ANY)  #: how the patterns of a `Matcher` combine
+
+_REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+_compiled = {}  #: regular expressions shared by all targets, by pattern
+
 
 class ServerConfigError(Exception):
     """Application level exception.
@@ -19,23 +50,157 @@ class ServerConfigError(Exception):
     """
 
 
+class UnknownTargetError(ValueError):
+    """A binary message refers to a target id missing in the target map."""
+
+
+def compile_pattern(pattern: str) -> re.Pattern:
+    """Return the compiled `pattern`, compiled once per process."""
+    regex = _compiled.get(pattern)
+    if regex is None:
+        regex = _compiled[pattern] = re.compile(pattern)
+    return regex
+
+
+class Matcher:
+    """Search several patterns in a body, combined by `mode`.
+
+    A pattern is a string, a compiled regular expression, or a pair of
+    either and a flag that negates it: a negated pattern is satisfied if it
+    is not found. With `mode` ``all`` every pattern must be satisfied, with
+    ``any`` at least one. Strings without regex syntax are searched as
+    plain substrings, the others are compiled once per process and shared
+    between the targets using them.
+
+    A body can be fed in pieces, see `start` and `feed`, which tell as soon
+    as the result is known, e.g. at the first match of a positive pattern
+    in ``any`` mode. A found pattern is not searched for again.
+    """
+
+    __slots__ = ('_patterns', '_mode', '_positive', '_negative')
+
+    def __init__(self, patterns: list, mode: str = ALL):
+        """Prepare the `patterns`, raise `re.error` or ValueError if one is invalid."""
+        if mode not in MATCH_MODES:
+            raise ValueError('Invalid match mode "{0}"'.format(mode))
+        self._mode = mode
+        self._patterns = []
+        for pattern in patterns:
+            negate = False
+            if isinstance(pattern, (tuple, list)):
+                pattern, negate = pattern
+            if isinstance(pattern, str) and not _REGEX_CHARS.intersection(pattern):
+                self._patterns.append((pattern, None, bool(negate)))
+            elif isinstance(pattern, str):
+                self._patterns.append((pattern, compile_pattern(pattern), bool(negate)))
+            elif isinstance(pattern, re.Pattern):
+                self._patterns.append((pattern.pattern, pattern, bool(negate)))
+            else:
+                raise ValueError('Invalid pattern {0!r}'.format(pattern))
+        self._positive = [i for i, p in enumerate(self._patterns) if not p[2]]
+        self._negative = [i for i, p in enumerate(self._patterns) if p[2]]
+
+    def __bool__(self) -> bool:
+        """Return True if there is anything to search."""
+        return bool(self._patterns)
+
+    def __len__(self) -> int:
+        """Return the number of patterns."""
+        return len(self._patterns)
+
+    def __str__(self) -> str:
+        """Return the patterns and the mode, for logging."""
+        return ' {0} '.format(self._mode).join(
+            ('not ' if negate else '') + text for text, _, negate in self._patterns)
+
+    def start(self) -> list:
+        """Return the state of a new search, the found flags of the patterns."""
+        return [False] * len(self._patterns)
+
+    def feed(self, text: str, found: list) -> bool:
+        """Search the next piece of the body, return the result once it is certain, else None."""
+        for i, (literal, regex, _) in enumerate(self._patterns):
+            if not found[i]:
+                found[i] = literal in text if regex is None else regex.search(text) is not None
+        if self._mode == ALL:
+            if any(found[i] for i in self._negative):
+                return False
+            if not self._negative and all(found[i] for i in self._positive):
+                return True
+        else:
+            if any(found[i] for i in self._positive):
+                return True
+            if not self._positive and all(found[i] for i in self._negative):
+                return False
+        return None
+
+    def result(self, found: list) -> bool:
+        """Return the result after the whole body was fed."""
+        satisfied = (found[i] != negate for i, (_, _, negate) in enumerate(self._patterns))
+        return all(satisfied) if self._mode == ALL else any(satisfied)
+
+    def match(self, text: str) -> bool:
+        """Return the result for the whole body `text`."""
+        found = self.start()
+        decided = self.feed(text, found)
+        return self.result(found) if decided is None else decided
+
+
 class ServerConfig:
     """Remote server representation."""
 
-    def __init__(self, url: str, pattern: str = None):
-        """Creatws a remote server object to hold url."""
+    def __init__(self, url: str, pattern=None, interval: int = None,
+                 max_body: int = None, target_id: int = None, method: str = 'GET',
+                 conditional: bool = True, match: str = ALL):
+        """Creatws a remote server object to hold url.
+
+        `pattern` is one pattern or a list of them, a pattern in a list may
+        be a dict with the keys ``pattern`` and ``negate``. The list is
+        combined by `match`, see `Matcher`.
+
+        `method` is GET or HEAD, HEAD only works without a `pattern`. With
+        `conditional` a pattern is searched only in bodies changed since the
+        last scrape, see `ae.bb.scraper.Scraper`.
+        """
         try:
             res = urllib.parse.urlparse(url)
             if res.scheme not in ['http', 'https']:
                 raise ValueError('Invalid scheme')
         except ValueError as ex:
             raise ServerConfigError('Invalid URL') from ex
+        if interval is not None and (not isinstance(interval, int) or interval <= 0):
+            L.error('Invalid interval in entry "%s": %s', url, interval)
+            raise ServerConfigError("Invalid configuration")
+        if max_body is not None and (not isinstance(max_body, int) or max_body <= 0):
+            L.error('Invalid max_body in entry "%s": %s', url, max_body)
+            raise ServerConfigError("Invalid configuration")
+        if target_id is None:
+            target_id = zlib.crc32(url.encode('utf-8')) & 0x7fffffff
+        elif not isinstance(target_id, int) or not 0 <= target_id < 2**32:
+            L.error('Invalid id in entry "%s": %s', url, target_id)
+            raise ServerConfigError("Invalid configuration")
+        method = method.upper() if isinstance(method, str) else method
+        if method not in ('GET', 'HEAD') or (method == 'HEAD' and pattern):
+            L.error('Invalid method in entry "%s": %s, HEAD needs an entry without pattern',
+                    url, method)
+            raise ServerConfigError("Invalid configuration")
+        if not isinstance(conditional, bool):
+            L.error('Invalid conditional in entry "%s": %s', url, conditional)
+            raise ServerConfigError("Invalid configuration")
         self._url = url
-        self._re = None
+        self._interval = interval
+        self._max_body = max_body
+        self._target_id = target_id
+        self._method = method
+        self._conditional = conditional
+        self._single = pattern if isinstance(pattern, str) else None
+        self._matcher = None
         if pattern:
+            patterns = pattern if isinstance(pattern, list) else [pattern]
             try:
-                self._re = re.compile(pattern)
-            except re.error as exc:
+                self._matcher = Matcher([(p['pattern'], p.get('negate', False)) if isinstance(p, dict)
+                                         else p for p in patterns], match)
+            except (re.error, ValueError, KeyError) as exc:
                 L.error('Cannot compile regex in entry "%s", regex "%s": %s', url, pattern, exc)
                 raise ServerConfigError("Invalid configuration") from exc
 
@@ -46,8 +211,38 @@ class ServerConfig:
 
     @property
     def pattern(self) -> re.Pattern:
-        """Regular expression used to match body"""
-        return self._re
+        """Regular expression of an entry with one pattern, None otherwise; see `matcher`."""
+        return compile_pattern(self._single) if self._single else None
+
+    @property
+    def matcher(self) -> Matcher:
+        """Patterns searched in the body, None if the body is not searched."""
+        return self._matcher
+
+    @property
+    def interval(self) -> int:
+        """Scrape interval of this server, None for the global one."""
+        return self._interval
+
+    @property
+    def max_body(self) -> int:
+        """Bytes of the body searched for the pattern, None for the global limit."""
+        return self._max_body
+
+    @property
+    def target_id(self) -> int:
+        """Stable id of the server on the bus, the CRC32 of the URL if not configured."""
+        return self._target_id
+
+    @property
+    def method(self) -> str:
+        """HTTP method of the scrapes, GET or HEAD."""
+        return self._method
+
+    @property
+    def conditional(self) -> bool:
+        """True if the scrapes of a pattern are conditional GETs."""
+        return self._conditional
 
 
 class Config:
@@ -55,6 +250,39 @@ class Config:
 
     def __init__(self, f: str = None):
         """Read config from file and parse config."""
+        self._servers = []
+        self._targets = {}
+        self._interval = 60
+        self._topic = None
+        self._http_timeout = 50
+        self._kafka_producer = 3
+        self._kafka_timeout = 7
+        self._kafka_in_flight = 1
+        self._kafka_linger_ms = 0
+        self._kafka_batch_size = 16384
+        self._kafka_compression = None
+        self._queue_factor = 2
+        self._queue_policy = 'block'
+        self._max_in_flight = 1000
+        self._http_limit = 1000
+        self._http_limit_per_host = 0
+        self._dns_ttl = 300
+        self._keepalive_timeout = None
+        self._aiodns = False
+        self._max_body = 1024 * 1024
+        self._adaptive_timeouts = False
+        self._min_timeout = 1.0
+        self._breaker_failures = 0
+        self._breaker_max_backoff = 3600
+        self._match_thread_bytes = 0
+        self._wire_format = JSON
+        self._series_window = 10
+        self._changes_only = False
+        self._heartbeat = 10
+        self._spool_dir = None
+        self._spool_max_bytes = 1024 * 1024 * 1024
+        self._spool_fsync = 'interval'
+        self._metrics_port = None
         if not f:
             return
 
@@ -65,22 +293,35 @@ class Config:
 
         print('self._config = ', self._config)
         try:
-            self._servers = [ServerConfig(x['url'], x.get('pattern')) for x in self._config]
+            self._servers = [ServerConfig(x['url'], x.get('pattern'), x.get('interval'),
+                                          x.get('max_body'), x.get('id'), x.get('method', 'GET'),
+                                          x.get('conditional', True), x.get('match', ALL))
+                             for x in self._config]
         except KeyError as ex:
             L.fatal('Cannot parse config file "g%s": ', ex)
             raise ServerConfigError("Invalid Config file") from ex
-
-        self._interval = 60
-        self._topic = None
-        self._http_timeout = 50
-        self._kafka_producer = 3
-        self._kafka_timeout = 7
+        for server in self._servers:
+            known = self._targets.setdefault(server.target_id, server.url)
+            if known != server.url:
+                L.fatal('Entries "%s" and "%s" have the same id %d, set an explicit "id"',
+                        known, server.url, server.target_id)
+                raise ServerConfigError("Duplicate target id")
 
     @property
     def servers(self) -> str:
         """List of server configs."""
         return self._servers
 
+    @servers.setter
+    def servers(self, s: list) -> None:
+        """Replace the list of server configs."""
+        self._servers = s
+
+    @property
+    def targets(self) -> dict:
+        """Map of target ids to URLs, of all servers in the config file."""
+        return self._targets
+
     @property
     def interval(self) -> int:
         """Return the scrping interval."""
@@ -119,33 +360,312 @@ class Config:
     @kafka_producer.setter
     def kafka_producer(self, p: int) -> None:
         """Return the number of kafka producers."""
-        self._Kafka_producer = p
+        self._kafka_producer = p
 
     @property
     def kafka_timeout(self) -> int:
         """Return the kafka timeout."""
-        return self._kafka_timout
+        return self._kafka_timeout
 
     @kafka_timeout.setter
     def kafka_timeout(self, t: int) -> None:
-        self._kafka_timout = t
+        self._kafka_timeout = t
+
+    @property
+    def kafka_in_flight(self) -> int:
+        """Return the number of messages waiting for delivery at the same time."""
+        return self._kafka_in_flight
+
+    @kafka_in_flight.setter
+    def kafka_in_flight(self, n: int) -> None:
+        """Set the number of messages waiting for delivery at the same time."""
+        self._kafka_in_flight = n
+
+    @property
+    def kafka_linger_ms(self) -> int:
+        """Return how long the Kafka client waits to fill a batch."""
+        return self._kafka_linger_ms
+
+    @kafka_linger_ms.setter
+    def kafka_linger_ms(self, t: int) -> None:
+        """Set how long the Kafka client waits to fill a batch."""
+        self._kafka_linger_ms = t
+
+    @property
+    def kafka_batch_size(self) -> int:
+        """Return the maximum Kafka batch size in bytes."""
+        return self._kafka_batch_size
+
+    @kafka_batch_size.setter
+    def kafka_batch_size(self, s: int) -> None:
+        """Set the maximum Kafka batch size in bytes."""
+        self._kafka_batch_size = s
+
+    @property
+    def kafka_compression(self) -> str:
+        """Return the Kafka compression type, None for no compression."""
+        return self._kafka_compression
+
+    @kafka_compression.setter
+    def kafka_compression(self, c: str) -> None:
+        """Set the Kafka compression type."""
+        self._kafka_compression = c
+
+    @property
+    def max_in_flight(self) -> int:
+        """Return the maximum number of concurrent scrapes."""
+        return self._max_in_flight
+
+    @max_in_flight.setter
+    def max_in_flight(self, n: int) -> None:
+        """Set the maximum number of concurrent scrapes."""
+        self._max_in_flight = n
+
+    @property
+    def http_limit(self) -> int:
+        """Return the maximum number of open HTTP connections."""
+        return self._http_limit
+
+    @http_limit.setter
+    def http_limit(self, v: int) -> None:
+        """Set the maximum number of open HTTP connections."""
+        self._http_limit = v
+
+    @property
+    def http_limit_per_host(self) -> int:
+        """Return the maximum number of HTTP connections per host, 0 for no limit."""
+        return self._http_limit_per_host
+
+    @http_limit_per_host.setter
+    def http_limit_per_host(self, v: int) -> None:
+        """Set the maximum number of HTTP connections per host."""
+        self._http_limit_per_host = v
+
+    @property
+    def dns_ttl(self) -> int:
+        """Return the time DNS lookups are cached, in seconds."""
+        return self._dns_ttl
+
+    @dns_ttl.setter
+    def dns_ttl(self, v: int) -> None:
+        """Set the time DNS lookups are cached."""
+        self._dns_ttl = v
+
+    @property
+    def keepalive_timeout(self) -> int:
+        """Return the keep-alive timeout of idle connections, None for interval + 5 seconds."""
+        return self._keepalive_timeout
+
+    @keepalive_timeout.setter
+    def keepalive_timeout(self, v: int) -> None:
+        """Set the keep-alive timeout of idle connections."""
+        self._keepalive_timeout = v
+
+    @property
+    def aiodns(self) -> bool:
+        """Return whether to resolve names with aiodns."""
+        return self._aiodns
+
+    @aiodns.setter
+    def aiodns(self, v: bool) -> None:
+        """Set whether to resolve names with aiodns."""
+        self._aiodns = v
+
+    @property
+    def max_body(self) -> int:
+        """Return the number of body bytes searched for a pattern."""
+        return self._max_body
+
+    @max_body.setter
+    def max_body(self, n: int) -> None:
+        """Set the number of body bytes searched for a pattern."""
+        self._max_body = n
+
+    @property
+    def match_thread_bytes(self) -> int:
+        """Return the size from which body pieces are searched in a thread, 0 for never."""
+        return self._match_thread_bytes
+
+    @match_thread_bytes.setter
+    def match_thread_bytes(self, n: int) -> None:
+        """Set the size from which body pieces are searched in a thread, 0 for never."""
+        self._match_thread_bytes = n
+
+    @property
+    def adaptive_timeouts(self) -> bool:
+        """Return True if the timeouts follow the latency of each target."""
+        return self._adaptive_timeouts
+
+    @adaptive_timeouts.setter
+    def adaptive_timeouts(self, b: bool) -> None:
+        """Let the timeouts follow the latency of each target, see `ae.bb.health`."""
+        self._adaptive_timeouts = b
+
+    @property
+    def min_timeout(self) -> float:
+        """Return the lower limit of the adaptive timeouts."""
+        return self._min_timeout
+
+    @min_timeout.setter
+    def min_timeout(self, t: float) -> None:
+        """Set the lower limit of the adaptive timeouts."""
+        self._min_timeout = t
+
+    @property
+    def breaker_failures(self) -> int:
+        """Return the failures in a row that pause the scrapes of a target, 0 for never."""
+        return self._breaker_failures
+
+    @breaker_failures.setter
+    def breaker_failures(self, n: int) -> None:
+        """Set the failures in a row that pause the scrapes of a target, 0 for never."""
+        self._breaker_failures = n
+
+    @property
+    def breaker_max_backoff(self) -> int:
+        """Return the longest pause of a failing target in seconds."""
+        return self._breaker_max_backoff
+
+    @breaker_max_backoff.setter
+    def breaker_max_backoff(self, n: int) -> None:
+        """Set the longest pause of a failing target in seconds."""
+        self._breaker_max_backoff = n
+
+    @property
+    def wire_format(self) -> str:
+        """Return the encoding of the messages on the bus."""
+        return self._wire_format
+
+    @wire_format.setter
+    def wire_format(self, f: str) -> None:
+        """Set the encoding of the messages on the bus."""
+        self._wire_format = f
+
+    @property
+    def series_window(self) -> int:
+        """Return the number of results per target in one series message."""
+        return self._series_window
+
+    @series_window.setter
+    def series_window(self, n: int) -> None:
+        """Set the number of results per target in one series message."""
+        self._series_window = n
+
+    @property
+    def changes_only(self) -> bool:
+        """Return True if only changed results are sent."""
+        return self._changes_only
+
+    @changes_only.setter
+    def changes_only(self, v: bool) -> None:
+        """Send only changed results, see `ae.bb.scraper.ChangeFilter`."""
+        self._changes_only = v
+
+    @property
+    def heartbeat(self) -> int:
+        """Return the number of intervals after which an unchanged result is sent anyway."""
+        return self._heartbeat
+
+    @heartbeat.setter
+    def heartbeat(self, n: int) -> None:
+        """Set the number of intervals after which an unchanged result is sent anyway."""
+        self._heartbeat = n
+
+    @property
+    def spool_dir(self) -> str:
+        """Return the directory of the spool for undeliverable messages, or None."""
+        return self._spool_dir
+
+    @spool_dir.setter
+    def spool_dir(self, d: str) -> None:
+        """Set the directory of the spool, None for no spool."""
+        self._spool_dir = d
+
+    @property
+    def spool_max_bytes(self) -> int:
+        """Return the maximum size of the spool."""
+        return self._spool_max_bytes
+
+    @spool_max_bytes.setter
+    def spool_max_bytes(self, n: int) -> None:
+        """Set the maximum size of the spool."""
+        self._spool_max_bytes = n
+
+    @property
+    def spool_fsync(self) -> str:
+        """Return the fsync policy of the spool."""
+        return self._spool_fsync
+
+    @spool_fsync.setter
+    def spool_fsync(self, p: str) -> None:
+        """Set the fsync policy of the spool, see `ae.bb.spool`."""
+        self._spool_fsync = p
+
+    @property
+    def metrics_port(self) -> int:
+        """Return the port of the metrics endpoint, or None."""
+        return self._metrics_port
+
+    @metrics_port.setter
+    def metrics_port(self, port: int) -> None:
+        """Set the port of the metrics endpoint, None for no endpoint."""
+        self._metrics_port = port
+
+    @property
+    def queue_factor(self) -> int:
+        """Return the queue capacity as multiple of the number of servers."""
+        return self._queue_factor
+
+    @queue_factor.setter
+    def queue_factor(self, f: int) -> None:
+        """Set the queue capacity as multiple of the number of servers."""
+        self._queue_factor = f
+
+    @property
+    def queue_policy(self) -> str:
+        """Return the overflow policy of the result queue."""
+        return self._queue_policy
+
+    @queue_policy.setter
+    def queue_policy(self, p: str) -> None:
+        """Set the overflow policy of the result queue."""
+        self._queue_policy = p
+
+
+#: Canonical int objects for the HTTP status codes, so queued results share
+#: them instead of each holding its own int.
+_HTTP_STATUS = {code: code for code in range(100, 600)}
 
 
 class RemoteServerResult:
-    """The result of a remote server scrape."""
+    """The result of a remote server scrape.
+
+    One result is created per scrape and may wait in the result queue, so it
+    is kept small: no instance dict, the URL and the network status are
+    interned and the http status is a shared int object. With shared
+    strings a queued result takes about 100 bytes, see
+    ``test_data_srv_result_memory``.
+    """
+
+    __slots__ = ('_url', '_nw_status', '_http_status', '_match', '_tstamp', '_target_id',
+                 '_unchanged_since')
 
     def __init__(self,
                  url: str = "",
                  nw_status: str = "",
                  http_status: int = -1,
                  match: bool = True,
-                 tstamp: int = 0):
+                 tstamp: int = 0,
+                 target_id: int = None,
+                 unchanged_since: float = None):
         """Construct a result from  data."""
-        self._url = url
-        self._nw_status = nw_status
-        self._http_status = http_status
+        self._url = sys.intern(url)
+        self._nw_status = sys.intern(str(nw_status)) if nw_status else ''
+        self._http_status = _HTTP_STATUS.get(http_status, http_status)
         self._match = match
         self._tstamp = tstamp
+        self._target_id = target_id
+        self._unchanged_since = unchanged_since
 
     @property
     def url(self) -> str:
@@ -183,15 +703,43 @@ class RemoteServerResult:
         """Return the timestamp as seconds since Epoch."""
         return self._tstamp
 
+    @property
+    def target_id(self) -> int:
+        """Return the id of the scrape target, see `ServerConfig.target_id`."""
+        return self._target_id
+
+    @property
+    def unchanged_since(self) -> float:
+        """Return the time since when the result did not change, or None.
+
+        Set on results standing for the suppressed scrapes before them, see
+        `ae.bb.scraper.ChangeFilter`.
+        """
+        return self._unchanged_since
+
+    def same_state(self, other: 'RemoteServerResult') -> bool:
+        """Return True if `other` has the same status and match result."""
+        return self._nw_status == other._nw_status \
+            and self._http_status == other._http_status \
+            and self._match == other._match
+
+    def unchanged(self, since: float) -> 'RemoteServerResult':
+        """Return a copy of the result, unchanged since `since`."""
+        return RemoteServerResult(self._url, self._nw_status, self._http_status, self._match,
+                                  self._tstamp, self._target_id, since)
+
     def json(self) -> str:
         """Format and utf-8 encode result."""
-        _s = json.dumps({
+        _d = {
             'url': self._url,
             'nw_status': str(self._nw_status),
             'http_status': self._http_status,
             'match': self._match,
             'tstamp': self._tstamp
-        }, ensure_ascii=False)
+        }
+        if self._unchanged_since is not None:
+            _d['unchanged_since'] = self._unchanged_since
+        _s = json.dumps(_d, ensure_ascii=False)
         return _s.encode('utf-8')
 
     @staticmethod
@@ -200,13 +748,224 @@ class RemoteServerResult:
         _d = json.loads(s)
         if _d['nw_status'] == 'None':
             _d['nw_status'] = ''
-        if type(isinstance(_d['match']), bool) \
-           and _d['match'].lower() not in ['true', 'false']:
+        if not isinstance(_d['match'], bool) \
+           and str(_d['match']).lower() not in ['true', 'false']:
             L.warning('Converting "%s" to True', _d['match'])
             _d['match'] = True
         _o = RemoteServerResult(url=_d['url'],
                                 nw_status=_d['nw_status'],
                                 http_status=_d['http_status'],
                                 match=_d['match'],
-                                tstamp=_d['tstamp'])
+                                tstamp=_d['tstamp'],
+                                unchanged_since=_d.get('unchanged_since'))
         return _o
+
+    def binary(self) -> bytes:
+        """Pack the result into the binary format, the URL is sent as target id."""
+        nw = str(self.nw_status).encode('utf-8')[:0xffff]
+        flags = 1 if self._match else 0
+        if self._unchanged_since is None:
+            tail = nw
+        else:
+            flags |= 2
+            tail = nw + _DOUBLE.pack(self._unchanged_since)
+        return _BINARY_V1.pack(_MAGIC, 1, self._target_id, self._tstamp,
+                               -1 if self._http_status is None else self._http_status,
+                               flags, len(nw)) + tail
+
+    @staticmethod
+    def from_binary(b: bytes, targets: dict):
+        """Unpack from the binary format, `targets` maps target ids to URLs."""
+        try:
+            _, version, target_id, tstamp, http_status, flags, nw_len = _BINARY_V1.unpack_from(b)
+        except struct.error as exc:
+            raise ValueError('Truncated binary message') from exc
+        if version != 1:
+            raise ValueError('Unknown binary version {0}'.format(version))
+        try:
+            url = targets[target_id]
+        except KeyError as exc:
+            raise UnknownTargetError('Unknown target id {0}'.format(target_id)) from exc
+        off = _BINARY_V1.size + nw_len
+        nw = bytes(b[_BINARY_V1.size:off]).decode('utf-8')
+        unchanged_since = None
+        if flags & 2:
+            try:
+                (unchanged_since,) = _DOUBLE.unpack_from(b, off)
+            except struct.error as exc:
+                raise ValueError('Truncated binary message') from exc
+        return RemoteServerResult(url=url,
+                                  nw_status=nw,
+                                  http_status=None if http_status == -1 else http_status,
+                                  match=bool(flags & 1),
+                                  tstamp=tstamp,
+                                  target_id=target_id,
+                                  unchanged_since=unchanged_since)
+
+    def encode(self, wire_format: str = JSON) -> bytes:
+        """Encode the result in `wire_format`."""
+        if wire_format == BINARY:
+            return self.binary()
+        return self.json()
+
+    @staticmethod
+    def decode(b: bytes, targets: dict = None):
+        """Decode a message in any wire format.
+
+        Binary messages need `targets` to map the target id back to the URL.
+        Raises ValueError or KeyError for malformed messages.
+        """
+        if b[:1] == bytes((_MAGIC,)):
+            if b[1:2] != b'\x01':
+                raise ValueError('Not a single result message')
+            return RemoteServerResult.from_binary(b, targets or {})
+        return RemoteServerResult.from_json(b)
+
+
+class ResultBatch:
+    """A batch of results kept as parallel arrays.
+
+    The columns are the target id, timestamp, http status (-1 for none),
+    match flag, the network status as index into a per batch table of
+    distinct status texts, index 0 being no error, and the unchanged since
+    timestamp (NaN for none). A batch is encoded into one bus message, the
+    arrays are copied as they are, and is stored with one COPY without
+    creating a result object per row.
+
+    Encoded layout, little-endian: the `_BATCH_V2` header, the number of
+    status texts, each text as length and utf-8 bytes, then the columns one
+    after the other. The unchanged since column is left out if it holds no
+    timestamp.
+    """
+
+    def __init__(self):
+        """Create an empty batch."""
+        self.target_ids = array.array('I')
+        self.tstamps = array.array('d')
+        self.http_status = array.array('h')
+        self.match = array.array('B')
+        self.nw_codes = array.array('H')
+        self.unchanged_since = array.array('d')
+        self.nw_table = ['']
+        self._nw_index = {'': 0}
+
+    def _columns(self, since: bool = True):
+        columns = (self.target_ids, self.tstamps, self.http_status, self.match, self.nw_codes)
+        return columns + (self.unchanged_since,) if since else columns
+
+    def __len__(self) -> int:
+        """Return the number of results in the batch."""
+        return len(self.target_ids)
+
+    def _nw_code(self, nw_status: str) -> int:
+        code = self._nw_index.get(nw_status)
+        if code is None:
+            code = self._nw_index[nw_status] = len(self.nw_table)
+            self.nw_table.append(nw_status)
+        return code
+
+    def append(self, result: RemoteServerResult) -> None:
+        """Add `result`, which must have a target id."""
+        self.target_ids.append(result.target_id)
+        self.tstamps.append(result.tstamp)
+        self.http_status.append(-1 if result.http_status is None else result.http_status)
+        self.match.append(1 if result.match else 0)
+        self.nw_codes.append(self._nw_code(result.nw_status))
+        self.unchanged_since.append(math.nan if result.unchanged_since is None
+                                    else result.unchanged_since)
+
+    def extend(self, other: 'ResultBatch') -> None:
+        """Add all results of `other`."""
+        remap = array.array('H', (self._nw_code(t) for t in other.nw_table))
+        self.target_ids.extend(other.target_ids)
+        self.tstamps.extend(other.tstamps)
+        self.http_status.extend(other.http_status)
+        self.match.extend(other.match)
+        self.nw_codes.extend(remap[c] for c in other.nw_codes)
+        self.unchanged_since.extend(other.unchanged_since)
+
+    @staticmethod
+    def from_results(results) -> 'ResultBatch':
+        """Create a batch from an iterable of results."""
+        batch = ResultBatch()
+        for result in results:
+            batch.append(result)
+        return batch
+
+    def rows(self, targets: dict):
+        """Yield (url, tstamp, nw_status, http_status, match, unchanged_since) tuples.
+
+        Rows with a target id missing in `targets` are skipped, see `unknown`.
+        """
+        nw_table = self.nw_table
+        for target_id, tstamp, http_status, match, nw, since in zip(*self._columns()):
+            url = targets.get(target_id)
+            if url is None:
+                continue
+            yield (url, tstamp, nw_table[nw], None if http_status == -1 else http_status, bool(match),
+                   None if math.isnan(since) else since)
+
+    def unknown(self, targets: dict) -> int:
+        """Return the number of rows with a target id missing in `targets`."""
+        return sum(1 for target_id in self.target_ids if target_id not in targets)
+
+    def results(self, targets: dict):
+        """Yield the batch as result objects, see `rows`."""
+        for url, tstamp, nw_status, http_status, match, since in self.rows(targets):
+            yield RemoteServerResult(url, nw_status, http_status, match, tstamp,
+                                     unchanged_since=since)
+
+    def encode(self) -> bytes:
+        """Encode the batch into one message."""
+        since = not all(math.isnan(t) for t in self.unchanged_since)
+        parts = [_BATCH_V2.pack(_MAGIC, 2, len(self), 1 if since else 0),
+                 _U16.pack(len(self.nw_table))]
+        for text in self.nw_table:
+            raw = text.encode('utf-8')[:0xffff]
+            parts.append(_U16.pack(len(raw)))
+            parts.append(raw)
+        for column in self._columns(since):
+            if sys.byteorder == 'big':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        return b''.join(parts)
+
+    @staticmethod
+    def is_batch(b: bytes) -> bool:
+        """Return True if `b` is an encoded batch."""
+        return len(b) >= 2 and b[0] == _MAGIC and b[1] == 2
+
+    @staticmethod
+    def decode(b: bytes) -> 'ResultBatch':
+        """Decode a batch message, raises ValueError if it is malformed."""
+        batch = ResultBatch()
+        try:
+            _, version, count, flags = _BATCH_V2.unpack_from(b)
+            if version != 2:
+                raise ValueError('Not a batch message')
+            off = _BATCH_V2.size
+            (ntab,) = _U16.unpack_from(b, off)
+            off += _U16.size
+            batch.nw_table = []
+            for _ in range(ntab):
+                (length,) = _U16.unpack_from(b, off)
+                off += _U16.size
+                batch.nw_table.append(bytes(b[off:off + length]).decode('utf-8'))
+                off += length
+        except struct.error as exc:
+            raise ValueError('Truncated batch message') from exc
+        for column in batch._columns(bool(flags & 1)):
+            size = column.itemsize * count
+            if off + size > len(b):
+                raise ValueError('Truncated batch message')
+            column.frombytes(b[off:off + size])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            off += size
+        if not flags & 1:
+            batch.unchanged_since.extend([math.nan] * count)
+        if count and max(batch.nw_codes) >= len(batch.nw_table):
+            raise ValueError('Invalid network status code')
+        batch._nw_index = {t: i for i, t in enumerate(batch.nw_table)}
+        return batch
@@ -0,0 +1,111 @@
+"""Per target latency estimates, timeouts and circuit breakers.
+
+The latency of every successful scrape updates a smoothed estimate and a
+smoothed deviation per target, like TCP does for its retransmission
+timeout. Once a target has `warmup` samples, its connect and read timeouts
+are ``estimate + 4 * deviation``, at least `min_timeout` and at most the
+global HTTP timeout, which stays the limit for the whole request. A
+timeout doubles the timeouts of the target until its next success, so a
+target that got slower for good is not cut off.
+
+With `failures` set, a target failing that many times in a row is not
+scraped for one interval, then two, four and so on, up to `max_backoff`
+seconds. After the pause one scrape is let through; a success closes the
+breaker, a failure opens it again for twice as long. HTTP error statuses
+are answers, only network errors and timeouts count as failures.
+"""
+
+import time
+
+import aiohttp
+
+ALPHA = 0.125  #: weight of a new sample in the estimate
+BETA = 0.25  #: weight of a new sample in the deviation
+MAX_BACKOFF_FACTOR = 64  #: limit of the timeout doubling
+
+
+class _State:
+
+    __slots__ = ('estimate', 'deviation', 'samples', 'backoff', 'failures', 'open_until')
+
+    def __init__(self):
+        self.estimate = 0.0
+        self.deviation = 0.0
+        self.samples = 0
+        self.backoff = 1
+        self.failures = 0
+        self.open_until = 0.0
+
+
+class Health:
+    """Latency history and breaker state of the scrape targets, by URL."""
+
+    def __init__(self, http_timeout: float, adaptive: bool = True, min_timeout: float = 1.0,
+                 failures: int = 0, max_backoff: float = 3600, warmup: int = 3):
+        """Adapt the timeouts if `adaptive`, open breakers after `failures`, 0 for never."""
+        self._http_timeout = http_timeout
+        self._adaptive = adaptive
+        self._min_timeout = min_timeout
+        self._failures = failures
+        self._max_backoff = max_backoff
+        self._warmup = warmup
+        self._states = {}
+        self.short_circuited = 0
+
+    def _state(self, url: str) -> _State:
+        state = self._states.get(url)
+        if state is None:
+            state = self._states[url] = _State()
+        return state
+
+    def timeout(self, url: str):
+        """Return the timeout for the next scrape of `url`, for ``ClientSession.get``."""
+        state = self._states.get(url)
+        if not self._adaptive or state is None or state.samples < self._warmup:
+            return self._http_timeout
+        t = (state.estimate + 4 * state.deviation) * state.backoff
+        t = min(max(t, self._min_timeout), self._http_timeout)
+        return aiohttp.ClientTimeout(total=self._http_timeout, sock_connect=t, sock_read=t)
+
+    def allow(self, url: str, now: float = None) -> bool:
+        """Return False while the breaker of `url` is open."""
+        state = self._states.get(url)
+        if state is None or not state.open_until:
+            return True
+        if (now if now is not None else time.monotonic()) < state.open_until:
+            self.short_circuited += 1
+            return False
+        return True
+
+    def record(self, url: str, interval: float, elapsed: float, ok: bool, timed_out: bool = False,
+               now: float = None) -> None:
+        """Record a scrape of `url`, scraped every `interval` seconds, that took `elapsed`."""
+        state = self._state(url)
+        if ok:
+            if state.samples:
+                state.deviation += BETA * (abs(state.estimate - elapsed) - state.deviation)
+                state.estimate += ALPHA * (elapsed - state.estimate)
+            else:
+                state.estimate = elapsed
+                state.deviation = elapsed / 2
+            state.samples += 1
+            state.backoff = 1
+            state.failures = 0
+            state.open_until = 0.0
+            return
+        if timed_out:
+            state.backoff = min(state.backoff * 2, MAX_BACKOFF_FACTOR)
+        state.failures += 1
+        if self._failures and state.failures >= self._failures:
+            pause = min(interval * 2 ** (state.failures - self._failures), self._max_backoff)
+            state.open_until = (now if now is not None else time.monotonic()) + pause
+
+    def open(self, now: float = None) -> int:
+        """Return the number of targets with an open breaker."""
+        now = now if now is not None else time.monotonic()
+        return sum(1 for state in self._states.values() if state.open_until > now)
+
+    def stats(self) -> dict:
+        """Return the number of open breakers and of scrapes skipped by them."""
+        return {'open': self.open(),
+                'short_circuited': self.short_circuited}
@@ -0,0 +1,250 @@
+"""Counters and histograms served in the Prometheus text format.
+
+A metric with labels has one child per combination of label values,
+created by `labels` on first use and cached, so the hot path only looks up
+the child and increments a number. Components keep the children they use
+all the time, like the one of every scrape target.
+
+The metrics are updated from the event loop only, there is no locking.
+`serve` starts an HTTP server answering ``GET /metrics`` with the
+metrics of a `Registry`, by default the module wide `REGISTRY`.
+"""
+
+import bisect
+import logging
+import math
+
+from aiohttp import web
+
+L = logging.getLogger('metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Registry:
+    """The metrics rendered together on one endpoint."""
+
+    def __init__(self):
+        """Create an empty registry."""
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add `metric`, names must be unique."""
+        if metric.name in self._metrics:
+            raise ValueError('Metric "{0}" is already registered'.format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str):
+        """Return the metric called `name`."""
+        return self._metrics[name]
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append('# HELP {0} {1}'.format(metric.name, _escape(metric.help)))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    """A metric family, its children are kept by label values."""
+
+    kind = None
+    _child = None
+
+    def __init__(self, name: str, help: str, labels: tuple = (), registry: Registry = REGISTRY):
+        """Create the metric and add it to `registry`."""
+        self.name = name
+        self.help = help
+        self._labels = tuple(labels)
+        self._children = {}
+        if not self._labels:
+            self._children[()] = self._new()
+        if registry is not None:
+            registry.register(self)
+
+    def _new(self):
+        return self._child()
+
+    def labels(self, *values):
+        """Return the child of the label `values`, creating it on first use.
+
+        A metric without labels has one child, returned by ``labels()``.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self._labels):
+                raise ValueError('{0} has the labels {1}'.format(self.name, self._labels))
+            child = self._children[values] = self._new()
+        return child
+
+    def remove(self, *values):
+        """Drop the child of the label `values`, e.g. of a target that is gone."""
+        self._children.pop(values, None)
+
+    def _label_str(self, values, extra: str = '') -> str:
+        pairs = ['{0}="{1}"'.format(k, _escape(v)) for k, v in zip(self._labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        """Yield the sample lines of all children."""
+        for values, child in list(self._children.items()):
+            yield from self._samples(self._label_str(values), values, child)
+
+    def _samples(self, labels, values, child):
+        yield '{0}{1} {2}'.format(self.name, labels, _number(child.value))
+
+
+class _CounterChild:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+
+    __slots__ = ('function',)
+
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Read the value from `function` when the metrics are rendered."""
+        self.function = function
+
+
+class _HistogramChild:
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _SummaryChild:
+
+    __slots__ = ('sum', 'count')
+
+    def __init__(self):
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+
+
+class Counter(_Metric):
+    """A total that only goes up, `inc` adds to it."""
+
+    kind = 'counter'
+    _child = _CounterChild
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, set directly or read from a function."""
+
+    kind = 'gauge'
+    _child = _GaugeChild
+
+    def _samples(self, labels, values, child):
+        if child.function is not None:
+            try:
+                child.value = child.function()
+            except Exception:
+                L.exception('%s: reading the value failed', self.name)
+        yield from super()._samples(labels, values, child)
+
+
+class Summary(_Metric):
+    """Sum and count of observations, without quantiles.
+
+    Two numbers per child, cheap enough for a label per scrape target.
+    """
+
+    kind = 'summary'
+    _child = _SummaryChild
+
+    def _samples(self, labels, values, child):
+        yield '{0}_sum{1} {2}'.format(self.name, labels, _number(child.sum))
+        yield '{0}_count{1} {2}'.format(self.name, labels, child.count)
+
+
+class Histogram(_Metric):
+    """Observations counted in `buckets`, plus their sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 registry: Registry = REGISTRY):
+        """Create a histogram with the upper `buckets` bounds, +Inf is added."""
+        self._bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _new(self):
+        return _HistogramChild(self._bounds)
+
+    def _samples(self, labels, values, child):
+        total = 0
+        for bound, count in zip(self._bounds + (math.inf,), child.counts):
+            total += count
+            yield '{0}_bucket{1} {2}'.format(
+                self.name, self._label_str(values, 'le="{0}"'.format(_number(float(bound)))), total)
+        yield '{0}_sum{1} {2}'.format(self.name, labels, _number(child.sum))
+        yield '{0}_count{1} {2}'.format(self.name, labels, child.count)
+
+
+async def serve(port: int, registry: Registry = REGISTRY, host: str = '0.0.0.0') -> web.AppRunner:
+    """Serve ``/metrics`` on `port` until the returned runner is cleaned up."""
+    async def handler(_request):
+        return web.Response(body=registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    L.warning('serve: metrics on http://%s:%d/metrics', host, port)
+    return runner
@@ -1,14 +1,30 @@
 """Producer and consumer implementation for Kafka msgbus."""
 
 import asyncio
-import kafka
+import concurrent.futures
+import heapq
 import logging
+import time
 
-from aiokafka import AIOKafkaProducer, AIOKafkaConsumer
+from aiokafka import AIOKafkaProducer, AIOKafkaConsumer, ConsumerRebalanceListener
+from aiokafka.errors import KafkaConnectionError, KafkaError
 
-from ae.bb.data import RemoteServerResult
+from ae.bb import metrics, series, trace
+from ae.bb.data import BATCH, JSON, SERIES, RemoteServerResult, ResultBatch, UnknownTargetError
 
 L = logging.getLogger('msgbus')
+T = trace.Tracer('msgbus')
+
+SEND_SECONDS = metrics.Histogram('ae_kafka_send_seconds', 'Time from sending a message to its delivery')
+MESSAGE_RESULTS = metrics.Histogram('ae_kafka_message_results', 'Results per Kafka message',
+                                    buckets=metrics.SIZE_BUCKETS)
+MESSAGE_BYTES = metrics.Histogram('ae_kafka_message_bytes', 'Size of the Kafka messages',
+                                  buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576))
+SEND_ERRORS = metrics.Counter('ae_kafka_send_errors_total', 'Failed deliveries, retries included')
+CONSUMER_LAG = metrics.Gauge('ae_consumer_lag', 'Messages behind the high watermark after a commit',
+                             ('partition',))
+UNKNOWN_TARGETS = metrics.Counter('ae_consumer_unknown_targets_total',
+                                  'Results with a target id missing in the target map')
 
 
 class Producer:
@@ -19,11 +35,37 @@ class Producer:
     TODO: Maybe more  producers get better performance,
     if they connect to different nodes in a Kafka cluster. This needs
     some bench-marking and error simulations.
+
+    With `in_flight` 1 every task waits for the delivery of its message
+    before it takes the next one from the queue. With a larger value the
+    producer is pipelined: messages are handed to the Kafka client, which
+    batches them according to `linger_ms` and `batch_size`, and up to
+    `in_flight` messages wait for their delivery report at the same time.
+    A message is marked done in the queue only after its delivery was
+    confirmed, or after it failed `retries` more times.
+
+    In the batch wire format one message carries all results queued within
+    `linger_ms`, as a `ae.bb.data.ResultBatch`. In the series wire format
+    the results are collected per target and sent as one compressed message
+    every `series_window` results, see `ae.bb.series`. Collected results are
+    done in the queue right away; `flush` sends the partial windows.
+
+    With a `spool` (`ae.bb.spool.Spool`) no message is lost when Kafka is
+    down or slow: a message that can't be delivered is appended to the
+    spool, and so is every message taken from a full queue while all send
+    slots are busy. While the spool is not empty all new messages go there
+    as well, so the order is kept. A replay task sends the spooled messages
+    through the same `in_flight` window as soon as the broker is back, each
+    one leaves the spool once its delivery is confirmed. The spool file IO
+    runs on a thread of its own. `init` does not fail if Kafka can't be
+    reached then.
     """
 
     def __init__(self, endpoint: str, pcount: int, topic: str,
-                 q: asyncio.Queue):
-        """Init producer with endpoint and topic."""
+                 q: asyncio.Queue, in_flight: int = 1, linger_ms: int = 0,
+                 batch_size: int = 16384, compression: str = None,
+                 wire_format: str = JSON, series_window: int = 10, spool=None):
+        """Init producer with endpoint and topic, messages are encoded in `wire_format`."""
         self._topic = topic
         self._kafka = None
         self._producers = []
@@ -32,31 +74,326 @@ class Producer:
         self._queue = q
         self._connect_timeout = 10
         self._retry_backoff = 2 * 1000
+        self._in_flight = in_flight
+        self._linger_ms = linger_ms
+        self._batch_size = batch_size
+        self._compression = compression
+        self._wire_format = wire_format
+        self._max_batch = 1000
+        self._windows = series.Windows(series_window) if wire_format == SERIES else None
+        self._retries = 3
+        self._window = None
+        self._resends = set()
+        self._spool = spool
+        self._spool_io = None
+        if spool is not None:
+            self._spool_io = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                   thread_name_prefix='spool')
+        self._spooled = spool is not None and not spool.empty()
+        self._spool_buf = []
+        self._spool_writer = None
+        self._spool_ready = asyncio.Event()
+        self._replayer = None
+        self._replaying = 0
+        self._replay_retry = []
+        self._down = False
+        self.delivered = 0
+        self.failed = 0
 
     async def init(self):
-        """Block on initializing the async Kafka producer."""
-        # FIXME: As with he consumer, a loop with exp backoff makes
-        #        sense here. Would make orchestration easier.
-        self._kafka = AIOKafkaProducer(bootstrap_servers=self._endpoint,
-                                       retry_backoff_ms=self._retry_backoff)
-        return await asyncio.wait_for(self._kafka.start(), self._connect_timeout)
+        """Block on initializing the async Kafka producer.
+
+        Without a spool a broker that can't be reached within the connect
+        timeout is an error, with a spool messages are spooled until it is.
+        """
+        self._window = asyncio.Semaphore(self._in_flight)
+        try:
+            await self._start()
+        except (asyncio.TimeoutError, KafkaError) as exc:
+            if self._spool is None:
+                raise
+            L.error('init: Kafka at %s not reachable (%s), spooling', self._endpoint, exc)
+            self._down = True
+
+    async def _start(self):
+        kafka = AIOKafkaProducer(bootstrap_servers=self._endpoint,
+                                 retry_backoff_ms=self._retry_backoff,
+                                 linger_ms=self._linger_ms,
+                                 max_batch_size=self._batch_size,
+                                 compression_type=self._compression)
+        try:
+            await asyncio.wait_for(kafka.start(), self._connect_timeout)
+        except BaseException:
+            await kafka.stop()
+            raise
+        self._kafka = kafka
+
+    def _spooling(self) -> bool:
+        """Return True if new messages must go to the spool."""
+        return self._spool is not None and (self._down or self._spooled)
+
+    def _saturated(self) -> bool:
+        """Return True if Kafka does not keep up: the queue is full and all send slots busy."""
+        q = self._queue
+        return (self._spool is not None and q.maxsize > 0
+                and q.qsize() >= q.maxsize - self.numof_producers
+                and (self._in_flight == 1 or self._window.locked()))
+
+    async def _spool_call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._spool_io, fn, *args)
+
+    def _spool_put(self, msgs: list, payload: bytes) -> None:
+        """Append `payload` to the spool, `msgs` are done once it is written."""
+        self._spooled = True
+        self._spool_buf.append((msgs, payload))
+        if self._spool_writer is None:
+            self._spool_writer = asyncio.ensure_future(self._write_spool())
+
+    async def _write_spool(self) -> None:
+        """Write the messages waiting for the spool, all waiting at once with one fsync."""
+        try:
+            while self._spool_buf:
+                buf, self._spool_buf = self._spool_buf, []
+                try:
+                    await self._spool_call(self._spool.append_many, [payload for _, payload in buf])
+                except OSError:
+                    L.exception('_write_spool: %d messages lost', len(buf))
+                self._spool_ready.set()
+                for msgs, _ in buf:
+                    self._task_done(msgs)
+        finally:
+            self._spool_writer = None
+
+    def _spill(self, msgs: list, payload: bytes, exc: BaseException) -> None:
+        L.warning('delivery of %d results for "%s" failed (%s), spooling',
+                  len(msgs), msgs[0].url, exc)
+        self._down = True
+        self._spool_put(msgs, payload)
 
     async def _send(self, idx: int) -> None:
         """Dequeue item and send to Kafka"""
         while True:
             try:
-                msg = await self._queue.get()
-                L.info('_send[%d]: dequeued "%s"', idx, msg)
-                await self._kafka.send_and_wait(self._topic, msg.json())
-                self._queue.task_done()
+                msgs = await self._dequeue()
+                if T.on():
+                    T.log('_send[%d]: dequeued %d results, first "%s"', idx, len(msgs), msgs[0])
+                if self._windows is not None:
+                    full = self._windows.add(msgs[0])
+                    self._queue.task_done()
+                    if full is None:
+                        continue
+                    msgs, payload = full
+                else:
+                    payload = self._encode(msgs)
+                MESSAGE_RESULTS.labels().observe(len(msgs))
+                MESSAGE_BYTES.labels().observe(len(payload))
+                if self._spooling():
+                    self._spool_put(msgs, payload)
+                elif self._saturated():
+                    L.warning('_send[%d]: Kafka does not keep up, spooling', idx)
+                    self._spool_put(msgs, payload)
+                elif self._in_flight > 1:
+                    await self._window.acquire()
+                    await self._pipeline(msgs, payload, 0)
+                else:
+                    try:
+                        t0 = time.perf_counter()
+                        await self._kafka.send_and_wait(self._topic, payload)
+                        SEND_SECONDS.labels().observe(time.perf_counter() - t0)
+                    except Exception as exc:
+                        SEND_ERRORS.labels().inc()
+                        if self._spool is None:
+                            raise
+                        self._spill(msgs, payload, exc)
+                        continue
+                    self._task_done(msgs)
             except Exception:
                 L.exception('_send[%d] exception', idx)
 
+    async def _replay(self) -> None:
+        """Send the spooled messages in order whenever Kafka is reachable.
+
+        The messages take slots of the `in_flight` window like new ones, so
+        the spool drains as fast as the pipeline sends. While Kafka is down
+        one message at a time probes it every retry backoff. Failed messages
+        are sent again before the next one is read.
+        """
+        backoff = self._retry_backoff / 1000
+        while True:
+            if self._down:
+                await asyncio.sleep(backoff)
+                if self._replaying:
+                    continue
+            if self._kafka is None:
+                try:
+                    await self._start()
+                except Exception as exc:
+                    self._replay_failed(exc)
+                    continue
+            await self._window.acquire()
+            if self._replay_retry:
+                token, payload = heapq.heappop(self._replay_retry)
+            else:
+                self._spool_ready.clear()
+                item = await self._spool_call(self._spool.read)
+                if item is None:
+                    self._window.release()
+                    if not (self._replaying or self._replay_retry or self._spool_buf
+                            or self._spool_writer):
+                        self._spooled = False
+                    try:
+                        await asyncio.wait_for(self._spool_ready.wait(), backoff)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                token, payload = item
+            self._replaying += 1
+            try:
+                fut = await self._kafka.send(self._topic, payload)
+            except Exception as exc:
+                self._replayed(token, payload, None, exc)
+                continue
+            fut.add_done_callback(lambda f, token=token, payload=payload:
+                                  self._replayed(token, payload, f))
+
+    def _replay_failed(self, exc: BaseException) -> None:
+        SEND_ERRORS.labels().inc()
+        if not self._down:
+            L.warning('_replay: Kafka still down (%s)', exc)
+        self._down = True
+
+    def _replayed(self, token: int, payload: bytes, fut: asyncio.Future,
+                  exc: BaseException = None) -> None:
+        """Acknowledge a delivered spooled message, queue a failed one for resending."""
+        self._window.release()
+        self._replaying -= 1
+        if fut is not None:
+            exc = asyncio.CancelledError() if fut.cancelled() else fut.exception()
+        if exc is not None:
+            self._replay_failed(exc)
+            heapq.heappush(self._replay_retry, (token, payload))
+            return
+        if self._down:
+            L.warning('_replay: Kafka is back, replaying %d spooled bytes', len(self._spool))
+            self._down = False
+        if self._spool_io is not None:
+            self._spool_io.submit(self._spool.ack, token)
+
+    async def flush(self) -> None:
+        """Send the partial windows of the series wire format and wait for their delivery."""
+        if self._windows is None:
+            return
+        for msgs, payload in self._windows.flush():
+            try:
+                if self._spooling():
+                    self._spool_put(msgs, payload)
+                else:
+                    await self._kafka.send_and_wait(self._topic, payload)
+            except Exception as exc:
+                if self._spool is not None:
+                    self._spill(msgs, payload, exc)
+                else:
+                    L.exception('flush: %d results for "%s" lost', len(msgs), msgs[0].url)
+
+    async def close(self) -> None:
+        """Stop the replay, write the messages waiting for the spool and close it."""
+        if self._spool is None:
+            return
+        if self._replayer is not None:
+            self._replayer.cancel()
+        while self._spool_writer is not None:
+            await self._spool_writer
+        await self._spool_call(self._spool.close)
+        self._spool_io.shutdown()
+        self._spool_io = None
+
+    async def _dequeue(self) -> list:
+        """Take the results for the next message from the queue.
+
+        In the batch wire format everything queued within `linger_ms` goes
+        into one message, up to `max_batch` results.
+        """
+        msgs = [await self._queue.get()]
+        if self._wire_format == BATCH:
+            if self._queue.qsize() < self._max_batch - 1 and self._linger_ms:
+                await asyncio.sleep(self._linger_ms / 1000)
+            while len(msgs) < self._max_batch and not self._queue.empty():
+                msgs.append(self._queue.get_nowait())
+        return msgs
+
+    def _encode(self, msgs: list) -> bytes:
+        if self._wire_format == BATCH:
+            return ResultBatch.from_results(msgs).encode()
+        return msgs[0].encode(self._wire_format)
+
+    async def _pipeline(self, msgs: list, payload: bytes, attempt: int) -> None:
+        """Hand `payload` to the Kafka client, the delivery is checked in `_delivered`."""
+        t0 = time.perf_counter()
+        try:
+            fut = await self._kafka.send(self._topic, payload)
+        except Exception as exc:
+            self._failed(msgs, payload, attempt, exc)
+            return
+        fut.add_done_callback(lambda f: self._delivered(msgs, payload, attempt, f, t0))
+
+    def _delivered(self, msgs: list, payload: bytes, attempt: int, fut: asyncio.Future,
+                   t0: float = None) -> None:
+        if fut.cancelled():
+            self._failed(msgs, payload, attempt, asyncio.CancelledError())
+        elif fut.exception() is not None:
+            self._failed(msgs, payload, attempt, fut.exception())
+        else:
+            if t0 is not None:
+                SEND_SECONDS.labels().observe(time.perf_counter() - t0)
+            self.delivered += len(msgs)
+            self._done(msgs)
+
+    def _failed(self, msgs: list, payload: bytes, attempt: int, exc: BaseException) -> None:
+        SEND_ERRORS.labels().inc()
+        if attempt < self._retries:
+            L.warning('delivery of %d results for "%s" failed (%s), retry %d',
+                      len(msgs), msgs[0].url, exc, attempt + 1)
+            task = asyncio.ensure_future(self._resend(msgs, payload, attempt + 1))
+            self._resends.add(task)
+            task.add_done_callback(self._resends.discard)
+        elif self._spool is not None:
+            self._window.release()
+            self._spill(msgs, payload, exc)
+        else:
+            L.error('delivery of %d results for "%s" failed (%s), giving up',
+                    len(msgs), msgs[0].url, exc)
+            self.failed += len(msgs)
+            self._done(msgs)
+
+    async def _resend(self, msgs: list, payload: bytes, attempt: int) -> None:
+        await asyncio.sleep(self._retry_backoff / 1000)
+        await self._pipeline(msgs, payload, attempt)
+
+    def _done(self, msgs: list) -> None:
+        """Release the in flight slot and mark the results as done."""
+        self._window.release()
+        self._task_done(msgs)
+
+    def _task_done(self, msgs: list) -> None:
+        if self._windows is None:
+            for _ in msgs:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """Return the number of delivered and failed messages in pipelined mode."""
+        _s = {'delivered': self.delivered,
+              'failed': self.failed}
+        if self._spool is not None:
+            _s.update(('spool_' + k, v) for k, v in self._spool.stats().items())
+        return _s
+
     async def kafka_producers(self):
-        """Create a list of kafka producer tasks."""
-        producers = [asyncio.create_task(self._send(i))
-                     for i in range(self.numof_producers)]
-        self._producers = [await p for p in producers]
+        """Create a list of kafka producer tasks, and the spool replay task."""
+        self._producers = [asyncio.create_task(self._send(i))
+                           for i in range(self.numof_producers)]
+        if self._spool is not None:
+            self._replayer = asyncio.create_task(self._replay())
+            self._producers.append(self._replayer)
         return self._producers
 
     async def cancel(self, *_):
@@ -69,75 +406,197 @@ class Producer:
         await self._kafka.stop()
 
 
+class _Rebalance(ConsumerRebalanceListener):
+    """Stop the partition workers of revoked partitions."""
+
+    def __init__(self, consumer):
+        self._consumer = consumer
+
+    async def on_partitions_revoked(self, revoked):
+        """Commit the in-flight batches before the partitions move away."""
+        await self._consumer._stop_workers(revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        """Workers are started on the first batch of a partition."""
+
+
 class Consumer:
-    """Fetch message from bus and send to storage for persisting."""
+    """Fetch message from bus and send to storage for persisting.
+
+    Each assigned partition gets its own worker task and queue. The fetch
+    loop hands the messages of a partition to its worker and keeps
+    fetching, the workers store and commit concurrently. At most `window`
+    batches per partition are in flight; a partition with a full queue is
+    paused on the Kafka consumer until its worker catches up.
+
+    Binary, batch and series messages carry target ids, `targets` maps them
+    back to URLs. A batch with ids missing in the map is neither stored nor
+    committed, the consumer stops with `ae.bb.data.UnknownTargetError`: the
+    store needs the config of the scraper.
+    """
 
-    def __init__(self, endpoint, topic, db):
+    def __init__(self, endpoint, topic, db, window=4, targets=None):
         """Initialize config data for the consumer.
 
         The real connection to the kafka message bus and the database is
         creatred when  the aync machinery is started int he `run`function.
         Therefore errors are delayed until that point.
+
+        `targets` maps target ids to URLs, it is needed for messages in the
+        binary wire format.
         """
         self._topic = topic
         self._endpoint = endpoint
         self._tasks = []
         self._db = db
         self._retry_backoff = 2 * 1000  # 2 seconds backoff for retries
+        self._fetch_timeout = 1000  # short, so resumed partitions are picked up
+        self._window = window
+        self._targets = targets or {}
+        self._workers = {}
         self._consumer = None
 
     async def _init_me(self):
         L.debug('_init_me: called')
 
-        self._consumer = AIOKafkaConsumer(self._topic,
-                                          group_id='g1',
+        self._consumer = AIOKafkaConsumer(group_id='g1',
                                           auto_offset_reset='earliest',
-                                          enable_auto_commit=True,
+                                          enable_auto_commit=False,
                                           retry_backoff_ms=self._retry_backoff,
                                           bootstrap_servers=self._endpoint)
+        self._consumer.subscribe([self._topic], listener=_Rebalance(self))
         # FIXME: We should loop  here with exp backoff and try to connect to
         #         the msgbus. That would make it easiert to start components
         #         out of order and lessen the complexity of orchestration.
         try:
             return await self._consumer.start()
-        except kafka.errors.KafkaConnectionError:
+        except KafkaConnectionError:
             L.exception('Consumer start failed')
             L.fatal('Aborting')
             raise SystemExit(1)
 
-    async def _process(self, msg):
+    def _decode(self, msg):
         _v = msg.value
-        L.info('msg.value = %s', _v)
+        if T.on():
+            T.log('_decode: msg.value = %s', _v)
         try:
-            result = RemoteServerResult.from_json(_v)
-        except KeyError:
-            L.warning("_process: malformatted JSON message, ignoring")
-            return
-        self._db.store(result)
+            return RemoteServerResult.decode(_v, self._targets)
+        except UnknownTargetError:
+            raise
+        except (KeyError, ValueError) as exc:
+            L.warning("_decode: malformatted message (%s), ignoring", exc)
+            return None
+
+    async def _store(self, tp, messages):
+        """Store the messages of one partition and commit its offset."""
+        results = []
+        batch = ResultBatch()
+        unknown = 0
+        for msg in messages:
+            if ResultBatch.is_batch(msg.value) or series.is_series(msg.value):
+                try:
+                    if series.is_series(msg.value):
+                        batch.extend(series.decode(msg.value))
+                    else:
+                        batch.extend(ResultBatch.decode(msg.value))
+                except (UnicodeDecodeError, ValueError) as exc:
+                    L.warning("_store: malformatted batch message (%s), ignoring", exc)
+            else:
+                try:
+                    result = self._decode(msg)
+                except UnknownTargetError:
+                    unknown += 1
+                    continue
+                if result is not None:
+                    results.append(result)
+        unknown += batch.unknown(self._targets)
+        if unknown:
+            UNKNOWN_TARGETS.labels().inc(unknown)
+            L.error('_store: %d results from %s have unknown target ids%s, not committing offset %d',
+                    unknown, tp, '' if self._targets else ' (store started without --config)',
+                    messages[0].offset)
+            raise UnknownTargetError('{0} results with unknown target ids'.format(unknown))
+        L.debug("_store: storing %d results and %d batched from %s", len(results), len(batch), tp)
+        if results:
+            await self._db.store_many(results)
+        if len(batch):
+            await self._db.store_batch(batch, self._targets)
+        L.info("_store: commiting offset %d for %s", messages[-1].offset + 1, tp)
+        await self._consumer.commit({tp: messages[-1].offset + 1})
+        highwater = self._consumer.highwater(tp)
+        if highwater is not None:
+            CONSUMER_LAG.labels(tp.partition).set(highwater - messages[-1].offset - 1)
+
+    async def _partition_worker(self, tp, q: asyncio.Queue):
+        """Store the batches of one partition in order."""
+        while True:
+            messages = await q.get()
+            try:
+                await self._store(tp, messages)
+            finally:
+                q.task_done()
+            if tp in self._consumer.paused() and not q.full():
+                L.debug('_partition_worker: resuming %s', tp)
+                self._consumer.resume(tp)
+
+    async def _dispatch(self, tp, messages):
+        """Queue messages for the partition worker, pause if the window is full."""
+        if tp not in self._workers:
+            q = asyncio.Queue(self._window)
+            self._workers[tp] = (q, asyncio.create_task(self._partition_worker(tp, q)))
+        q, _ = self._workers[tp]
+        await q.put(messages)
+        if q.full():
+            L.debug('_dispatch: window full, pausing %s', tp)
+            self._consumer.pause(tp)
+
+    async def _stop_workers(self, partitions):
+        """Let the workers of `partitions` commit their work, then stop them."""
+        for tp in partitions:
+            if tp not in self._workers:
+                continue
+            q, task = self._workers.pop(tp)
+            if not task.done():
+                await q.join()
+            task.cancel()
+
+    def _check_workers(self):
+        """Re-raise the error of a failed worker, offsets must not skip a batch."""
+        for _, task in self._workers.values():
+            if task.done() and not task.cancelled():
+                task.result()
 
     async def run(self):
         """Run the consumer loop.
 
-        Wait for consumer to complete initialization, then
+        Wait for the DB and the consumer to complete initialization, then
         fetch messages, process them and commit them batck to the message bus.
+
+        The messages of each partition in one ``getmany`` call are stored in
+        one DB transaction by the worker of that partition. An offset is
+        committed only after the transaction of its batch went through, and
+        the batches of a partition are committed in order.
         """
         L.debug('run: Waiting for messages')
 
+        if not self._targets:
+            L.warning('run: no target map, binary, batch and series messages stop the consumer')
+        await self._db.connect()
         await self._init_me()
         L.debug('run: self._consumer = %s', self._consumer)
 
-        while True:
-            result = await self._consumer.getmany(timeout_ms=10 * 1000)
-            L.info("run: result = %s", result)
-            for tp, messages in result.items():
-                L.debug("tp = %s, messages = %s", tp, messages)
-                if messages:
-                    L.debug("run: messages processing")
-                    for msg in messages:
-                        await self._process(msg)
-                    L.info("run: commiting offset %d", messages[-1].offset + 1)
-                    await self._consumer.commit({tp: messages[-1].offset + 1})
-                    L.info('run: commited')
+        try:
+            while True:
+                result = await self._consumer.getmany(timeout_ms=self._fetch_timeout)
+                if T.on():
+                    T.log('run: fetched %s', {tp: len(m) for tp, m in result.items()})
+                for tp, messages in result.items():
+                    if messages:
+                        await self._dispatch(tp, messages)
+                self._check_workers()
+        finally:
+            for _, task in self._workers.values():
+                task.cancel()
 
     def shutdown(self, loop):
         """Start synchronously the async postgres consumer."""
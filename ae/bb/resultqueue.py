@@ -0,0 +1,96 @@
+"""Bounded queue between the scrapers and the result sinks.
+
+The queue decouples scraping from sending or storing the results. Its
+capacity is limited, when it is full the overflow policy decides what
+happens to a new result:
+
+``block``
+    the scraper waits until there is room again. Nothing is lost, but
+    scraping falls behind schedule.
+``drop-oldest``
+    the oldest queued result is dropped to make room.
+``coalesce``
+    a queued result for the same URL is replaced by the new one, only the
+    latest result per URL is kept. If the URL is not queued yet and the
+    queue is full, the oldest result is dropped.
+"""
+
+import asyncio
+import collections
+import logging
+
+L = logging.getLogger('resultqueue')
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+
+class ResultQueue(asyncio.Queue):
+    """Asyncio queue of results with a configurable overflow policy."""
+
+    def __init__(self, maxsize: int = 0, policy: str = BLOCK):
+        """Create a queue holding at most `maxsize` results."""
+        if policy not in POLICIES:
+            raise ValueError('Invalid overflow policy "{0}"'.format(policy))
+        self._policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+        super().__init__(maxsize)
+
+    @property
+    def policy(self) -> str:
+        """Return the overflow policy."""
+        return self._policy
+
+    # Storage hooks of asyncio.Queue. With coalescing the deque holds the
+    # URLs in arrival order, the results live in a dict keyed by URL.
+    def _init(self, maxsize):
+        self._queue = collections.deque()
+        self._latest = {}
+
+    def _put(self, item):
+        if self._policy == COALESCE:
+            self._queue.append(item.url)
+            self._latest[item.url] = item
+        else:
+            self._queue.append(item)
+
+    def _get(self):
+        if self._policy == COALESCE:
+            return self._latest.pop(self._queue.popleft())
+        return self._queue.popleft()
+
+    async def put(self, item):
+        """Put a result into the queue, only the block policy ever waits."""
+        if self._policy == BLOCK:
+            await super().put(item)
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item):
+        """Put a result into the queue, apply the overflow policy if full."""
+        if self._policy == COALESCE and item.url in self._latest:
+            self._latest[item.url] = item
+            self.coalesced += 1
+            return
+        if self._policy != BLOCK and self.full():
+            self._get()
+            self.task_done()
+            self.dropped += 1
+        super().put_nowait(item)
+        self._track()
+
+    def _track(self):
+        if self.qsize() > self.high_water:
+            self.high_water = self.qsize()
+
+    def stats(self) -> dict:
+        """Return queue depth and overflow counters."""
+        return {'depth': self.qsize(),
+                'capacity': self.maxsize,
+                'high_water': self.high_water,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced}
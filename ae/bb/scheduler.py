@@ -0,0 +1,107 @@
+"""Fixed rate scheduler for the scrape targets.
+
+All targets live in one heap ordered by the time their next scrape is due.
+Targets sharing an interval are spread evenly across it: they are sorted by
+a hash of their URL and each one gets its own slot, with a jitter inside the
+slot also derived from the URL. The schedule is therefore the same after
+every restart, and the fleet is not hit in the same second.
+
+The next due time is always the previous due time plus the interval, not
+the time the scrape finished, so the schedule does not drift. If the
+scheduler falls behind by more than a whole interval, the missed scrapes
+are skipped instead of being fired in a burst.
+"""
+
+import asyncio
+import heapq
+import logging
+import math
+import zlib
+
+L = logging.getLogger('scheduler')
+
+
+def _fraction(url: str, salt: bytes = b'') -> float:
+    """Map `url` deterministically into [0, 1)."""
+    return zlib.crc32(salt + url.encode('utf-8')) / 2**32
+
+
+def offsets(servers, interval: int) -> list:
+    """Return the first due offset for each of `servers`, in their order.
+
+    `interval` is used for servers without an interval of their own.
+    """
+    groups = {}
+    for idx, server in enumerate(servers):
+        groups.setdefault(server.interval or interval, []).append(idx)
+    result = [0.0] * len(servers)
+    for iv, members in groups.items():
+        members.sort(key=lambda i: _fraction(servers[i].url))
+        n = len(members)
+        for slot, idx in enumerate(members):
+            jitter = _fraction(servers[idx].url, b'jitter')
+            result[idx] = iv * (slot + jitter) / n
+    return result
+
+
+class Scheduler:
+    """Run a fetch for each server whenever it is due.
+
+    At most `max_in_flight` fetches run at the same time, a due fetch waits
+    for a free slot.
+    """
+
+    def __init__(self, servers, interval: int, max_in_flight: int = 1000):
+        """Create the schedule for `servers`, scraped every `interval` seconds by default."""
+        self._servers = servers
+        self._interval = interval
+        self._max_in_flight = max_in_flight
+        self._heap = []
+        self._tasks = set()
+        self.skipped = 0
+
+    def _interval_of(self, server) -> int:
+        return server.interval or self._interval
+
+    async def run(self, fetch) -> None:
+        """Call the coroutine function `fetch(server)` according to the schedule."""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self._max_in_flight)
+        start = loop.time()
+        self._heap = [(start + offset, seq, server)
+                      for seq, (offset, server) in enumerate(zip(offsets(self._servers, self._interval),
+                                                                 self._servers))]
+        heapq.heapify(self._heap)
+        try:
+            while self._heap:
+                due, seq, server = self._heap[0]
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                heapq.heappop(self._heap)
+                await slots.acquire()
+                task = asyncio.create_task(fetch(server))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+                heapq.heappush(self._heap, (self._next_due(due, server, loop.time()), seq, server))
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    def _next_due(self, due: float, server, now: float) -> float:
+        """Return the next slot on the fixed rate grid of `server`."""
+        iv = self._interval_of(server)
+        nxt = due + iv
+        if nxt < now:
+            missed = math.ceil((now - nxt) / iv)
+            L.warning('_next_due: %s is %d intervals behind, skipping', server.url, missed)
+            self.skipped += missed
+            nxt += missed * iv
+        return nxt
+
+    def stats(self) -> dict:
+        """Return the number of fetches in flight and skipped so far."""
+        return {'in_flight': len(self._tasks),
+                'skipped': self.skipped}
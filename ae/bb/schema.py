@@ -0,0 +1,266 @@
+"""Database schemas the store component writes to.
+
+``webservers``
+    the original table, created with ``utils/create_table.sql``. Every row
+    carries the URL.
+``normalized``
+    the URLs live once in a ``targets`` table, the ``measurements`` table
+    refers to them with an integer ``target_id``. Both tables are created
+    by the store component.
+``partitioned``
+    ``normalized`` with ``measurements`` partitioned by range on
+    ``tstamp``, one partition per day. The partitions a batch needs are
+    created before it is written, `maintain` creates the partitions of the
+    next days and drops the ones older than `retention_days`. Every
+    partition has its own small unique index.
+``timescale``
+    ``normalized`` with ``measurements`` as TimescaleDB hypertable of one
+    day chunks. Chunks older than `compress_days` are compressed, segmented
+    by target, chunks older than `retention_days` are dropped. Falls back
+    to ``partitioned`` if the extension is not available.
+
+A schema provides the statements the `ae.bb.storage.DB` writes with. The
+normalized schemas create their tables in `create`, the ``webservers``
+table is only upgraded there. Statements run often
+are prepared once per connection, see `execute`; their parameters are
+numbered ``$1`` and so on.
+"""
+
+import datetime
+import logging
+
+import psycopg2
+import psycopg2.errors
+
+L = logging.getLogger('schema')
+
+WEBSERVERS = 'webservers'
+NORMALIZED = 'normalized'
+PARTITIONED = 'partitioned'
+TIMESCALE = 'timescale'
+SCHEMAS = (WEBSERVERS, NORMALIZED, PARTITIONED, TIMESCALE)
+
+
+def execute(conn, cursor, name: str, stmt: str, args: tuple = ()) -> None:
+    """Run `stmt` as the server side prepared statement `name` of `conn`.
+
+    The statement is prepared the first time it runs on a connection, then
+    its plan is reused. `conn.prepared` holds the names prepared so far.
+    """
+    if name not in conn.prepared:
+        cursor.execute('prepare {0} as {1}'.format(name, stmt))
+        conn.prepared.add(name)
+    if args:
+        cursor.execute('execute {0} ({1})'.format(name, ', '.join(['%s'] * len(args))), args)
+    else:
+        cursor.execute('execute {0}'.format(name))
+
+
+class Webservers:
+    """The ``webservers`` table, one row per result with the full URL."""
+
+    name = WEBSERVERS
+    normalized = False  #: rows refer to the URL by target id
+    partitioned = False  #: rows need a partition of their day, see `Partitioned`
+    insert_stmt = \
+        """insert into webservers (url, tstamp, nw_status, http_status, match, unchanged_since)
+                            values($1,  $2,     $3,        $4,          $5,    $6)
+        """
+    # Batches are COPYed into a per session staging table and merged
+    # from there, so duplicates are skipped row by row by the unique
+    # index instead of failing the whole batch.
+    stage_stmt = \
+        """create temporary table if not exists webservers_stage
+               (like webservers including defaults) on commit delete rows
+        """
+    copy_stmt = \
+        """copy webservers_stage (url, tstamp, nw_status, http_status, match, unchanged_since)
+               from stdin"""
+    merge_stmt = \
+        """insert into webservers (url, tstamp, nw_status, http_status, match, unchanged_since)
+                select url, tstamp, nw_status, http_status, match, unchanged_since
+                  from webservers_stage
+           on conflict (tstamp, url) do nothing
+        """
+    # tables created before the change only mode lack the column
+    upgrade_stmt = \
+        """alter table webservers add column if not exists unchanged_since timestamp"""
+
+    def create(self, _conn, cursor):
+        """Add the columns missing in tables of older versions, return the schema."""
+        cursor.execute(self.upgrade_stmt)
+        return self
+
+
+class Normalized(Webservers):
+    """A ``targets`` table and a ``measurements`` table referring to it."""
+
+    name = NORMALIZED
+    normalized = True
+    targets_stmt = \
+        """create table if not exists targets (
+               id serial primary key,
+               url varchar(1024) not null unique)
+        """
+    measurements_stmt = \
+        """create table if not exists measurements (
+               target_id integer not null references targets (id),
+               tstamp timestamp not null,
+               nw_status varchar(256),
+               http_status smallint,
+               match boolean,
+               unchanged_since timestamp,
+               unique (target_id, tstamp))
+        """
+    insert_stmt = \
+        """insert into measurements (target_id, tstamp, nw_status, http_status, match,
+                                     unchanged_since)
+                values ($1, $2, $3, $4, $5, $6)
+        """
+    stage_stmt = \
+        """create temporary table if not exists measurements_stage
+               (like measurements including defaults) on commit delete rows
+        """
+    copy_stmt = \
+        """copy measurements_stage (target_id, tstamp, nw_status, http_status, match,
+                                    unchanged_since) from stdin"""
+    merge_stmt = \
+        """insert into measurements (target_id, tstamp, nw_status, http_status, match,
+                                     unchanged_since)
+                select target_id, tstamp, nw_status, http_status, match, unchanged_since
+                  from measurements_stage
+           on conflict (target_id, tstamp) do nothing
+        """
+    add_targets_stmt = \
+        """insert into targets (url) select unnest($1::varchar[]) on conflict (url) do nothing"""
+    target_ids_stmt = \
+        """select url, id from targets where url = any($1::varchar[])"""
+
+    def create(self, _conn, cursor):
+        """Create the tables if they don't exist yet."""
+        cursor.execute(self.targets_stmt)
+        cursor.execute(self.measurements_stmt)
+        return self
+
+    def target_ids(self, conn, cursor, urls: list) -> dict:
+        """Return the ids of `urls`, adding the ones not known yet."""
+        # sorted, so concurrent sessions lock new rows in the same order
+        urls = sorted(urls)
+        execute(conn, cursor, 'ae_add_targets', self.add_targets_stmt, (urls,))
+        execute(conn, cursor, 'ae_target_ids', self.target_ids_stmt, (urls,))
+        return dict(cursor.fetchall())
+
+
+class Partitioned(Normalized):
+    """`Normalized` with ``measurements`` partitioned by day."""
+
+    name = PARTITIONED
+    partitioned = True
+    measurements_stmt = Normalized.measurements_stmt.rstrip() + ' partition by range (tstamp)\n'
+    partitions_stmt = \
+        """select c.relname from pg_inherits i
+                 join pg_class c on c.oid = i.inhrelid
+                 join pg_class p on p.oid = i.inhparent
+            where p.relname = 'measurements'"""
+
+    def __init__(self, retention_days: int = 90, ahead_days: int = 2):
+        """Keep `retention_days` of partitions, 0 for ever, and `ahead_days` in advance."""
+        self._retention_days = retention_days
+        self._ahead_days = ahead_days
+
+    @staticmethod
+    def _partition(day: datetime.date) -> str:
+        return 'measurements_p{0:%Y%m%d}'.format(day)
+
+    def oldest(self, today: datetime.date = None) -> datetime.date:
+        """Return the first day within the retention, None if data is kept for ever."""
+        if not self._retention_days:
+            return None
+        return (today or datetime.date.today()) - datetime.timedelta(days=self._retention_days)
+
+    def add_partitions(self, _conn, cursor, days) -> None:
+        """Create the partitions of `days` if they don't exist yet."""
+        for day in days:
+            cursor.execute('savepoint partition')
+            try:
+                cursor.execute("""create table if not exists {0} partition of measurements
+                                      for values from (%s) to (%s)""".format(self._partition(day)),
+                               (day, day + datetime.timedelta(days=1)))
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+                # created by another store at the same time
+                cursor.execute('rollback to savepoint partition')
+
+    def maintain(self, conn, cursor, today: datetime.date) -> set:
+        """Create the coming partitions, drop the expired ones, return the days left."""
+        self.add_partitions(conn, cursor, [today + datetime.timedelta(days=n)
+                                           for n in range(self._ahead_days + 1)])
+        oldest = self.oldest(today)
+        days = set()
+        cursor.execute(self.partitions_stmt)
+        for (name,) in cursor.fetchall():
+            try:
+                day = datetime.datetime.strptime(name, 'measurements_p%Y%m%d').date()
+            except ValueError:
+                continue
+            if oldest and day < oldest:
+                L.warning('maintain: dropping partition %s', name)
+                cursor.execute('drop table if exists {0}'.format(name))
+            else:
+                days.add(day)
+        return days
+
+
+class Timescale(Normalized):
+    """`Normalized` with a compressed TimescaleDB hypertable."""
+
+    name = TIMESCALE
+
+    def __init__(self, retention_days: int = 90, compress_days: int = 7):
+        """Set the policies, a `retention_days` of 0 keeps the data forever."""
+        self._retention_days = retention_days
+        self._compress_days = compress_days
+
+    def create(self, conn, cursor):
+        """Create the hypertable and its policies, fall back to `Partitioned`."""
+        cursor.execute("select 1 from pg_available_extensions where name = 'timescaledb'")
+        if cursor.fetchone() is None:
+            L.warning('create: timescaledb is not available, using the partitioned schema')
+            return Partitioned(self._retention_days).create(conn, cursor)
+        cursor.execute('savepoint timescale')
+        try:
+            cursor.execute('create extension if not exists timescaledb')
+        except psycopg2.Error as exc:
+            L.warning('create: cannot load timescaledb (%s), using the partitioned schema', exc)
+            cursor.execute('rollback to savepoint timescale')
+            return Partitioned(self._retention_days).create(conn, cursor)
+        super().create(conn, cursor)
+        cursor.execute("""select create_hypertable('measurements', 'tstamp',
+                                                   chunk_time_interval => interval '1 day',
+                                                   if_not_exists => true)""")
+        cursor.execute("""select compression_enabled from timescaledb_information.hypertables
+                           where hypertable_name = 'measurements'""")
+        if not cursor.fetchone()[0]:
+            cursor.execute("""alter table measurements set (timescaledb.compress,
+                                  timescaledb.compress_segmentby = 'target_id',
+                                  timescaledb.compress_orderby = 'tstamp')""")
+        cursor.execute("""select add_compression_policy('measurements', make_interval(days => %s),
+                                                        if_not_exists => true)""",
+                       (self._compress_days,))
+        if self._retention_days:
+            cursor.execute("""select add_retention_policy('measurements', make_interval(days => %s),
+                                                          if_not_exists => true)""",
+                           (self._retention_days,))
+        return self
+
+
+def get(name: str, retention_days: int = 90, compress_days: int = 7):
+    """Return the schema called `name`."""
+    if name == TIMESCALE:
+        return Timescale(retention_days, compress_days)
+    if name == PARTITIONED:
+        return Partitioned(retention_days)
+    if name == NORMALIZED:
+        return Normalized()
+    if name == WEBSERVERS:
+        return Webservers()
+    raise ValueError('Unknown schema "{0}"'.format(name))
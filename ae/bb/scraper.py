@@ -1,6 +1,6 @@
 """Async scraper fo websites."""
 
-import re
+import codecs
 import logging
 import time
 import asyncio
@@ -9,10 +9,142 @@ import sys
 
 from typing import TextIO
 
+from ae.bb import metrics, trace
 from ae.bb.msgbus import Producer
-from ae.bb.data import RemoteServerResult, ServerConfig, Config
+from ae.bb.data import JSON, SERIES, Config, Matcher, RemoteServerResult, ServerConfig
+from ae.bb.health import Health
+from ae.bb.resultqueue import ResultQueue
+from ae.bb.scheduler import Scheduler
+from ae.bb.spool import Spool
 
 L = logging.getLogger('scraper')
+T = trace.Tracer('scraper')
+
+
+OVERLAP = 4096  #: characters kept from the previous chunk when matching
+CHUNK_SIZE = 65536  #: bytes read from the body at once
+CIRCUIT_OPEN = 'Circuit open'  #: network status of a scrape skipped by its breaker
+
+FETCH_SECONDS = metrics.Histogram('ae_fetch_seconds', 'Duration of the scrapes by outcome',
+                                  ('outcome',))
+TARGET_FETCH_SECONDS = metrics.Summary('ae_target_fetch_seconds',
+                                       'Duration of the scrapes by target and outcome',
+                                       ('target', 'outcome'))
+QUEUE_DEPTH = metrics.Gauge('ae_queue_depth', 'Results waiting in the result queue')
+SHORT_CIRCUITED = metrics.Counter('ae_fetch_short_circuited_total',
+                                  'Scrapes skipped because the breaker of the target is open')
+BREAKERS_OPEN = metrics.Gauge('ae_breakers_open', 'Targets with an open circuit breaker')
+NOT_MODIFIED = metrics.Counter('ae_fetch_not_modified_total',
+                               'Conditional scrapes answered with 304 Not Modified')
+
+
+async def stream_match(resp: aiohttp.ClientResponse, pattern, max_body: int,
+                       overlap: int = OVERLAP, offload: int = 0) -> bool:
+    """Search `pattern` in the body of `resp` while it is being read.
+
+    `pattern` is a `ae.bb.data.Matcher` or a compiled regular expression.
+    The body is decoded chunk by chunk. Each chunk is searched together with
+    the last `overlap` characters of the text before it, so a match across
+    a chunk boundary is found as long as it is not longer than `overlap`.
+    Reading stops as soon as the result is certain, e.g. at the first match
+    of a single pattern, and after `max_body` bytes; the rest of the body is
+    never downloaded. Patterns anchored with ``^`` or ``$`` match at chunk
+    boundaries too.
+
+    With `offload` set, pieces of at least that many characters are
+    searched in a worker thread. The search still holds the GIL, but the
+    event loop gets its turn every switch interval instead of waiting for
+    a slow regular expression to finish.
+    """
+    if not isinstance(pattern, Matcher):
+        pattern = Matcher([pattern])
+    try:
+        decoder = codecs.getincrementaldecoder(resp.charset or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    found = pattern.start()
+    tail = ''
+    left = max_body
+
+    async def feed(text):
+        if offload and len(text) >= offload:
+            return await asyncio.get_running_loop().run_in_executor(None, pattern.feed, text, found)
+        return pattern.feed(text, found)
+
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        chunk = chunk[:left]
+        left -= len(chunk)
+        text = tail + decoder.decode(chunk, final=left == 0)
+        decided = await feed(text)
+        if decided is not None:
+            return decided
+        if left == 0:
+            if T.on():
+                T.log('stream_match: %s: undecided after the first %d bytes', resp.url, max_body)
+            return pattern.result(found)
+        tail = text[-overlap:]
+    text = tail + decoder.decode(b'', final=True)
+    decided = await feed(text)
+    return pattern.result(found) if decided is None else decided
+
+
+async def drain(resp: aiohttp.ClientResponse, limit: int) -> None:
+    """Read and discard the rest of the body of `resp`, up to `limit` bytes.
+
+    aiohttp only returns a connection to the pool when its response was
+    read to the end. A body stopped early by `stream_match`, or not read at
+    all, is read on for up to `limit` more bytes, so the next scrape of the
+    host skips the handshakes. A longer body closes the connection instead.
+    """
+    if resp.content.at_eof():
+        return
+    if resp.content_length is not None and resp.content_length > limit:
+        resp.close()
+        return
+    left = limit
+    try:
+        while left > 0:
+            chunk = await resp.content.readany()
+            if not chunk:
+                return
+            left -= len(chunk)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+    resp.close()
+
+
+class ChangeFilter:
+    """Pass on only the results that differ from the previous one of their URL.
+
+    The last sent result of every URL is kept in memory. A result with the
+    same status and match result as that one is held back, unless it is
+    the `heartbeat`-th in a row; it is then sent with `unchanged_since` set
+    to the time of the last sent result. When the state changes, the last
+    held back result is sent the same way before the new one, so the end of
+    every unchanged range is stored and no transition is lost.
+    """
+
+    def __init__(self, heartbeat: int):
+        """Create a filter sending unchanged results every `heartbeat` scrapes."""
+        self._heartbeat = heartbeat
+        self._last = {}
+        self.suppressed = 0
+
+    def filter(self, result: RemoteServerResult) -> list:
+        """Return the results to send for the new `result`."""
+        state = self._last.get(result.url)
+        if state is None or not state[0].same_state(result):
+            self._last[result.url] = [result, None, 0]
+            if state is None or state[1] is None:
+                return [result]
+            return [state[1].unchanged(state[0].tstamp), result]
+        state[1] = result
+        state[2] += 1
+        if state[2] >= self._heartbeat:
+            self._last[result.url] = [result, None, 0]
+            return [result.unchanged(state[0].tstamp)]
+        self.suppressed += 1
+        return []
 
 
 class Scraper:
@@ -20,78 +152,150 @@ class Scraper:
     Scrapes the webservers.
 
     Does regexp matching on the bodies and enqueues.
-    results into the Kafka client queue.
+    results into the Kafka client queue. When each server is scraped is
+    decided by the `ae.bb.scheduler.Scheduler`. With `Config.changes_only`
+    results go through a `ChangeFilter` first.
+
+    Servers with a pattern are scraped with conditional GETs: the ``ETag``
+    and ``Last-Modified`` headers of the last full response are sent back
+    as ``If-None-Match`` and ``If-Modified-Since``. A ``304 Not Modified``
+    yields the status and match result of that response, without a body
+    to search.
+
+    With `Config.adaptive_timeouts` or `Config.breaker_failures` the
+    timeouts and breakers of each target come from its `ae.bb.health.Health`
+    history. A scrape skipped by an open breaker yields a result with the
+    network status `CIRCUIT_OPEN`, without touching the network.
     """
 
     def __init__(self, config: Config, q: asyncio.Queue):
         """Init scraper  with list of servers to scrape."""
         self._queue = q
         self._http_timeout = config.http_timeout
+        self._interval = config.interval
+        self._max_body = config.max_body
+        self._match_thread_bytes = config.match_thread_bytes
         self._servers = config.servers
+        self._scheduler = Scheduler(config.servers, config.interval, config.max_in_flight)
         self._producers = []
+        self._changes = ChangeFilter(config.heartbeat) if config.changes_only else None
+        self._validators = {}
+        self._health = None
+        if config.adaptive_timeouts or config.breaker_failures:
+            self._health = Health(config.http_timeout, config.adaptive_timeouts, config.min_timeout,
+                                  config.breaker_failures, config.breaker_max_backoff)
+            BREAKERS_OPEN.labels().set_function(self._health.open)
 
     async def _fetch(self, client: aiohttp.ClientSession, server: ServerConfig) -> None:
         """Async fetch of one server.
 
-        Polls one server and puts result in the queue.
+        Polls one server and puts result in the queue. The duration is
+        recorded by outcome: ok, client_error, timeout or error.
         """
-        while True:
-            start_time = time.clock_gettime(time.CLOCK_MONOTONIC)
-            try:
-                L.info('_fetch: fetching %s with timeout %d secs', server.url,
-                       self._http_timeout)
-
-                resp = await client.get(server.url, timeout=self._http_timeout)
-                # enqueue it to kafka
-                L.debug('fetch: url = "%s", resp.status = "%s"', server.url,
-                        resp.status)
-                bdy = await resp.text()
+        if self._health is not None and not self._health.allow(server.url):
+            SHORT_CIRCUITED.labels().inc()
+            await self._enqueue(RemoteServerResult(server.url, CIRCUIT_OPEN, None, False,
+                                                   tstamp=time.time(), target_id=server.target_id))
+            return
+        timeout = self._http_timeout if self._health is None else self._health.timeout(server.url)
+        t0 = time.perf_counter()
+        outcome = 'ok'
+        cached = self._validators.get(server.url) if server.matcher and server.conditional else None
+        try:
+            async with client.request(server.method, server.url, timeout=timeout,
+                                      headers=cached and cached[0]) as resp:
+                status = resp.status
                 match = False
-                if server.pattern:
-                    match = re.search(server.pattern, bdy) is not None
-                    L.debug('Body pattern match result: %s,  body = %s, pattern = %s', match, bdy[:80], server.pattern)
-                result = RemoteServerResult(server.url,
-                                            None,
-                                            resp.status,
-                                            match,
-                                            tstamp=time.time())
-            except aiohttp.client_exceptions.ClientError as exc:
-                L.exception('fetch: client exception: url = "%s", exception = "%s"',
-                            server.url, exc)
-                result = RemoteServerResult(server.url,
-                                            exc,
-                                            None,
-                                            False,
-                                            tstamp=time.time())
-            except asyncio.TimeoutError:
-                L.warning('fetch timeout: url = "%s"', server.url)
-                result = RemoteServerResult(server.url,
-                                            "Timeout",
-                                            None,
-                                            False,
-                                            tstamp=time.time())
-            except Exception as exc:
-                L.error('_fetch: Uncaught exception: url = "%s, exc = %s', server.url, exc)
-                result = RemoteServerResult(server.url,
-                                            "Uncaught Exception: {0}".format(exc),
-                                            None,
-                                            False,
-                                            tstamp=time.time())
-
-            L.debug("_fetch: enqueueing to kafka: %s", result.json()[:128])
+                if status == 304 and cached is not None:
+                    NOT_MODIFIED.labels().inc()
+                    _, status, match = cached
+                elif server.matcher:
+                    match = await stream_match(resp, server.matcher,
+                                               server.max_body or self._max_body,
+                                               offload=self._match_thread_bytes)
+                    if server.conditional:
+                        self._remember(server.url, resp, match)
+                await drain(resp, server.max_body or self._max_body)
+            result = RemoteServerResult(server.url,
+                                        None,
+                                        status,
+                                        match,
+                                        tstamp=time.time(),
+                                        target_id=server.target_id)
+        except asyncio.TimeoutError:
+            # before ClientError: the socket timeouts of aiohttp are both
+            outcome = 'timeout'
+            L.warning('fetch timeout: url = "%s"', server.url)
+            result = RemoteServerResult(server.url,
+                                        "Timeout",
+                                        None,
+                                        False,
+                                        tstamp=time.time(),
+                                        target_id=server.target_id)
+        except aiohttp.client_exceptions.ClientError as exc:
+            outcome = 'client_error'
+            L.exception('fetch: client exception: url = "%s", exception = "%s"',
+                        server.url, exc)
+            result = RemoteServerResult(server.url,
+                                        exc,
+                                        None,
+                                        False,
+                                        tstamp=time.time(),
+                                        target_id=server.target_id)
+        except Exception as exc:
+            outcome = 'error'
+            L.error('_fetch: Uncaught exception: url = "%s, exc = %s', server.url, exc)
+            result = RemoteServerResult(server.url,
+                                        "Uncaught Exception: {0}".format(exc),
+                                        None,
+                                        False,
+                                        tstamp=time.time(),
+                                        target_id=server.target_id)
+        elapsed = time.perf_counter() - t0
+        FETCH_SECONDS.labels(outcome).observe(elapsed)
+        TARGET_FETCH_SECONDS.labels(server.url, outcome).observe(elapsed)
+        if self._health is not None:
+            self._health.record(server.url, server.interval or self._interval, elapsed,
+                                outcome == 'ok', outcome == 'timeout')
+        if T.on():
+            T.log('_fetch: %s in %.3f secs, pattern %s, enqueueing %s', server.url, elapsed,
+                  server.matcher, result.json()[:128])
+        await self._enqueue(result)
+
+    def _remember(self, url: str, resp: aiohttp.ClientResponse, match: bool) -> None:
+        """Keep the validators of a full response of `url` for the next conditional GET."""
+        headers = {}
+        if resp.headers.get('ETag'):
+            headers['If-None-Match'] = resp.headers['ETag']
+        if resp.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = resp.headers['Last-Modified']
+        if headers and resp.status == 200:
+            self._validators[url] = (headers, resp.status, match)
+        else:
+            self._validators.pop(url, None)
+
+    async def _enqueue(self, result: RemoteServerResult) -> None:
+        if self._changes is None:
             await self._queue.put(result)
-            used = time.clock_gettime(time.CLOCK_MONOTONIC) - start_time
-            timeout = self._http_timeout - used
-            L.debug("_fetch: sleeping %d for url %s", timeout, server.url)
-            await asyncio.sleep(timeout)
-            L.debug('_fetchj: Done sleep, new iteration starts')
+        else:
+            for r in self._changes.filter(result):
+                await self._queue.put(r)
 
     async def producers(self, client):
-        """Create a list with one task per scrape target and return the list."""
-        self._producers = [asyncio.create_task(self._fetch(client, server))
-                           for server in self._servers]
+        """Start the scheduler task and return it as one element list."""
+        self._producers = [asyncio.create_task(
+            self._scheduler.run(lambda server: self._fetch(client, server)))]
         return self._producers
 
+    def stats(self) -> dict:
+        """Return the scheduler statistics, the held back results and the breaker counts."""
+        _s = self._scheduler.stats()
+        if self._changes is not None:
+            _s['suppressed'] = self._changes.suppressed
+        if self._health is not None:
+            _s.update(('breakers_' + k, v) for k, v in self._health.stats().items())
+        return _s
+
     async def cancel(self, *args):
         """Cancel running tasks."""
         L.warning('cancel: args = %s', args)
@@ -100,40 +304,155 @@ class Scraper:
         await self._queue.join()
 
 
-async def run(c: Config) -> None:
+class ConnStats:
+    """Count new and reused HTTP connections and DNS cache use.
+
+    The counters are hooked into the client session with an aiohttp
+    trace config and reset every time they are reported, so they show
+    how many TCP and TLS handshakes were saved per interval.
+    """
+
+    def __init__(self):
+        """Create zeroed counters."""
+        self._reset()
+
+    def _reset(self):
+        self.created = 0
+        self.reused = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Return a trace config feeding the counters."""
+        tc = aiohttp.TraceConfig()
+        tc.on_connection_create_end.append(self._on_create)
+        tc.on_connection_reuseconn.append(self._on_reuse)
+        tc.on_dns_cache_hit.append(self._on_dns_hit)
+        tc.on_dns_cache_miss.append(self._on_dns_miss)
+        return tc
+
+    async def _on_create(self, *_):
+        self.created += 1
+
+    async def _on_reuse(self, *_):
+        self.reused += 1
+
+    async def _on_dns_hit(self, *_):
+        self.dns_hits += 1
+
+    async def _on_dns_miss(self, *_):
+        self.dns_misses += 1
+
+    def stats(self) -> dict:
+        """Return the counters since the last call and reset them."""
+        _s = {'created': self.created,
+              'reused': self.reused,
+              'dns_hits': self.dns_hits,
+              'dns_misses': self.dns_misses}
+        self._reset()
+        return _s
+
+
+def session(c: Config, conn_stats: ConnStats) -> aiohttp.ClientSession:
+    """Create the client session shared by all scrapes.
+
+    Connections are kept alive at least one interval, so the next scrape of
+    a server reuses them. The aiodns resolver is used if requested and
+    installed.
+    """
+    resolver = None
+    if c.aiodns:
+        try:
+            import aiodns  # noqa: F401
+            resolver = aiohttp.AsyncResolver()
+        except ImportError:
+            L.warning('session: aiodns is not installed, using the default resolver')
+    keepalive = c.keepalive_timeout if c.keepalive_timeout is not None else c.interval + 5
+    connector = aiohttp.TCPConnector(limit=c.http_limit,
+                                     limit_per_host=c.http_limit_per_host,
+                                     ttl_dns_cache=c.dns_ttl,
+                                     keepalive_timeout=keepalive,
+                                     resolver=resolver)
+    return aiohttp.ClientSession(connector=connector,
+                                 trace_configs=[conn_stats.trace_config()])
+
+
+async def report(interval: int, publish=None, **sources) -> None:
+    """Log the statistics of `sources` once per interval.
+
+    If given, `publish` is called with a dict of all statistics, keyed by
+    source name.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        stats = {name: source.stats() for name, source in sources.items()}
+        for name, _s in stats.items():
+            L.info('%s: %s', name, _s)
+        if publish:
+            publish(stats)
+
+
+async def scrape(c: Config, q: ResultQueue, publish=None, **sources) -> None:
+    """Scrape the servers in `c` into `q` until cancelled.
+
+    Whatever consumes the queue must already be running. The queue and the
+    additional `sources` report their statistics once per interval, see
+    `report`.
+    """
+    s = Scraper(c, q)
+    QUEUE_DEPTH.labels().set_function(q.qsize)
+    conn_stats = ConnStats()
+    reporter = asyncio.create_task(report(c.interval, publish, queue=q, scheduler=s,
+                                          connections=conn_stats, **sources))
+    async with session(c, conn_stats) as client:
+        producers = await s.producers(client)
+        try:
+            await asyncio.gather(*producers)
+        except asyncio.exceptions.CancelledError:
+            L.warning('main run: cancelled')
+            reporter.cancel()
+            await q.join()
+    L.debug('main run: done')
+
+
+async def run(c: Config, publish=None) -> None:
     """Init the async tasks and start them.
 
-    Creates one scrape task per URL, 'producer' number of kafka producers and
+    Creates the scrape scheduler, 'producer' number of kafka producers and
     connects then via an async queue. The fetchers push ServerResults into the
     queue, and the kafka producers send the result to the Kafka broker.
 
     It is assumed, that the broker is available. The queue is only here to
-    decouple the scraper from the kafka producer.
+    decouple the scraper from the kafka producer. It holds `queue_factor`
+    results per scrape target, i.e. it buffers that many measurements when
+    the broker is slow. What happens when it is full is decided by
+    `queue_policy`, see `ae.bb.resultqueue`.
+
+    The statistics are handed to `publish`, see `report`. On the way out
+    the partial windows of the series wire format are sent.
 
-    FIXME: the queue should be of limited capacity, at least as big as the
-    number of scrape targets, at most N times the  number of scrape targets,
-    which will buffer N measurements.
+    With `spool_dir` set, messages Kafka does not take are spooled to disk
+    and sent later, see `ae.bb.spool`. With `metrics_port` set, the
+    metrics are served on that port, see `ae.bb.metrics`.
     """
-    q = asyncio.Queue()
-    kp = Producer(c.kafka_endpoint, c.kafka_producer, c.topic, q)
+    runner = await metrics.serve(c.metrics_port) if c.metrics_port else None
+    q = ResultQueue(max(1, c.queue_factor * len(c.servers)), c.queue_policy)
+    spool = Spool(c.spool_dir, c.spool_max_bytes, fsync=c.spool_fsync) if c.spool_dir else None
+    kp = Producer(c.kafka_endpoint, c.kafka_producer, c.topic, q,
+                  c.kafka_in_flight, c.kafka_linger_ms, c.kafka_batch_size, c.kafka_compression,
+                  c.wire_format, c.series_window, spool)
     await kp.init()
+    await kp.kafka_producers()
+    try:
+        await scrape(c, q, publish, producer=kp)
+        await kp.flush()
+    finally:
+        await kp.close()
+        if runner is not None:
+            await runner.cleanup()
 
-    s = Scraper(c, q)
-    async with aiohttp.ClientSession() as client:
-        producers = await s.producers(client)
-        _ = await kp.kafka_producers()
-        while True:
-            try:
-                await asyncio.gather(*producers)
-                await q.join()
-            except asyncio.exceptions.CancelledError:
-                L.warning('main run: cancelled')
-                await q.join()
-                return
-    L.debug('main run: done')
 
-
-def _check_timeouts(interval, http_timeout, kafka_timeout):
+def check_timeouts(interval, http_timeout, kafka_timeout):
     """Checkf for timeout validity.
 
     kafka_timeout + http_timeout < interval + fudge (2 secs for now)
@@ -153,11 +472,37 @@ def start(config_file: TextIO,
           http_timeout: int,
           kafka_endpoint: str,
           kafka_producer: int,
-          kafka_timeout: int):
-    """Run the main loop."""
-    if not _check_timeouts(interval, http_timeout, kafka_timeout):
+          kafka_timeout: int,
+          queue_factor: int = 2,
+          queue_policy: str = 'block',
+          kafka_in_flight: int = 1,
+          kafka_linger_ms: int = 0,
+          kafka_batch_size: int = 16384,
+          kafka_compression: str = None,
+          max_in_flight: int = 1000,
+          http: dict = None,
+          workers: int = 1,
+          wire_format: str = JSON,
+          series_window: int = 10,
+          changes_only: bool = False,
+          heartbeat: int = 10,
+          spool: dict = None,
+          metrics_port: int = None):
+    """Run the main loop.
+
+    `http` holds the settings of the HTTP client, keyed by the `Config`
+    property names, as do the spool settings in `spool`. With more than one
+    worker the servers are sharded across that many processes, see
+    `ae.bb.workers`; each worker serves its metrics on its own port,
+    counting up from `metrics_port`.
+    """
+    if not check_timeouts(interval, http_timeout, kafka_timeout):
         L.fatal('Aborting.')
         sys.exit(1)
+    if changes_only and wire_format == SERIES:
+        L.fatal('changes only does not work with the series wire format, which encodes unchanged '
+                'results in a few bits anyway. Aborting.')
+        sys.exit(1)
 
     c = Config(config_file)
     c.topic = topic
@@ -166,4 +511,22 @@ def start(config_file: TextIO,
     c.kafka_endpoint = kafka_endpoint
     c.kafka_producer = kafka_producer
     c.kafka_timeout = kafka_timeout
-    asyncio.run(run(c))
+    c.kafka_in_flight = kafka_in_flight
+    c.kafka_linger_ms = kafka_linger_ms
+    c.kafka_batch_size = kafka_batch_size
+    c.kafka_compression = kafka_compression
+    c.queue_factor = queue_factor
+    c.queue_policy = queue_policy
+    c.max_in_flight = max_in_flight
+    c.wire_format = wire_format
+    c.series_window = series_window
+    c.changes_only = changes_only
+    c.heartbeat = heartbeat
+    c.metrics_port = metrics_port
+    for k, v in list((http or {}).items()) + list((spool or {}).items()):
+        setattr(c, k, v)
+    if workers > 1:
+        from ae.bb.workers import Supervisor
+        Supervisor(c, workers).run()
+    else:
+        asyncio.run(run(c))
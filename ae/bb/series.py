@@ -0,0 +1,177 @@
+"""Compressed time series of the results of one target.
+
+A series packs a window of consecutive results of one scrape target into
+one bus message, in the spirit of Gorilla
+(https://blog.acolyer.org/2016/05/03/gorilla-a-fast-scalable-in-memory-time-series-database/):
+
+- timestamps are stored with millisecond resolution as delta of deltas.
+  With a fixed scrape interval the delta of deltas is only the jitter of
+  the response time, one or two bytes per point.
+- the http status, match flag and network status are run length encoded.
+  A target answering 200 with a match every interval needs one run for the
+  whole window.
+
+All integers are LEB128 varints, signed ones zigzag encoded. Layout: magic,
+version 3, target id, number of points, number of network status texts
+after the empty one, each text as length and utf-8 bytes, the first
+timestamp, the first delta and the delta of deltas of the remaining
+points, then the runs as length, ``(http status + 1) << 1 | match`` and the
+network status index.
+"""
+
+import logging
+import math
+
+from ae.bb.data import _MAGIC, RemoteServerResult, ResultBatch
+
+L = logging.getLogger('series')
+
+_VERSION = 3
+
+
+def _put_uint(out: bytearray, n: int) -> None:
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _put_int(out: bytearray, n: int) -> None:
+    _put_uint(out, (n << 1) ^ (n >> 63))
+
+
+def _get_uint(b: bytes, off: int) -> tuple:
+    n = shift = 0
+    while True:
+        try:
+            byte = b[off]
+        except IndexError:
+            raise ValueError('Truncated series message') from None
+        off += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, off
+        shift += 7
+
+
+def _get_int(b: bytes, off: int) -> tuple:
+    n, off = _get_uint(b, off)
+    return (n >> 1) ^ -(n & 1), off
+
+
+def encode(results: list) -> bytes:
+    """Encode `results` of one target, in scrape order, into one message.
+
+    Timestamps are rounded to milliseconds. The unchanged since time of the
+    results is not encoded, a series holds every scrape anyway.
+    """
+    out = bytearray((_MAGIC, _VERSION))
+    _put_uint(out, results[0].target_id)
+    _put_uint(out, len(results))
+    table = ['']
+    index = {'': 0}
+    runs = []
+    for r in results:
+        code = index.get(r.nw_status)
+        if code is None:
+            code = index[r.nw_status] = len(table)
+            table.append(r.nw_status)
+        value = (0 if r.http_status is None else r.http_status + 1) << 1 | bool(r.match)
+        if runs and runs[-1][1] == value and runs[-1][2] == code:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value, code])
+    _put_uint(out, len(table) - 1)
+    for text in table[1:]:
+        raw = text.encode('utf-8')
+        _put_uint(out, len(raw))
+        out += raw
+    prev = prev_delta = 0
+    for i, r in enumerate(results):
+        t = round(r.tstamp * 1000)
+        if i == 0:
+            _put_uint(out, t)
+        else:
+            delta = t - prev
+            _put_int(out, delta - prev_delta)
+            prev_delta = delta
+        prev = t
+    for length, value, code in runs:
+        _put_uint(out, length)
+        _put_uint(out, value)
+        _put_uint(out, code)
+    return bytes(out)
+
+
+def is_series(b: bytes) -> bool:
+    """Return True if `b` is an encoded series."""
+    return len(b) >= 2 and b[0] == _MAGIC and b[1] == _VERSION
+
+
+def decode(b: bytes) -> ResultBatch:
+    """Decode a series message into a batch, raises ValueError if it is malformed."""
+    if not is_series(b):
+        raise ValueError('Not a series message')
+    batch = ResultBatch()
+    target_id, off = _get_uint(b, 2)
+    count, off = _get_uint(b, off)
+    ntab, off = _get_uint(b, off)
+    for _ in range(ntab):
+        length, off = _get_uint(b, off)
+        if off + length > len(b):
+            raise ValueError('Truncated series message')
+        batch._nw_code(bytes(b[off:off + length]).decode('utf-8'))
+        off += length
+    t = delta = 0
+    for i in range(count):
+        if i == 0:
+            t, off = _get_uint(b, off)
+        else:
+            dod, off = _get_int(b, off)
+            delta += dod
+            t += delta
+        batch.target_ids.append(target_id)
+        batch.tstamps.append(t / 1000)
+        batch.unchanged_since.append(math.nan)
+    while len(batch.http_status) < count:
+        length, off = _get_uint(b, off)
+        value, off = _get_uint(b, off)
+        code, off = _get_uint(b, off)
+        if code > ntab or length == 0 or len(batch.http_status) + length > count:
+            raise ValueError('Invalid run in series message')
+        http_status = (value >> 1) - 1
+        batch.http_status.extend([http_status] * length)
+        batch.match.extend([value & 1] * length)
+        batch.nw_codes.extend([code] * length)
+    return batch
+
+
+class Windows:
+    """Collect results per target until a window is full.
+
+    `add` returns the encoded series of a target once `size` of its results
+    have been collected, `flush` encodes all partial windows.
+    """
+
+    def __init__(self, size: int):
+        """Create empty windows of `size` results."""
+        self._size = size
+        self._windows = {}
+
+    def __len__(self) -> int:
+        """Return the number of results waiting in windows."""
+        return sum(len(w) for w in self._windows.values())
+
+    def add(self, result: RemoteServerResult) -> tuple:
+        """Add `result`, return (results, message) if its window is full, else None."""
+        window = self._windows.setdefault(result.target_id, [])
+        window.append(result)
+        if len(window) < self._size:
+            return None
+        del self._windows[result.target_id]
+        return window, encode(window)
+
+    def flush(self) -> list:
+        """Return (results, message) of every partial window and empty them."""
+        windows, self._windows = self._windows, {}
+        return [(window, encode(window)) for window in windows.values()]
@@ -0,0 +1,234 @@
+"""Disk spool for messages the message bus can't take.
+
+The spool is a directory of append-only segment files, named by a
+sequence number. Each record is the length and CRC32 of a message followed
+by the message itself. Messages are appended to the newest segment and read
+back in order from the oldest one. Several messages can be read ahead with
+`read` before they are acknowledged with `ack`, in any order; a segment is
+deleted once it is read completely and all its messages are acknowledged.
+`peek` and `pop` do the same one message at a time. When the spool would
+grow beyond `max_bytes`, the oldest segment is dropped.
+
+The spool is not thread safe. Its methods do blocking file IO, an asyncio
+user runs them all on one executor thread.
+
+How often appended data is flushed to the disk is set by the fsync policy:
+
+``always``
+    after every `append` or `append_many`, nothing is lost when the machine
+    crashes.
+``interval``
+    at most once per `fsync_interval` seconds.
+``never``
+    left to the operating system.
+
+Reading does not remember its position across restarts, a partly
+acknowledged segment is read again from the start. The duplicate results
+are skipped by the unique index of the database.
+"""
+
+import logging
+import os
+import struct
+import time
+import zlib
+
+L = logging.getLogger('spool')
+
+ALWAYS = 'always'
+INTERVAL = 'interval'
+NEVER = 'never'
+FSYNC_POLICIES = (ALWAYS, INTERVAL, NEVER)
+
+_HEADER = struct.Struct('<II')  #: length, crc32 of the message
+_SUFFIX = '.seg'
+
+
+class Spool:
+    """FIFO of messages in segment files below `path`."""
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024,
+                 segment_bytes: int = 16 * 1024 * 1024, fsync: str = INTERVAL,
+                 fsync_interval: float = 1.0):
+        """Open the spool in `path`, creating it if needed."""
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Invalid fsync policy "{0}"'.format(fsync))
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._max_bytes = max_bytes
+        self._segment_bytes = min(segment_bytes, max(1, max_bytes // 4))
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._synced = time.monotonic()
+        self._segments = sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(path)
+                                if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+        self._sizes = {seq: os.path.getsize(self._file(seq)) for seq in self._segments}
+        self._unacked = dict(self._sizes)  #: bytes not acknowledged yet, by segment
+        self._finished = set()  #: segments read completely
+        self._last = self._segments[-1] if self._segments else -1
+        self._writer = None
+        self._reader = None
+        self._read_seq = None
+        self._tokens = {}
+        self._token = 0
+        self._next = None
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped_segments = 0
+        if self._segments:
+            L.warning('Spool: %d bytes left in %s', sum(self._sizes.values()), path)
+
+    def _file(self, seq: int) -> str:
+        return os.path.join(self._path, '{0:020d}{1}'.format(seq, _SUFFIX))
+
+    def __len__(self) -> int:
+        """Return the number of bytes in the spool, read or not."""
+        return sum(self._sizes.values())
+
+    def empty(self) -> bool:
+        """Return True if every message is acknowledged, without touching the disk."""
+        return not any(self._unacked.values())
+
+    def append(self, message: bytes) -> None:
+        """Add `message` at the end of the spool."""
+        self.append_many([message])
+
+    def append_many(self, messages: list) -> None:
+        """Add `messages` at the end of the spool, with at most one fsync."""
+        for message in messages:
+            record = _HEADER.pack(len(message), zlib.crc32(message)) + message
+            if self._writer is None or \
+                    self._sizes[self._segments[-1]] + len(record) > self._segment_bytes:
+                self._roll()
+            while len(self) + len(record) > self._max_bytes and len(self._segments) > 1:
+                self._drop_oldest()
+            self._writer.write(record)
+            self._sizes[self._segments[-1]] += len(record)
+            self._unacked[self._segments[-1]] += len(record)
+            self.spooled += 1
+        self._writer.flush()
+        if self._fsync == ALWAYS or (self._fsync == INTERVAL and
+                                     time.monotonic() - self._synced >= self._fsync_interval):
+            os.fsync(self._writer.fileno())
+            self._synced = time.monotonic()
+
+    def _roll(self) -> None:
+        """Start a new segment."""
+        if self._writer is not None:
+            self._writer.flush()
+            if self._fsync != NEVER:
+                os.fsync(self._writer.fileno())
+            self._writer.close()
+        self._last += 1
+        self._segments.append(self._last)
+        self._sizes[self._last] = self._unacked[self._last] = 0
+        self._writer = open(self._file(self._last), 'ab')
+
+    def _drop_oldest(self) -> None:
+        seq = self._segments[0]
+        L.error('_drop_oldest: spool full, dropping %d bytes of %s', self._sizes[seq], self._file(seq))
+        self._remove(seq)
+        self.dropped_segments += 1
+
+    def _remove(self, seq: int) -> None:
+        if self._read_seq == seq and self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        for token in [t for t, (s, _) in self._tokens.items() if s == seq]:
+            del self._tokens[token]
+        if self._next is not None and self._next[0] not in self._tokens:
+            self._next = None
+        self._segments.remove(seq)
+        self._finished.discard(seq)
+        del self._sizes[seq]
+        del self._unacked[seq]
+        os.remove(self._file(seq))
+
+    def read(self):
+        """Return the next unread message as (token, message), or None.
+
+        The message stays in the spool until `ack` is called with its token.
+        """
+        while True:
+            if self._reader is None:
+                later = [seq for seq in self._segments if self._read_seq is None or seq > self._read_seq]
+                if not later:
+                    return None
+                self._read_seq = later[0]
+                self._reader = open(self._file(self._read_seq), 'rb')
+            message = self._read()
+            if message is not None:
+                self._token += 1
+                self._tokens[self._token] = (self._read_seq, _HEADER.size + len(message))
+                return self._token, message
+            if self._read_seq == self._segments[-1] and self._writer is not None:
+                return None  # everything written so far is read
+            self._finish()
+
+    def _finish(self) -> None:
+        """Close the segment read completely, the bytes not read are done."""
+        seq = self._read_seq
+        self._unacked[seq] -= self._sizes[seq] - self._reader.tell()
+        self._reader.close()
+        self._reader = None
+        self._finished.add(seq)
+        self._release(seq)
+
+    def _release(self, seq: int) -> None:
+        if seq in self._finished and self._unacked[seq] <= 0:
+            self._remove(seq)
+
+    def ack(self, token: int) -> None:
+        """Remove the message read with `token`, it was delivered."""
+        entry = self._tokens.pop(token, None)
+        if entry is None:
+            return  # its segment was dropped meanwhile
+        seq, size = entry
+        self._unacked[seq] -= size
+        self.replayed += 1
+        self._release(seq)
+
+    def _read(self) -> bytes:
+        """Read the next record of the current segment, None at its end."""
+        pos = self._reader.tell()
+        header = self._reader.read(_HEADER.size)
+        if len(header) == _HEADER.size:
+            length, crc = _HEADER.unpack(header)
+            message = self._reader.read(length)
+            if len(message) == length and zlib.crc32(message) == crc:
+                return message
+            if self._read_seq != self._segments[-1] or self._writer is None:
+                L.error('_read: corrupt record in %s at %d, skipping the rest',
+                        self._file(self._read_seq), pos)
+        # the end, a corrupt record or one being written
+        self._reader.seek(pos)
+        return None
+
+    def peek(self) -> bytes:
+        """Return the oldest message not popped yet, or None."""
+        if self._next is None:
+            self._next = self.read()
+            if self._next is None:
+                return None
+        return self._next[1]
+
+    def pop(self) -> None:
+        """Remove the message returned by `peek`."""
+        if self._next is not None:
+            token, self._next = self._next[0], None
+            self.ack(token)
+
+    def close(self) -> None:
+        """Close the files, the unread messages stay on disk."""
+        for f in (self._reader, self._writer):
+            if f is not None:
+                f.close()
+        self._reader = self._writer = self._next = None
+
+    def stats(self) -> dict:
+        """Return the size and the message counters of the spool."""
+        return {'bytes': len(self),
+                'segments': len(self._segments),
+                'spooled': self.spooled,
+                'replayed': self.replayed,
+                'dropped_segments': self.dropped_segments}
@@ -0,0 +1,69 @@
+"""Scrape and store in one process, without the message bus.
+
+The scraper feeds the result queue, a batching `ae.bb.storage.Sink`
+drains it directly into postgres. There is no network hop between the two
+halves, see the Reliability section of the design document.
+"""
+
+import asyncio
+import logging
+import sys
+
+from typing import TextIO
+
+from ae.bb import metrics, scraper
+from ae.bb.data import Config
+from ae.bb.resultqueue import ResultQueue
+from ae.bb.storage import DB, Sink
+
+L = logging.getLogger('standalone')
+
+
+async def run(c: Config, db: DB, sinks: int, batch_size: int, linger: float) -> None:
+    """Connect to the DB, then scrape into the queue and store from it."""
+    runner = await metrics.serve(c.metrics_port) if c.metrics_port else None
+    try:
+        await db.connect()
+        q = ResultQueue(max(1, c.queue_factor * len(c.servers)), c.queue_policy)
+        sink = Sink(db, q, sinks, batch_size, linger)
+        sink.sinks()
+        await scraper.scrape(c, q, sink=sink)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+def start(config_file: TextIO,
+          interval: int,
+          http_timeout: int,
+          pg_dsn: str,
+          pg_password: str,
+          queue_factor: int = 2,
+          queue_policy: str = 'block',
+          sinks: int = 2,
+          batch_size: int = 1000,
+          linger: float = 0.5,
+          max_in_flight: int = 1000,
+          http: dict = None,
+          changes_only: bool = False,
+          heartbeat: int = 10,
+          schema=None,
+          metrics_port: int = None):
+    """Run the main loop, `http` as in `ae.bb.scraper.start`, `schema` as in `ae.bb.storage.run`."""
+    if not scraper.check_timeouts(interval, http_timeout, 0):
+        L.fatal('Aborting.')
+        sys.exit(1)
+
+    c = Config(config_file)
+    c.interval = interval
+    c.http_timeout = http_timeout
+    c.queue_factor = queue_factor
+    c.queue_policy = queue_policy
+    c.max_in_flight = max_in_flight
+    c.changes_only = changes_only
+    c.heartbeat = heartbeat
+    c.metrics_port = metrics_port
+    for k, v in (http or {}).items():
+        setattr(c, k, v)
+    db = DB(password=pg_password, dsn=pg_dsn, pool_size=sinks, schema=schema)
+    asyncio.run(run(c, db, sinks, batch_size, linger))
@@ -1,48 +1,188 @@
 """Interface to postgres DB."""
 
 import asyncio
+import concurrent.futures
+import functools
+import io
 import logging
 import datetime
 import time
 
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
 
-from ae.bb.msgbus import Consumer
+from ae.bb import metrics, trace
+from ae.bb.data import ResultBatch
+from ae.bb.msgbus import UNKNOWN_TARGETS, Consumer
+from ae.bb.schema import Webservers, execute
 
 L = logging.getLogger()
+T = trace.Tracer('storage')
+
+INSERT_SECONDS = metrics.Histogram('ae_db_insert_seconds', 'Duration of the insert transactions',
+                                   ('op',))
+BATCH_ROWS = metrics.Histogram('ae_db_batch_rows', 'Rows per batch insert',
+                               buckets=metrics.SIZE_BUCKETS)
+DUPLICATES = metrics.Counter('ae_db_duplicates_total', 'Rows skipped as already stored')
+REJECTED = metrics.Counter('ae_db_rejected_rows_total', 'Rows dropped as refused by the DB')
+
+
+class _Connection(psycopg2.extensions.connection):
+    """Pooled connection remembering its per session setup."""
+
+    staged = False
+
+    def __init__(self, *args, **kwargs):
+        """Open the connection, nothing is prepared yet."""
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
 
 
 class DB:
     """Implement interface to postgres DB.
 
-    Simple wrapper around postgres DB. Errors here
-    are always fatal. Connection problems block the whole
-    machinery, becausae we can. There's a message bus buffering
-    data, so we don't have to care.
+    Asyncio wrapper around a bounded pool of postgres connections. The
+    blocking psycopg2 calls run in a thread pool with one thread per pooled
+    connection, so several batches can be inserted at the same time while
+    the event loop keeps fetching from the message bus. Connection problems
+    are retried with a backoff sleeping on the event loop; there's a message
+    bus buffering data, so we don't have to care.
+
+    The tables written to are defined by `schema`, see `ae.bb.schema`. With
+    a normalized schema the target ids of the URLs are cached, so each row
+    carries only integers. With a partitioned schema the existing partitions
+    are cached as well, and a maintenance task adds and drops partitions
+    every `maintenance_interval` seconds.
     """
 
-    def __init__(self, password="", dsn="host=s1 dbnname=aiven user=aiven"):
-        """Connect to the DB."""
+    def __init__(self, password="", dsn="host=s1 dbnname=aiven user=aiven", pool_size=4,
+                 schema=None):
+        """Set up the DB parameters, `connect` creates the connections and tables."""
         self._dsn = dsn
         self._password = password
         self._backoff_time = 2
-        self._stmt = \
-            """insert into webservers (url,     tstamp,     nw_status,       http_status,     match)
-                                values(%(url)s, %(tstamp)s, %(nw_status)s, %(http_status)s, %(match)s)
-            """
-        self._connect()
+        self._pool_size = pool_size
+        self._pool = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size,
+                                                               thread_name_prefix='db')
+        self._schema = schema or Webservers()
+        self._target_ids = {}
+        self._days = set()
+        self._maintenance = None
+        self.maintenance_interval = 3600
 
-    def _connect(self):
+    async def _run(self, fn, *args):
+        """Run a blocking DB function in the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def connect(self):
+        """Create the connection pool, retry until the DB is reachable."""
         while True:
             try:
-                self._conn = psycopg2.connect(dsn=self._dsn, password=self._password)
-                L.warning('_connect: self._conn = %s', self._conn)
-                return
+                self._pool = await self._run(functools.partial(
+                    psycopg2.pool.ThreadedConnectionPool, 1, self._pool_size,
+                    dsn=self._dsn, password=self._password,
+                    connection_factory=_Connection))
+                L.warning('connect: pool of %d connections to %s', self._pool_size, self._dsn)
+                break
             except psycopg2.OperationalError:
-                L.error('_connect: Cannot connect to %s, sleeping....', self._dsn)
-                time.sleep(self._backoff_time)
+                L.error('connect: Cannot connect to %s, sleeping....', self._dsn)
+                await asyncio.sleep(self._backoff_time)
+        self._schema = await self._retry(self._transaction, self._schema.create)
+        L.warning('connect: writing to the %s schema', self._schema.name)
+        if self._schema.partitioned:
+            await self._maintain()
+            self._maintenance = asyncio.create_task(self._maintain_loop())
+
+    async def _maintain(self):
+        self._days = await self._retry(self._transaction, self._schema.maintain,
+                                       datetime.date.today())
 
-    def store(self, result):
+    async def _maintain_loop(self):
+        """Add and drop partitions once per maintenance interval."""
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                await self._maintain()
+            except Exception:
+                L.exception('_maintain_loop: partition maintenance failed')
+
+    async def _partitions(self, rows: list) -> list:
+        """Create the partitions `rows` go to, return the rows not expired yet."""
+        oldest = self._schema.oldest()
+        if oldest:
+            kept = [row for row in rows if datetime.date.fromtimestamp(row[1]) >= oldest]
+            if len(kept) < len(rows):
+                L.warning('_partitions: dropping %d rows older than %s', len(rows) - len(kept), oldest)
+            rows = kept
+        days = {datetime.date.fromtimestamp(row[1]) for row in rows} - self._days
+        if days:
+            await self._retry(self._transaction, self._schema.add_partitions, sorted(days))
+            self._days |= days
+        return rows
+
+    async def _ids(self, urls) -> dict:
+        """Return the cached target ids, after looking up the ones of new `urls`."""
+        missing = [url for url in set(urls) if url not in self._target_ids]
+        if missing:
+            self._target_ids.update(await self._retry(self._transaction,
+                                                      self._schema.target_ids, missing))
+        return self._target_ids
+
+    async def close(self):
+        """Close all pooled connections."""
+        if self._maintenance:
+            self._maintenance.cancel()
+        if self._pool:
+            await self._run(self._pool.closeall)
+            self._pool = None
+        self._executor.shutdown(wait=False)
+
+    async def _retry(self, fn, *args):
+        """Run `fn` in the executor, retry on connection errors."""
+        while True:
+            try:
+                return await self._run(fn, *args)
+            except psycopg2.OperationalError:
+                L.exception('DB not reachable, retrying in %d secs', self._backoff_time)
+                await asyncio.sleep(self._backoff_time)
+
+    def _transaction(self, fn, *args):
+        """Run `fn(conn, cursor, *args)` in one transaction on a pooled connection.
+
+        Broken connections are closed and dropped from the pool, the pool
+        opens a fresh one the next time it runs short. The other connections
+        and their prepared statements stay. After a rollback the prepared
+        statements of the connection are dropped, so they are prepared again
+        from a clean state.
+        """
+        conn = self._pool.getconn()
+        try:
+            with conn.cursor() as _c:
+                ret = fn(conn, _c, *args)
+            conn.commit()
+        except psycopg2.OperationalError:
+            self._pool.putconn(conn, close=True)
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+                with conn.cursor() as _c:
+                    _c.execute('deallocate all')
+                conn.commit()
+                conn.prepared.clear()
+            except psycopg2.Error:
+                self._pool.putconn(conn, close=True)
+                raise
+            self._pool.putconn(conn)
+            raise
+        self._pool.putconn(conn)
+        return ret
+
+    async def store(self, result):
         """Store one result.
 
         Retry in connection errors, abort the single insert error.
@@ -50,36 +190,233 @@ class DB:
         so we don't have to do fancy 2 phase commits between postgres
         and Kafka.
         """
-        while True:
-            _c = self._conn.cursor()
-            data = {
-                'url': result.url,
-                'tstamp': datetime.datetime.fromtimestamp(result.tstamp),
-                'nw_status': result.nw_status,
-                'http_status': result.http_status,
-                'match': result.match}
-            L.info('inserting data %s', data)
+        data = _data(result.url, result.tstamp, result.nw_status, result.http_status,
+                     result.match, result.unchanged_since)
+        if self._schema.partitioned and not await self._partitions([(result.url, result.tstamp)]):
+            return
+        if self._schema.normalized:
+            data['target_id'] = (await self._ids([result.url]))[result.url]
+        if T.on():
+            T.log('store: inserting %s', data)
+        t0 = time.perf_counter()
+        try:
+            await self._retry(self._transaction, self._insert, data)
+        except psycopg2.errors.UniqueViolation:
+            if T.on():
+                T.log('store: duplicate entry %s at %s', data['url'], data['tstamp'])
+            DUPLICATES.labels().inc()
+        INSERT_SECONDS.labels('insert').observe(time.perf_counter() - t0)
+
+    def _insert(self, conn, cursor, data):
+        execute(conn, cursor, 'ae_insert', self._schema.insert_stmt,
+                (data['target_id'] if self._schema.normalized else data['url'], data['tstamp'],
+                 data['nw_status'], data['http_status'], data['match'], data['unchanged_since']))
+
+    async def store_many(self, results) -> int:
+        """Store a batch of results in one transaction.
+
+        The batch is written with ``COPY FROM STDIN`` into a staging table
+        and merged into ``webservers`` with ``ON CONFLICT DO NOTHING``, so a
+        duplicate (url, timestamp) only skips that row. The transaction is
+        retried as a whole on connection errors. Returns the number of rows
+        actually inserted.
+        """
+        return await self._copy([(r.url, r.tstamp, r.nw_status, r.http_status, r.match,
+                                  r.unchanged_since) for r in results], 'store_many')
+
+    async def store_batch(self, batch: ResultBatch, targets: dict) -> int:
+        """Store a `ResultBatch` in one transaction, like `store_many`.
+
+        The COPY input is built from the batch columns directly, without a
+        result object per row. `targets` maps the target ids to URLs, rows
+        with unknown ids are skipped and counted.
+        """
+        unknown = batch.unknown(targets)
+        if unknown:
+            L.warning('store_batch: skipping %d of %d rows with unknown target ids', unknown, len(batch))
+            UNKNOWN_TARGETS.labels().inc(unknown)
+        return await self._copy(list(batch.rows(targets)), 'store_batch')
+
+    async def _copy(self, rows: list, caller: str) -> int:
+        if self._schema.partitioned:
+            rows = await self._partitions(rows)
+        if not rows:
+            return 0
+        if self._schema.normalized:
+            ids = await self._ids(row[0] for row in rows)
+            rows = [(url, ids[url], *values) for url, *values in rows]
+        else:
+            rows = [(row[0], *row) for row in rows]
+        buf = io.StringIO()
+        for row in rows:
+            buf.write(_copy_row(*row[1:]))
+        count = len(rows)
+        t0 = time.perf_counter()
+        try:
+            inserted = await self._retry(self._transaction, self._copy_merge, buf)
+        except psycopg2.Error as exc:
+            L.error('%s: batch of %d rows refused (%s), inserting row by row',
+                    caller, count, str(exc).strip())
+            inserted = await self._insert_rows(rows)
+        INSERT_SECONDS.labels('copy').observe(time.perf_counter() - t0)
+        BATCH_ROWS.labels().observe(count)
+        DUPLICATES.labels().inc(count - inserted)
+        L.info('%s: inserted %d of %d rows, %d duplicates',
+               caller, inserted, count, count - inserted)
+        return inserted
+
+    async def _insert_rows(self, rows: list) -> int:
+        """Insert (url, target, ...) `rows` one at a time, drop the ones the DB refuses.
+
+        Keeps the rest of a batch that failed for a few bad rows, for
+        example a network status too long for its column, so the offset of
+        the batch can be committed.
+        """
+        inserted = 0
+        for url, target, *values in rows:
+            data = _data(url, *values)
+            data['target_id'] = target
             try:
-                _c.execute(self._stmt, data)
-                self._conn.commit()
-                return
+                await self._retry(self._transaction, self._insert, data)
+                inserted += 1
             except psycopg2.errors.UniqueViolation:
-                L.info('Got duplicate  entry %s at %s', data['url'], data['tstamp'])
-                self._conn.rollback()
-                return
-            except psycopg2.errors.AdminShutdown:
-                L.exception('DB not reachable')
-                # try to reconnect
-                self._connect()
+                pass
+            except psycopg2.Error as exc:
+                REJECTED.labels().inc()
+                L.error('_insert_rows: dropping %s (%s)', data, str(exc).strip())
+        return inserted
+
+    def _copy_merge(self, conn, cursor, buf):
+        if not conn.staged:
+            cursor.execute(self._schema.stage_stmt)
+        buf.seek(0)
+        cursor.copy_expert(self._schema.copy_stmt, buf)
+        # prepared after the staging table exists, the plan refers to it
+        execute(conn, cursor, 'ae_merge', self._schema.merge_stmt)
+        # the temp table survives the commit, mark it on success only
+        conn.staged = True
+        return cursor.rowcount
+
+
+class Sink:
+    """Store results from an in-process queue in batches.
+
+    Used instead of the Kafka producer when scraper and storage run in one
+    process. Each of the `count` sink tasks takes a result from the queue,
+    waits up to `linger` seconds for more and stores up to `batch_size`
+    results in one transaction. Results are marked done in the queue after
+    their transaction committed.
+    """
+
+    def __init__(self, db: DB, q: asyncio.Queue, count: int = 2,
+                 batch_size: int = 1000, linger: float = 0.5):
+        """Init the sink, the `db` must be connected before `sinks` is called."""
+        self._db = db
+        self._queue = q
+        self._count = count
+        self._batch_size = batch_size
+        self._linger = linger
+        self._tasks = []
+        self.stored = 0
+        self.batches = 0
+        self.max_latency = 0.0
+
+    async def _batch(self) -> list:
+        """Wait for a result, then collect what arrives within `linger`."""
+        batch = [await self._queue.get()]
+        if self._queue.qsize() < self._batch_size - 1:
+            await asyncio.sleep(self._linger)
+        while len(batch) < self._batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _store(self, idx: int) -> None:
+        while True:
+            batch = await self._batch()
+            try:
+                await self._db.store_many(batch)
+                self.stored += len(batch)
+                self.batches += 1
+                self.max_latency = max(self.max_latency, time.time() - min(r.tstamp for r in batch))
+            except Exception:
+                L.exception('_store[%d]: dropping batch of %d results', idx, len(batch))
+            for _ in batch:
+                self._queue.task_done()
+
+    def sinks(self) -> list:
+        """Create the sink tasks."""
+        self._tasks = [asyncio.create_task(self._store(i)) for i in range(self._count)]
+        return self._tasks
+
+    def stats(self) -> dict:
+        """Return the number of stored results and the worst scrape to commit latency."""
+        _s = {'stored': self.stored,
+              'batches': self.batches,
+              'max_latency': round(self.max_latency, 3)}
+        self.max_latency = 0.0
+        return _s
+
+
+def _copy_field(value) -> str:
+    """Escape one value for the COPY text format."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\') \
+                     .replace('\t', '\\t') \
+                     .replace('\n', '\\n') \
+                     .replace('\r', '\\r')
+
+
+def _datetime(tstamp):
+    return None if tstamp is None else datetime.datetime.fromtimestamp(tstamp)
 
 
-def run(pg_dsn, pg_password, kafka_endpoint, topic):
+def _data(url, tstamp, nw_status, http_status, match, unchanged_since) -> dict:
+    """Return the parameters of a single insert, without target id."""
+    return {'url': url,
+            'target_id': None,
+            'tstamp': datetime.datetime.fromtimestamp(tstamp),
+            'nw_status': nw_status,
+            'http_status': http_status,
+            'match': match,
+            'unchanged_since': _datetime(unchanged_since)}
+
+
+def _copy_row(target, tstamp, nw_status, http_status, match, unchanged_since=None) -> str:
+    """Format one result as a line of COPY text input, `target` is its URL or id."""
+    since = _datetime(unchanged_since)
+    return '\t'.join((
+        _copy_field(target),
+        _copy_field(_datetime(tstamp).isoformat(' ')),
+        _copy_field(nw_status),
+        _copy_field(http_status),
+        't' if match else 'f',
+        _copy_field(since and since.isoformat(' ')))) + '\n'
+
+
+async def _serve(consumer: Consumer, metrics_port: int = None) -> None:
+    """Run `consumer`, serving the metrics on `metrics_port` if set."""
+    runner = await metrics.serve(metrics_port) if metrics_port else None
+    try:
+        await consumer.run()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+def run(pg_dsn, pg_password, kafka_endpoint, topic, window=4, targets=None, schema=None,
+        pool_size=4, metrics_port=None):
     """Connecto to DB and Kafka and start async processing.
 
     This runs until the program is terminated. Errors int he kafka endpoint or
     the postgres DSN are not detected before this function call.
+
+    `targets` maps the target ids of binary messages to URLs. `schema` is
+    one of `ae.bb.schema`, by default the webservers table. `pool_size`
+    connections are opened at most. With `metrics_port` set, the metrics
+    are served on that port, see `ae.bb.metrics`.
     """
     L.debug('run: pg_dsn = %s', pg_dsn)
-    db = DB(password='aiven', dsn=pg_dsn)
-    c = Consumer(kafka_endpoint, topic, db)
-    asyncio.run(c.run())
+    db = DB(password=pg_password, dsn=pg_dsn, pool_size=pool_size, schema=schema)
+    c = Consumer(kafka_endpoint, topic, db, window, targets)
+    asyncio.run(_serve(c, metrics_port))
@@ -0,0 +1,50 @@
+"""Sampled tracing of the per result hot paths.
+
+Scraping, sending and storing log nothing per result unless tracing is
+switched on with a sample `rate` between 0 and 1, and the logger of the
+component is enabled for DEBUG. Then roughly that share of the trace
+points is logged. Call sites check `Tracer.on` first, so the messages are
+neither formatted nor their arguments built while tracing is off::
+
+    if T.on():
+        T.log('_fetch: %s', result.json())
+
+The rate is process wide, ``ae --trace_rate`` sets it.
+"""
+
+import logging
+import random
+
+_rate = 0.0
+
+
+def configure(rate: float) -> None:
+    """Trace a share of `rate` of the trace points, 0 switches tracing off."""
+    global _rate
+    if not 0.0 <= rate <= 1.0:
+        raise ValueError('Invalid trace rate {0}'.format(rate))
+    _rate = rate
+
+
+def rate() -> float:
+    """Return the sample rate."""
+    return _rate
+
+
+class Tracer:
+    """Trace points of one component, logged to the logger `name` at DEBUG."""
+
+    __slots__ = ('_logger',)
+
+    def __init__(self, name: str):
+        """Create the tracer of the logger `name`."""
+        self._logger = logging.getLogger(name)
+
+    def on(self) -> bool:
+        """Return True if this trace point is to be logged."""
+        return (_rate > 0.0 and self._logger.isEnabledFor(logging.DEBUG)
+                and (_rate >= 1.0 or random.random() < _rate))
+
+    def log(self, msg: str, *args) -> None:
+        """Log a trace point, call only after `on`."""
+        self._logger.debug(msg, *args)
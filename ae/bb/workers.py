@@ -0,0 +1,169 @@
+"""Run the scraper in several processes.
+
+The servers are sharded across the worker processes with a consistent
+hash ring on the URL, so adding a worker moves only about 1/N of the
+servers. Every worker runs its own event loop, HTTP client and Kafka
+producer. The parent process supervises them: it restarts crashed workers
+and merges the statistics they publish into one log line per interval.
+Workers are stopped with SIGTERM, which cancels their scraper like an
+interrupt does, so queued results, series windows and the spool are
+flushed before they exit.
+"""
+
+import asyncio
+import bisect
+import copy
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from ae.bb import trace
+from ae.bb.data import Config
+
+L = logging.getLogger('workers')
+
+VNODES = 64  #: points per worker on the hash ring
+STOP_TIMEOUT = 30  #: seconds a worker gets to flush before it is killed
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def shard(servers, n: int, vnodes: int = VNODES) -> list:
+    """Split `servers` into `n` lists by consistent hashing on the URL."""
+    ring = sorted((_hash('{0}-{1}'.format(w, v)), w) for w in range(n) for v in range(vnodes))
+    points = [p for p, _ in ring]
+    shards = [[] for _ in range(n)]
+    for server in servers:
+        idx = bisect.bisect(points, _hash(server.url)) % len(ring)
+        shards[ring[idx][1]].append(server)
+    return shards
+
+
+def merge(stats: list) -> dict:
+    """Merge the statistics of several workers.
+
+    Counters are summed, maxima and high water marks take the maximum.
+    """
+    merged = {}
+    for worker in stats:
+        for source, values in worker.items():
+            into = merged.setdefault(source, {})
+            for k, v in values.items():
+                if k.startswith('max') or k == 'high_water':
+                    into[k] = max(into.get(k, v), v)
+                else:
+                    into[k] = into.get(k, 0) + v
+    return merged
+
+
+async def _run(c: Config, publish) -> None:
+    """Run the scraper of a worker until SIGTERM cancels it."""
+    from ae.bb import scraper
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await scraper.run(c, publish)
+    except asyncio.CancelledError:
+        L.warning('worker: terminated')
+
+
+def _worker(idx: int, c: Config, stats_q: multiprocessing.Queue, level: int,
+            trace_rate: float = 0.0) -> None:
+    """Entry point of a worker process."""
+    trace.configure(trace_rate)
+
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=level)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if c.spool_dir:
+        c.spool_dir = os.path.join(c.spool_dir, 'worker-{0}'.format(idx))
+    if c.metrics_port:
+        c.metrics_port += idx
+    L.info('worker %d: scraping %d servers', idx, len(c.servers))
+    asyncio.run(_run(c, lambda s: stats_q.put((idx, s))))
+
+
+class Supervisor:
+    """Start, watch and restart the scraper worker processes."""
+
+    def __init__(self, c: Config, count: int):
+        """Shard the servers of `c` across `count` workers."""
+        self._config = c
+        self._count = count
+        self._ctx = multiprocessing.get_context()
+        self._stats_q = self._ctx.Queue()
+        self._procs = [None] * count
+        self._stats = [{} for _ in range(count)]
+        self._backoff = [1] * count
+        self._restart_at = [0.0] * count
+        self.restarts = 0
+        self._configs = []
+        for servers in shard(c.servers, count):
+            wc = copy.copy(c)
+            wc.servers = servers
+            self._configs.append(wc)
+
+    def _start(self, idx: int) -> None:
+        p = self._ctx.Process(target=_worker, name='ae-scrape-{0}'.format(idx),
+                              args=(idx, self._configs[idx], self._stats_q,
+                                    logging.getLogger().getEffectiveLevel(), trace.rate()),
+                              daemon=True)
+        p.start()
+        self._procs[idx] = p
+
+    def _watch(self) -> None:
+        """Restart dead workers, with exponential backoff per worker."""
+        now = time.monotonic()
+        for idx, p in enumerate(self._procs):
+            if p is not None and p.is_alive():
+                continue
+            if p is not None:
+                L.error('worker %d died with exit code %s, restarting in %d secs',
+                        idx, p.exitcode, self._backoff[idx])
+                self._restart_at[idx] = now + self._backoff[idx]
+                self._backoff[idx] = min(self._backoff[idx] * 2, self._config.interval)
+                self._procs[idx] = None
+                self.restarts += 1
+            elif now >= self._restart_at[idx]:
+                self._start(idx)
+
+    def _collect(self, timeout: float) -> None:
+        try:
+            idx, stats = self._stats_q.get(timeout=timeout)
+            self._stats[idx] = stats
+            # a worker reporting statistics is healthy again
+            self._backoff[idx] = 1
+        except queue.Empty:
+            pass
+
+    def run(self) -> None:
+        """Supervise the workers until interrupted."""
+        for idx in range(self._count):
+            self._start(idx)
+        next_report = time.monotonic() + self._config.interval
+        try:
+            while True:
+                self._collect(1)
+                self._watch()
+                if time.monotonic() >= next_report:
+                    next_report += self._config.interval
+                    L.info('workers: %s, restarts: %d', merge(self._stats), self.restarts)
+        except KeyboardInterrupt:
+            L.warning('run: interrupted, stopping workers')
+        finally:
+            for p in self._procs:
+                if p is not None:
+                    p.terminate()
+            for p in self._procs:
+                if p is not None:
+                    p.join(STOP_TIMEOUT)
+                    if p.is_alive():
+                        L.error('run: worker %s did not stop, killing it', p.name)
+                        p.kill()
+                        p.join()
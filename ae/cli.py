@@ -21,8 +21,14 @@ It can be used as a handy facility for running the task from a command line.
 import logging
 import coloredlogs
 import click
+from ae.bb import data
+from ae.bb import resultqueue
+from ae.bb import schema as db_schema
 from ae.bb import scraper
+from ae.bb import spool as disk_spool
+from ae.bb import standalone
 from ae.bb import storage
+from ae.bb import trace
 
 from typing import TextIO
 
@@ -57,9 +63,12 @@ pass_info = click.make_pass_decorator(Info, ensure=True)
 # tasks).
 @click.group(name='ae')
 @click.option("--verbose", "-v", count=True, help="Enable verbose output.")
+@click.option("--trace_rate", type=click.FloatRange(0, 1), default=0.0,
+              help="Share of the per result trace points logged at DEBUG level, 0 for none.")
 @pass_info
-def cli(info: Info, verbose: int):
+def cli(info: Info, verbose: int, trace_rate: float):
     """Run ae."""
+    trace.configure(trace_rate)
     # Use the verbosity count to determine the logging level...
     if verbose > 0:
         logging.basicConfig(
@@ -78,6 +87,66 @@ def cli(info: Info, verbose: int):
     info.verbose = verbose
 
 
+def change_options(f):
+    """Add the change only options to a command."""
+    f = click.option("--heartbeat", type=click.IntRange(min=1), default=10,
+                     help="With --changes_only, send an unchanged result every this many scrapes.")(f)
+    return click.option("--changes_only/--no-changes_only", default=False,
+                        help="Send only results that differ from the previous one.")(f)
+
+
+def schema_options(f):
+    """Add the database schema options to a command."""
+    for option in reversed([
+            click.option("--schema", type=click.Choice(db_schema.SCHEMAS), default=db_schema.WEBSERVERS,
+                         help="Tables to store the results in."),
+            click.option("--retention_days", type=click.IntRange(min=0), default=90,
+                         help="With the partitioned and timescale schemas, days data is kept, 0 for ever."),
+            click.option("--compress_days", type=click.IntRange(min=1), default=7,
+                         help="With the timescale schema, days after which data is compressed.")]):
+        f = option(f)
+    return f
+
+
+def metrics_option(f):
+    """Add the metrics endpoint option to a command."""
+    return click.option("--metrics_port", type=click.IntRange(min=1, max=65535),
+                        help="Serve Prometheus metrics on this port at /metrics.")(f)
+
+
+def http_options(f):
+    """Add the HTTP client options to a command.
+
+    The values are passed as keyword arguments named like the `Config`
+    properties they set.
+    """
+    for option in reversed([
+            click.option("--http_limit", type=click.IntRange(min=0), default=1000,
+                         help="Maximum number of open HTTP connections, 0 for no limit."),
+            click.option("--http_limit_per_host", type=click.IntRange(min=0), default=0,
+                         help="Maximum number of HTTP connections per host, 0 for no limit."),
+            click.option("--dns_ttl", type=int, default=300,
+                         help="Seconds DNS lookups are cached."),
+            click.option("--keepalive_timeout", type=int, default=None,
+                         help="Seconds idle connections are kept, default interval + 5."),
+            click.option("--aiodns/--no-aiodns", default=False,
+                         help="Resolve names with aiodns, if installed."),
+            click.option("--max_body", type=click.IntRange(min=1), default=1024 * 1024,
+                         help="Bytes of a body searched for the pattern."),
+            click.option("--match_thread_bytes", type=click.IntRange(min=0), default=0,
+                         help="Search body pieces of at least this many characters in a thread, 0 for never."),
+            click.option("--adaptive_timeouts/--no-adaptive_timeouts", default=False,
+                         help="Derive connect and read timeouts from the latency of each target."),
+            click.option("--min_timeout", type=click.FloatRange(min=0.1), default=1.0,
+                         help="Lower limit of the adaptive timeouts in seconds."),
+            click.option("--breaker_failures", type=click.IntRange(min=0), default=0,
+                         help="Failures in a row after which a target is paused, 0 for never."),
+            click.option("--breaker_max_backoff", type=click.IntRange(min=1), default=3600,
+                         help="Longest pause of a failing target in seconds.")]):
+        f = option(f)
+    return f
+
+
 @cli.command()
 @click.option("--config", "-c", type=click.File("r"), required=True)
 @click.option("--topic", "-t", type=str, required=True)
@@ -85,7 +154,36 @@ def cli(info: Info, verbose: int):
 @click.option("--http_timeout", type=int, default=50)
 @click.option("--kafka_endpoint", type=str, default="localhost:9092")
 @click.option("--kafka_producer", type=int, default=3)
+@click.option("--kafka_in_flight", type=click.IntRange(min=1), default=1,
+              help="Messages waiting for delivery at the same time, 1 waits for each message.")
+@click.option("--kafka_linger_ms", type=int, default=0,
+              help="Time the Kafka client waits to fill a batch.")
+@click.option("--kafka_batch_size", type=int, default=16384,
+              help="Maximum Kafka batch size in bytes.")
+@click.option("--kafka_compression", type=click.Choice(['none', 'gzip', 'snappy', 'lz4', 'zstd']),
+              default='none')
 @click.option("--kafka_timeout", type=int, default=7)
+@click.option("--max_in_flight", type=click.IntRange(min=1), default=1000,
+              help="Maximum number of concurrent scrapes.")
+@click.option("--queue_factor", type=click.IntRange(min=1), default=2,
+              help="Queue capacity as multiple of the number of scrape targets.")
+@click.option("--queue_policy", type=click.Choice(resultqueue.POLICIES), default=resultqueue.BLOCK,
+              help="What to do with a new result when the queue is full.")
+@click.option("--workers", type=click.IntRange(min=1), default=1,
+              help="Number of scraper processes the targets are sharded across.")
+@click.option("--wire_format", type=click.Choice(data.WIRE_FORMATS), default=data.JSON,
+              help="Message encoding; binary sends target ids, 'ae store' needs the config file.")
+@click.option("--series_window", type=click.IntRange(min=1), default=10,
+              help="Results per target in one message of the series wire format.")
+@click.option("--spool_dir", type=click.Path(file_okay=False),
+              help="Spool messages Kafka doesn't take to this directory, and send them later.")
+@click.option("--spool_max_mb", type=click.IntRange(min=1), default=1024,
+              help="Maximum size of the spool, the oldest messages are dropped beyond.")
+@click.option("--spool_fsync", type=click.Choice(disk_spool.FSYNC_POLICIES), default=disk_spool.INTERVAL,
+              help="When spooled messages are flushed to the disk.")
+@metrics_option
+@change_options
+@http_options
 @pass_info
 def scrape(_: Info,
            config: TextIO,
@@ -94,7 +192,24 @@ def scrape(_: Info,
            http_timeout: int,
            kafka_endpoint: str,
            kafka_producer: int,
-           kafka_timeout: int) -> None:
+           kafka_in_flight: int,
+           kafka_linger_ms: int,
+           kafka_batch_size: int,
+           kafka_compression: str,
+           kafka_timeout: int,
+           max_in_flight: int,
+           queue_factor: int,
+           queue_policy: str,
+           workers: int,
+           wire_format: str,
+           series_window: int,
+           changes_only: bool,
+           heartbeat: int,
+           spool_dir: str,
+           spool_max_mb: int,
+           spool_fsync: str,
+           metrics_port: int,
+           **http) -> None:
     """Start the srcaper component."""
     scraper.start(config,
                   topic,
@@ -102,7 +217,24 @@ def scrape(_: Info,
                   http_timeout,
                   kafka_endpoint,
                   kafka_producer,
-                  kafka_timeout)
+                  kafka_timeout,
+                  queue_factor,
+                  queue_policy,
+                  kafka_in_flight,
+                  kafka_linger_ms,
+                  kafka_batch_size,
+                  None if kafka_compression == 'none' else kafka_compression,
+                  max_in_flight,
+                  http,
+                  workers,
+                  wire_format,
+                  series_window,
+                  changes_only,
+                  heartbeat,
+                  {'spool_dir': spool_dir,
+                   'spool_max_bytes': spool_max_mb * 1024 * 1024,
+                   'spool_fsync': spool_fsync},
+                  metrics_port)
 
 
 @cli.command()
@@ -110,15 +242,93 @@ def scrape(_: Info,
 @click.option("--postgres_password", type=str, required=True)
 @click.option("--kafka_endpoint", type=str, default='localhost:9091')
 @click.option("--topic", type=str, required=True)
+@click.option("--partition_window", type=int, default=4,
+              help="Batches in flight per partition before fetching pauses.")
+@click.option("--pg_pool_size", type=click.IntRange(min=1), default=4,
+              help="Maximum number of postgres connections.")
+@click.option("--config", "-c", type=click.File("r"),
+              help="Scraper config file, maps the target ids of binary messages to URLs.")
+@schema_options
+@metrics_option
 @pass_info
 def store(_: Info,
           kafka_endpoint,
           topic,
           postgres_dsn: str,
-          postgres_password: str) -> None:
+          postgres_password: str,
+          partition_window: int,
+          pg_pool_size: int,
+          config: TextIO,
+          schema: str,
+          retention_days: int,
+          compress_days: int,
+          metrics_port: int) -> None:
     """Start the store componment."""
     L.debug("postgres_dsn = %s", postgres_dsn)
-    storage.run(postgres_dsn, postgres_password, kafka_endpoint, topic)
+    targets = data.Config(config).targets if config else None
+    storage.run(postgres_dsn, postgres_password, kafka_endpoint, topic, partition_window, targets,
+                db_schema.get(schema, retention_days, compress_days), pg_pool_size, metrics_port)
+
+
+@cli.command()
+@click.option("--config", "-c", type=click.File("r"), required=True)
+@click.option("--interval", "-i", type=int, default=60)
+@click.option("--http_timeout", type=int, default=50)
+@click.option("--postgres_dsn", type=str, required=True)
+@click.option("--postgres_password", type=str, required=True)
+@click.option("--max_in_flight", type=click.IntRange(min=1), default=1000,
+              help="Maximum number of concurrent scrapes.")
+@click.option("--queue_factor", type=click.IntRange(min=1), default=2,
+              help="Queue capacity as multiple of the number of scrape targets.")
+@click.option("--queue_policy", type=click.Choice(resultqueue.POLICIES), default=resultqueue.BLOCK,
+              help="What to do with a new result when the queue is full.")
+@click.option("--sinks", type=click.IntRange(min=1), default=2,
+              help="Number of concurrent DB writers.")
+@click.option("--batch_size", type=click.IntRange(min=1), default=1000,
+              help="Maximum number of results per DB transaction.")
+@click.option("--linger", type=float, default=0.5,
+              help="Seconds to wait for a batch to fill up.")
+@change_options
+@schema_options
+@metrics_option
+@http_options
+@pass_info
+def run(_: Info,
+        config: TextIO,
+        interval: int,
+        http_timeout: int,
+        postgres_dsn: str,
+        postgres_password: str,
+        queue_factor: int,
+        queue_policy: str,
+        sinks: int,
+        batch_size: int,
+        linger: float,
+        max_in_flight: int,
+        changes_only: bool,
+        heartbeat: int,
+        schema: str,
+        retention_days: int,
+        compress_days: int,
+        metrics_port: int,
+        **http) -> None:
+    """Scrape and store in one process, without Kafka."""
+    standalone.start(config,
+                     interval,
+                     http_timeout,
+                     postgres_dsn,
+                     postgres_password,
+                     queue_factor,
+                     queue_policy,
+                     sinks,
+                     batch_size,
+                     linger,
+                     max_in_flight,
+                     http,
+                     changes_only,
+                     heartbeat,
+                     db_schema.get(schema, retention_days, compress_days),
+                     metrics_port)
 
 
 @cli.command()
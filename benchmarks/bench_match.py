@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cost of the body matching per scrape cycle.
+
+Every case searches the pattern of each of `TARGETS` targets in a body of
+`BODY_BYTES`, with the match at the end, and reports the microseconds per
+target and the milliseconds per cycle. ``regex`` is a plain compiled
+regular expression, as before the `ae.bb.data.Matcher`; the other cases
+use the matcher. ``config`` is the time to build the server configs, where
+the shared compiled patterns pay off.
+"""
+
+import re
+import time
+
+from ae.bb.data import ANY, Matcher, ServerConfig
+
+from common import show
+
+TARGETS = 20000
+BODY_BYTES = 16384
+ROUNDS = 3
+
+BODY = 'x' * (BODY_BYTES - 40) + '<p>status: ok, db: up</p>'
+
+CASES = (
+    ('literal', ['status: ok']),
+    ('regex_pattern', [r'status: (ok|degraded)']),
+    ('all_with_negation', ['status: ok', 'db: up', ('error', True)]),
+    ('any_of_three', [r'state=\d+', 'healthy', 'status: ok']),
+)
+
+
+def _best(fn, *args) -> float:
+    best = None
+    for _ in range(ROUNDS):
+        t0 = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _cycle(search, n):
+    for _ in range(n):
+        search(BODY)
+
+
+def _configs(n, pattern):
+    return [ServerConfig('http://t{0}.example.com/'.format(i), pattern=pattern) for i in range(n)]
+
+
+def run(quick: bool = False) -> dict:
+    """Return the matching cost per target and per cycle of each case."""
+    n = TARGETS // 10 if quick else TARGETS
+    results = {}
+
+    def record(name, elapsed):
+        results[name] = {'per_target_us': round(elapsed / n * 1e6, 3),
+                         'per_cycle_ms': round(elapsed * 1e3, 2)}
+
+    record('regex', _best(_cycle, re.compile('status: ok').search, n))
+    for name, patterns in CASES:
+        mode = ANY if name.startswith('any') else 'all'
+        record(name, _best(_cycle, Matcher(patterns, mode).match, n))
+    record('config', _best(_configs, n, r'status: (ok|degraded)'))
+    return results
+
+
+def main():
+    show('match', run())
+
+
+if __name__ == '__main__':
+    main()
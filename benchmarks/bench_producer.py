@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Throughput of the Kafka `Producer` against an in-memory broker.
+
+The fake broker acknowledges every message after `ACK_DELAY` seconds, like
+a broker on the local network would, and counts the bytes it received. The
+cases vary the number of producer tasks, the pipelining and the wire format.
+"""
+
+import asyncio
+import time
+
+from ae.bb.data import BATCH, BINARY, JSON, SERIES, RemoteServerResult
+from ae.bb.msgbus import Producer
+
+from common import show
+
+RESULTS = 20000
+TARGETS = 1000
+ACK_DELAY = 0.001
+
+CASES = (
+    ('json_p1', dict(pcount=1, wire_format=JSON)),
+    ('json_p8', dict(pcount=8, wire_format=JSON)),
+    ('json_p1_inflight64', dict(pcount=1, in_flight=64, wire_format=JSON)),
+    ('binary_p1_inflight64', dict(pcount=1, in_flight=64, wire_format=BINARY)),
+    ('batch_p1', dict(pcount=1, wire_format=BATCH, linger_ms=5)),
+    ('series_p1', dict(pcount=1, wire_format=SERIES)),
+)
+
+
+class FakeBroker:
+    """The part of `AIOKafkaProducer` the producer uses."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def _ack(self, payload: bytes, fut: asyncio.Future) -> None:
+        self.messages += 1
+        self.bytes += len(payload)
+        fut.set_result(None)
+
+    async def send(self, _topic, payload):
+        fut = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().call_later(ACK_DELAY, self._ack, payload, fut)
+        return fut
+
+    async def send_and_wait(self, topic, payload):
+        return await (await self.send(topic, payload))
+
+    async def stop(self):
+        pass
+
+
+async def _case(results: list, **kwargs) -> dict:
+    q = asyncio.Queue()
+    p = Producer('fake:9092', topic='bench', q=q, **kwargs)
+    broker = FakeBroker()
+    p._kafka = broker
+    p._window = asyncio.Semaphore(p._in_flight)
+    tasks = await p.kafka_producers()
+    t0 = time.perf_counter()
+    for r in results:
+        q.put_nowait(r)
+    await q.join()
+    await p.flush()
+    elapsed = time.perf_counter() - t0
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {'results_per_s': round(len(results) / elapsed, 1),
+            'messages': broker.messages,
+            'bytes_per_result': round(broker.bytes / len(results), 1)}
+
+
+def run(quick: bool = False) -> dict:
+    """Return results per second and message counts of each case."""
+    n = RESULTS // 10 if quick else RESULTS
+    now = time.time()
+    results = [RemoteServerResult(url='https://t{0}.example.com/health'.format(i % TARGETS),
+                                  nw_status='', http_status=200, match=True,
+                                  tstamp=now + (i // TARGETS) * 60, target_id=i % TARGETS)
+               for i in range(n)]
+    return {name: asyncio.run(_case(results, **kwargs)) for name, kwargs in CASES}
+
+
+def main():
+    show('producer', run())
+
+
+if __name__ == '__main__':
+    main()
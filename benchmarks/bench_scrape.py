@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Throughput and latency of `Scraper._fetch` against a local server.
+
+Every target gets its own host name, all of them resolved to one local
+aiohttp server, so the client keeps a connection pool per virtual host as
+it would in production. Each target is fetched twice: the cold round opens
+the connections, the warm round reuses them.
+"""
+
+import asyncio
+import socket
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from aiohttp.test_utils import TestServer
+
+from ae.bb.data import Config, ServerConfig
+from ae.bb.scraper import Scraper
+
+from common import percentiles, show
+
+HOSTS = 2000
+BODY = ('x' * 1000 + '\n') * 8 + 'status: ok\n'
+
+
+class _Resolver(AbstractResolver):
+    """Resolve every host name to the local server."""
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{'hostname': host, 'host': '127.0.0.1', 'port': port, 'family': socket.AF_INET,
+                 'proto': 0, 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+
+async def _handler(_request):
+    return web.Response(text=BODY)
+
+
+async def _bench(hosts: int) -> dict:
+    app = web.Application()
+    app.router.add_get('/health', _handler)
+    server = TestServer(app, host='127.0.0.1')
+    await server.start_server()
+    c = Config()
+    c.servers = [ServerConfig('http://t{0}.bench.invalid:{1}/health'.format(i, server.port),
+                              pattern='status: ok') for i in range(hosts)]
+    s = Scraper(c, asyncio.Queue())
+    slots = asyncio.Semaphore(c.max_in_flight)
+    connector = aiohttp.TCPConnector(limit=c.http_limit, resolver=_Resolver(),
+                                     keepalive_timeout=60)
+    results = {}
+    try:
+        async with aiohttp.ClientSession(connector=connector) as client:
+            for rnd in ('cold', 'warm'):
+                latencies = []
+
+                async def fetch(server):
+                    async with slots:
+                        t0 = time.perf_counter()
+                        await s._fetch(client, server)
+                        latencies.append(time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                await asyncio.gather(*(fetch(server) for server in c.servers))
+                elapsed = time.perf_counter() - t0
+                results[rnd] = dict(fetches_per_s=round(hosts / elapsed, 1),
+                                    **percentiles(latencies))
+    finally:
+        await server.close()
+    return results
+
+
+def run(quick: bool = False) -> dict:
+    """Return fetches per second and latency percentiles of a cold and a warm round."""
+    return asyncio.run(_bench(HOSTS // 10 if quick else HOSTS))
+
+
+def main():
+    show('scrape', run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Throughput of `DB.store` and `DB.store_batch`.
+
+With ``AE_BENCH_PG_DSN`` (and ``AE_BENCH_PG_PASSWORD``) set the benchmark
+writes to that database, which must have the tables of the schema, see
+``utils/create_table.sql``. Otherwise it runs against a fake connection that
+takes the statements without executing them, which measures the cost on
+the store side only: building the rows and the COPY input, the thread pool
+and the transaction handling.
+"""
+
+import asyncio
+import os
+import time
+from unittest import mock
+
+from ae.bb.data import RemoteServerResult, ResultBatch
+from ae.bb.storage import DB
+
+from common import percentiles, show
+
+SINGLE = 2000
+BATCHES = 50
+BATCH_SIZE = 1000
+
+
+class _Cursor:
+
+    rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def execute(self, *_):
+        pass
+
+    def copy_expert(self, _stmt, buf):
+        self.rowcount = buf.getvalue().count('\n')
+
+    def fetchall(self):
+        return []
+
+
+class _FakeConnection:
+    """The part of a psycopg2 connection `DB` uses."""
+
+    staged = False
+
+    def __init__(self, *_, **__):
+        self.prepared = set()
+        self.closed = 0
+        self.info = mock.Mock(transaction_status=0)
+
+    def cursor(self):
+        return _Cursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        return 0
+
+
+async def _bench(n_single: int, n_batches: int) -> dict:
+    db = DB(password=os.environ.get('AE_BENCH_PG_PASSWORD', ''),
+            dsn=os.environ.get('AE_BENCH_PG_DSN', ''))
+    await db.connect()
+    base = time.time() - 3600
+    results = {}
+    try:
+        latencies = []
+        t0 = time.perf_counter()
+        for i in range(n_single):
+            r = RemoteServerResult(url='https://bench.example.com/health', nw_status='',
+                                   http_status=200, match=True, tstamp=base + i * 0.001)
+            t1 = time.perf_counter()
+            await db.store(r)
+            latencies.append(time.perf_counter() - t1)
+        results['store'] = dict(rows_per_s=round(n_single / (time.perf_counter() - t0), 1),
+                                **percentiles(latencies))
+        targets = {i: 'https://t{0}.bench.example.com/health'.format(i) for i in range(BATCH_SIZE)}
+        latencies = []
+        t0 = time.perf_counter()
+        for b in range(n_batches):
+            batch = ResultBatch.from_results([
+                RemoteServerResult(url=url, nw_status='', http_status=200, match=True,
+                                   tstamp=base + b, target_id=i)
+                for i, url in targets.items()])
+            t1 = time.perf_counter()
+            await db.store_batch(batch, targets)
+            latencies.append(time.perf_counter() - t1)
+        results['store_batch'] = dict(
+            rows_per_s=round(n_batches * BATCH_SIZE / (time.perf_counter() - t0), 1),
+            **percentiles(latencies))
+    finally:
+        await db.close()
+    return results
+
+
+def run(quick: bool = False) -> dict:
+    """Return rows per second and latency percentiles of single and batch inserts."""
+    scale = 10 if quick else 1
+    if os.environ.get('AE_BENCH_PG_DSN'):
+        return asyncio.run(_bench(SINGLE // scale, BATCHES // scale))
+    with mock.patch('psycopg2.connect', _FakeConnection):
+        return asyncio.run(_bench(SINGLE // scale, BATCHES // scale))
+
+
+def main():
+    show('store', run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""CPU time of the per result logging, per 10k results.
+
+``before`` runs the logging statements the fetch, send, decode and store
+paths had per result, with the arguments built up front; ``after`` runs the
+guarded trace points that replaced them, with tracing off. Both are
+measured with the loggers at WARNING, the production level, and at INFO.
+"""
+
+import datetime
+import logging
+import time
+
+from ae.bb import trace
+from ae.bb.data import RemoteServerResult
+
+from common import show
+
+RESULTS = 10000
+ROUNDS = 5
+
+L = logging.getLogger('bench_trace')
+T = trace.Tracer('bench_trace')
+
+
+def _before(r: RemoteServerResult, msg: bytes) -> None:
+    L.info('_fetch: fetching %s with timeout %d secs', r.url, 50)
+    L.debug('fetch: url = "%s", resp.status = "%s"', r.url, r.http_status)
+    L.debug('Body pattern match result: %s, pattern = %s', r.match, 'ok')
+    L.debug("_fetch: enqueueing to kafka: %s", r.json()[:128])
+    L.info('_send[%d]: dequeued %d results, first "%s"', 0, 1, r)
+    L.debug('msg.value = %s', msg)
+    L.info('inserting data %s', {'url': r.url, 'tstamp': datetime.datetime.fromtimestamp(r.tstamp),
+                                 'nw_status': r.nw_status, 'http_status': r.http_status,
+                                 'match': r.match})
+
+
+def _after(r: RemoteServerResult, msg: bytes) -> None:
+    if T.on():
+        T.log('_fetch: %s in %.3f secs, pattern %s, enqueueing %s', r.url, 0.1, 'ok', r.json()[:128])
+    if T.on():
+        T.log('_send[%d]: dequeued %d results, first "%s"', 0, 1, r)
+    if T.on():
+        T.log('_decode: msg.value = %s', msg)
+    if T.on():
+        T.log('store: inserting %s', r)
+
+
+def _cpu(fn, results, msgs) -> float:
+    best = None
+    for _ in range(ROUNDS):
+        t0 = time.process_time()
+        for r, msg in zip(results, msgs):
+            fn(r, msg)
+        elapsed = time.process_time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 10000 / len(results)
+
+
+def run(quick: bool = False) -> dict:
+    """Return the CPU milliseconds per 10k results before and after, at two log levels."""
+    n = RESULTS // 10 if quick else RESULTS
+    results = [RemoteServerResult(url='https://t{0}.example.com/health'.format(i), nw_status=None,
+                                  http_status=200, match=True, tstamp=time.time())
+               for i in range(n)]
+    msgs = [r.encode() for r in results]
+    # the records at INFO are built but not written anywhere
+    L.addHandler(logging.NullHandler())
+    L.propagate = False
+    out = {}
+    try:
+        for name, level in (('warning', logging.WARNING), ('info', logging.INFO)):
+            L.setLevel(level)
+            before = _cpu(_before, results, msgs)
+            after = _cpu(_after, results, msgs)
+            out[name] = {'before_ms': round(before * 1e3, 2),
+                         'after_ms': round(after * 1e3, 2)}
+    finally:
+        L.propagate = True
+    return out
+
+
+def main():
+    show('trace', run())
+
+
+if __name__ == '__main__':
+    main()
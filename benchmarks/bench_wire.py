@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare the wire formats of RemoteServerResult.
+
+Measures the message size and the encode and decode time per result. The
+batch format is measured with batches of `BATCH_SIZE` results, the series
+format with windows of `WINDOW` results of a target scraped every minute.
+"""
+
+import time
+import timeit
+
+from ae.bb import series
+from ae.bb.data import BATCH, BINARY, JSON, SERIES, RemoteServerResult, ResultBatch
+
+from common import show
+
+N = 100000
+BATCH_SIZE = 1000
+WINDOW = 10
+
+
+def run(quick: bool = False) -> dict:
+    """Return the size and the cost per result of each wire format."""
+    n = N // 10 if quick else N
+    url = 'https://www.example.com/some/health/check'
+    targets = {4711: url}
+    r = RemoteServerResult(url=url, nw_status='', http_status=200, match=True,
+                           tstamp=time.time(), target_id=4711)
+    results = {}
+
+    def record(fmt, size, enc, dec):
+        results[fmt] = {'bytes': round(size, 1),
+                        'encode_us': round(enc * 1e6, 3),
+                        'decode_us': round(dec * 1e6, 3)}
+
+    for fmt in (JSON, BINARY):
+        msg = r.encode(fmt)
+        record(fmt, len(msg),
+               timeit.timeit(lambda: r.encode(fmt), number=n) / n,
+               timeit.timeit(lambda: RemoteServerResult.decode(msg, targets), number=n) / n)
+    batch = [r] * BATCH_SIZE
+    msg = ResultBatch.from_results(batch).encode()
+    rounds = max(1, n // BATCH_SIZE)
+    record(BATCH, len(msg) / BATCH_SIZE,
+           timeit.timeit(lambda: ResultBatch.from_results(batch).encode(), number=rounds) / (rounds * BATCH_SIZE),
+           timeit.timeit(lambda: list(ResultBatch.decode(msg).rows(targets)), number=rounds) / (rounds * BATCH_SIZE))
+    window = [RemoteServerResult(url=url, nw_status='', http_status=200, match=True,
+                                 tstamp=r.tstamp + i * 60 + (i % 4) * 0.021, target_id=4711)
+              for i in range(WINDOW)]
+    msg = series.encode(window)
+    rounds = n // WINDOW
+    record(SERIES, len(msg) / WINDOW,
+           timeit.timeit(lambda: series.encode(window), number=rounds) / (rounds * WINDOW),
+           timeit.timeit(lambda: list(series.decode(msg).rows(targets)), number=rounds) / (rounds * WINDOW))
+    return results
+
+
+def main():
+    show('wire', run())
+
+
+if __name__ == '__main__':
+    main()
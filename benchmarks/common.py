@@ -0,0 +1,25 @@
+"""Helpers shared by the benchmarks."""
+
+import math
+
+
+def percentiles(samples: list, scale: float = 1e3, unit: str = 'ms') -> dict:
+    """Return p50, p90, p99 and max of `samples` in seconds, scaled to `unit`."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, math.ceil(p * len(ordered)) - 1)]
+
+    return {'p50_' + unit: round(pick(0.50) * scale, 3),
+            'p90_' + unit: round(pick(0.90) * scale, 3),
+            'p99_' + unit: round(pick(0.99) * scale, 3),
+            'max_' + unit: round(ordered[-1] * scale, 3)}
+
+
+def show(name: str, results: dict) -> None:
+    """Print the `results` of benchmark `name`, one line per case."""
+    for case, metrics in results.items():
+        print('{0:9} {1:24} {2}'.format(name, case, '  '.join(
+            '{0}={1}'.format(k, v) for k, v in metrics.items())))
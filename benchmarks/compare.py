@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare two result files of ``run.py``.
+
+Metrics ending in ``_per_s`` are better when higher, all others when
+lower. Exits with 1 if a metric got worse by more than the threshold.
+"""
+
+import argparse
+import json
+import sys
+
+
+def _load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(base: dict, new: dict, threshold: float) -> list:
+    """Print the changes from `base` to `new`, return the regressions."""
+    regressions = []
+    for bench, cases in new['results'].items():
+        for case, metrics in cases.items():
+            old = base['results'].get(bench, {}).get(case, {})
+            for metric, value in metrics.items():
+                before = old.get(metric)
+                if not before or not isinstance(value, (int, float)):
+                    continue
+                change = (value - before) / before
+                worse = -change if metric.endswith('_per_s') else change
+                flag = ''
+                if worse > threshold:
+                    flag = '  REGRESSION'
+                    regressions.append((bench, case, metric))
+                print('{0:9} {1:24} {2:18} {3:>12} {4:>12} {5:+7.1%}{6}'.format(
+                    bench, case, metric, before, value, change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base', help='results of the baseline commit')
+    parser.add_argument('new', help='results of the commit to check')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change counted as regression, default 0.1')
+    args = parser.parse_args(argv)
+    base, new = _load(args.base), _load(args.new)
+    print('{0} -> {1}'.format(base['commit'], new['commit']))
+    if base.get('quick') != new.get('quick'):
+        print('warning: comparing a quick run with a full one')
+    if compare(base, new, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
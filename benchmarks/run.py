@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Run the benchmarks and write their results as JSON.
+
+The output file records the commit and the Python version next to the
+results, so runs of different commits can be compared with ``compare.py``.
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+
+BENCHMARKS = ('wire', 'scrape', 'producer', 'store', 'trace', 'match')
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='run a tenth of the work, for smoke tests')
+    parser.add_argument('--only', action='append', choices=BENCHMARKS,
+                        help='run only this benchmark, may be repeated')
+    parser.add_argument('--output', help='JSON file, default results/<commit>.json')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, HERE)
+    sys.path.insert(1, os.path.dirname(HERE))
+    from common import show
+
+    commit = _commit()
+    report = {'commit': commit,
+              'python': platform.python_version(),
+              'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'quick': args.quick,
+              'results': {}}
+    for name in args.only or BENCHMARKS:
+        results = importlib.import_module('bench_' + name).run(quick=args.quick)
+        show(name, results)
+        report['results'][name] = results
+    output = args.output or os.path.join(HERE, 'results', commit + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to', output)
+
+
+if __name__ == '__main__':
+    main()
@@ -117,7 +117,7 @@ def test_store_missing_topic():
 def test_store_valid_options(mocker):
     """Test store with valid options."""
     runner = CliRunner()
-    mocker.patch('psycopg2.connect', return_value=None)
+    mocker.patch('psycopg2.connect', return_value=mocker.MagicMock())
     x = None
     result = runner.invoke(cli.cli, ["store",
                                      "--postgres_dsn", "host='s1' user='no_existing' dbname='aiven'",
@@ -126,3 +126,28 @@ def test_store_valid_options(mocker):
                                      ])
     assert (isinstance(result.exception, SystemExit))
     assert (result.exit_code == 1), "Error exit"
+
+
+def test_run_missing_dsn():
+    """Test run without postgres options."""
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("xx", "w").close()
+        result = runner.invoke(cli.cli, ["run", "--config", "xx"])
+        assert (
+            "--postgres_dsn" in result.output.strip()
+        ), "'run' without dsn."
+
+
+def test_scraper_http_options(mocker):
+    """The HTTP connection options are passed on by Config property name."""
+    start = mocker.patch('ae.bb.scraper.start')
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("xx", "w").close()
+        result = runner.invoke(cli.cli, ["scrape", "--config", "xx", "--topic", "t",
+                                         "--http_limit", "5000", "--dns_ttl", "600", "--aiodns"])
+    assert result.exit_code == 0, result.output
+    http = next(a for a in start.call_args[0] if isinstance(a, dict))
+    assert http['http_limit'] == 5000 and http['dns_ttl'] == 600 and http['aiodns'], 'http options'
+    assert http['keepalive_timeout'] is None, 'default keep-alive'
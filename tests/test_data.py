@@ -114,3 +114,209 @@ def test_data_srv_to_json():
     expected = json.dumps(d).encode('utf-8')
     j = r.json()
     assert (j == expected), 'to json serialization'
+
+
+def test_data_srv_from_json():
+    now = time.time()
+    r = ae.bb.data.RemoteServerResult(
+        url='http://www.example.com',
+        nw_status='',
+        http_status=200,
+        match=False,
+        tstamp=now)
+    o = ae.bb.data.RemoteServerResult.from_json(r.json())
+    assert (o.url == r.url), 'url'
+    assert (o.http_status == 200), 'http_status'
+    assert (o.match is False), 'match'
+    assert (o.tstamp == now), 'tstamp'
+
+
+def test_data_srv_binary_roundtrip():
+    now = time.time()
+    r = ae.bb.data.RemoteServerResult(
+        url='http://www.example.com',
+        nw_status='Timeout',
+        http_status=None,
+        match=True,
+        tstamp=now,
+        target_id=42)
+    b = r.encode(ae.bb.data.BINARY)
+    assert len(b) < len(r.json()) / 3, 'binary is compact'
+    o = ae.bb.data.RemoteServerResult.decode(b, {42: 'http://www.example.com'})
+    assert (o.url, o.nw_status, o.http_status, o.match, o.tstamp) == \
+        ('http://www.example.com', 'Timeout', None, True, now), 'binary roundtrip'
+    j = ae.bb.data.RemoteServerResult.decode(r.json())
+    assert j.url == 'http://www.example.com', 'JSON detected'
+    with pytest.raises(ValueError):
+        ae.bb.data.RemoteServerResult.decode(b, {})
+    with pytest.raises(ValueError):
+        ae.bb.data.RemoteServerResult.decode(b[:5], {42: 'http://www.example.com'})
+
+
+def test_data_target_ids(fs):
+    fs.create_file("xx", contents="""
+[
+  {"url": "http://www.example.com"},
+  {"url": "https://www2.example.com", "id": 7}
+]
+    """)
+    sc = ae.bb.data.Config(open("xx", "r"))
+    assert sc.servers[1].target_id == 7, 'configured id'
+    assert sc.targets[sc.servers[0].target_id] == 'http://www.example.com', 'derived id'
+
+
+def test_data_duplicate_target_ids(fs):
+    fs.create_file("xx", contents="""
+[
+  {"url": "http://www.example.com", "id": 7},
+  {"url": "https://www2.example.com", "id": 7}
+]
+    """)
+    with pytest.raises(ae.bb.data.ServerConfigError):
+        ae.bb.data.Config(open("xx", "r"))
+
+
+def test_data_method(fs):
+    fs.create_file("xx", contents="""
+[
+  {"url": "http://www.example.com", "method": "head"},
+  {"url": "https://www2.example.com", "pattern": "ok", "conditional": false}
+]
+    """)
+    sc = ae.bb.data.Config(open("xx", "r"))
+    assert sc.servers[0].method == 'HEAD' and sc.servers[0].conditional
+    assert sc.servers[1].method == 'GET' and not sc.servers[1].conditional
+    with pytest.raises(ae.bb.data.ServerConfigError):
+        ae.bb.data.ServerConfig('http://www.example.com', pattern='ok', method='HEAD')
+    with pytest.raises(ae.bb.data.ServerConfigError):
+        ae.bb.data.ServerConfig('http://www.example.com', method='POST')
+
+
+def test_data_srv_result_memory():
+    """A queued result fits the memory budget of the design document."""
+    import tracemalloc
+
+    n = 20000
+    urls = ['http://h{0}.example.com/'.format(i) for i in range(100)]
+    errors = [ValueError('Connection refused') for _ in range(n)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [ae.bb.data.RemoteServerResult(url=urls[i % 100],
+                                             nw_status=errors[i] if i % 2 else '',
+                                             http_status=404,
+                                             match=False,
+                                             tstamp=time.time())
+               for i in range(n)]
+    per_result = (tracemalloc.get_traced_memory()[0] - before) / n
+    tracemalloc.stop()
+    assert not hasattr(results[0], '__dict__'), 'slotted'
+    assert results[1].nw_status is results[3].nw_status, 'network status interned'
+    assert per_result < 128, 'bytes per result: {0}'.format(per_result)
+
+
+def _results(n, target_ids=5):
+    return [ae.bb.data.RemoteServerResult(url='http://h{0}'.format(i % target_ids),
+                                          nw_status='Timeout' if i % 3 == 0 else '',
+                                          http_status=None if i % 3 == 0 else 200,
+                                          match=bool(i % 2),
+                                          tstamp=1000.0 + i,
+                                          target_id=i % target_ids)
+            for i in range(n)]
+
+
+def test_data_result_batch_roundtrip():
+    results = _results(10)
+    targets = {i: 'http://h{0}'.format(i) for i in range(5)}
+    batch = ae.bb.data.ResultBatch.from_results(results)
+    b = batch.encode()
+    assert ae.bb.data.ResultBatch.is_batch(b), 'batch detected'
+    assert len(b) < sum(len(r.binary()) for r in results), 'smaller than single binary messages'
+    decoded = ae.bb.data.ResultBatch.decode(b)
+    assert list(decoded.rows(targets)) == \
+        [(r.url, r.tstamp, r.nw_status, r.http_status, r.match, None) for r in results], 'roundtrip'
+    with pytest.raises(ValueError):
+        ae.bb.data.ResultBatch.decode(b[:-1])
+    with pytest.raises(ValueError):
+        ae.bb.data.RemoteServerResult.decode(b, targets)
+
+
+def test_data_result_batch_extend():
+    a = ae.bb.data.ResultBatch.from_results(_results(3))
+    b = ae.bb.data.ResultBatch.from_results([ae.bb.data.RemoteServerResult(
+        url='http://h0', nw_status='Refused', tstamp=1, target_id=0)])
+    a.extend(b)
+    rows = list(a.rows({0: 'http://h0', 1: 'http://h1', 2: 'http://h2'}))
+    assert len(rows) == 4 and rows[-1][2] == 'Refused', 'status table merged'
+    assert len(list(a.rows({0: 'http://h0'}))) == 2, 'unknown target ids skipped'
+    assert a.unknown({0: 'http://h0'}) == 2
+
+
+def test_data_unchanged_since_roundtrip():
+    """The unchanged since time survives all single and batch formats."""
+    targets = {1: 'http://h1'}
+    r = ae.bb.data.RemoteServerResult(url='http://h1', http_status=200, tstamp=180.5,
+                                      target_id=1).unchanged(60.25)
+    assert r.unchanged_since == 60.25 and r.same_state(r.unchanged(None))
+    for fmt in (ae.bb.data.JSON, ae.bb.data.BINARY):
+        assert ae.bb.data.RemoteServerResult.decode(r.encode(fmt), targets).unchanged_since == 60.25
+    plain = r.unchanged(None)
+    assert ae.bb.data.RemoteServerResult.from_json(plain.json()).unchanged_since is None
+    assert b'unchanged' not in plain.json(), 'plain results look as before'
+    batch = ae.bb.data.ResultBatch.decode(ae.bb.data.ResultBatch.from_results([r, plain]).encode())
+    assert [row[5] for row in batch.rows(targets)] == [60.25, None]
+
+
+def test_matcher_modes():
+    """Patterns combine with all or any, negated patterns must not be found."""
+    from ae.bb.data import ANY, Matcher
+
+    body = 'status: ok, db: up'
+    assert Matcher(['status: ok', 'db: (up|degraded)']).match(body)
+    assert not Matcher(['status: ok', ('db: up', True)]).match(body)
+    assert Matcher([('error', True), 'ok']).match(body)
+    assert Matcher(['nope', 'db: up'], ANY).match(body)
+    assert not Matcher(['nope', ('db', True)], ANY).match(body)
+    assert Matcher([('nope', True)], ANY).match(body)
+    assert str(Matcher(['a', ('b', True)])) == 'a all not b'
+
+
+def test_matcher_literals_and_sharing():
+    """Plain strings are searched as substrings, regexes are compiled once."""
+    from ae.bb.data import Matcher, ServerConfig, compile_pattern
+
+    m = Matcher(['status: ok', r'v\d+'])
+    assert m._patterns[0][1] is None and m._patterns[1][1] is not None
+    a = ServerConfig('http://a.example.com', pattern=r'v\d+')
+    b = ServerConfig('http://b.example.com', pattern=r'v\d+')
+    assert a.pattern is b.pattern is compile_pattern(r'v\d+')
+    assert a.matcher._patterns[0][1] is m._patterns[1][1]
+
+
+def test_matcher_feed_decides_early():
+    """Feeding pieces returns the result as soon as it is certain."""
+    from ae.bb.data import ANY, Matcher
+
+    m = Matcher(['a', 'b'])
+    found = m.start()
+    assert m.feed('xxa', found) is None and m.feed('xxb', found) is True
+    m = Matcher(['a', ('err', True)])
+    found = m.start()
+    assert m.feed('a', found) is None, 'a negated pattern needs the whole body'
+    assert m.feed('err', found) is False
+    m = Matcher(['a', 'b'], ANY)
+    assert m.feed('b', m.start()) is True
+
+
+def test_data_multi_pattern(fs):
+    fs.create_file("xx", contents="""
+[
+  {"url": "http://www.example.com", "match": "any",
+   "pattern": ["ok", {"pattern": "err(or)?", "negate": true}]}
+]
+    """)
+    sc = ae.bb.data.Config(open("xx", "r"))
+    assert len(sc.servers[0].matcher) == 2 and sc.servers[0].pattern is None
+    assert sc.servers[0].matcher.match('fine')
+    for bad in ({'pattern': ['(']}, {'pattern': 'ok', 'match': 'some'}, {'pattern': [{'negate': True}]}):
+        with pytest.raises(ae.bb.data.ServerConfigError):
+            ae.bb.data.ServerConfig('http://www.example.com', **bad)
@@ -0,0 +1,48 @@
+"""Tests for the per target latency history and circuit breakers."""
+
+import aiohttp
+
+from ae.bb.health import Health
+
+
+def test_adaptive_timeout():
+    """Timeouts follow the latency after the warmup, and double after a timeout."""
+    h = Health(50, min_timeout=0.1, warmup=3)
+    url = 'http://www.example.com'
+    assert h.timeout(url) == 50, 'no history yet'
+    for _ in range(3):
+        h.record(url, 60, 0.2, True)
+    t = h.timeout(url)
+    assert isinstance(t, aiohttp.ClientTimeout) and t.total == 50
+    assert 0.2 < t.sock_connect < 1 and t.sock_read == t.sock_connect
+    h.record(url, 60, t.sock_read, False, timed_out=True)
+    assert h.timeout(url).sock_read == 2 * t.sock_read, 'doubled after a timeout'
+    h.record(url, 60, 0.2, True)
+    assert h.timeout(url).sock_read < t.sock_read, 'back after a success'
+    assert Health(50, adaptive=False).timeout(url) == 50
+
+
+def test_timeout_limits():
+    """Adaptive timeouts stay between the minimum and the HTTP timeout."""
+    h = Health(5, min_timeout=1, warmup=1)
+    h.record('fast', 60, 0.001, True)
+    h.record('slow', 60, 4.0, True)
+    assert h.timeout('fast').sock_read == 1
+    assert h.timeout('slow').sock_read == 5
+
+
+def test_circuit_breaker():
+    """A failing target is paused for growing intervals, a success closes the breaker."""
+    h = Health(50, failures=2, max_backoff=200)
+    url = 'http://www.example.com'
+    h.record(url, 60, 1, False, now=0)
+    assert h.allow(url, now=1), 'one failure is not enough'
+    h.record(url, 60, 1, False, now=0)
+    assert not h.allow(url, now=59) and h.allow(url, now=60), 'paused one interval'
+    assert h.open(now=59) == 1 and h.short_circuited == 1
+    h.record(url, 60, 1, False, now=60)
+    assert not h.allow(url, now=179) and h.allow(url, now=180), 'then two'
+    h.record(url, 60, 1, False, now=180)
+    assert not h.allow(url, now=379) and h.allow(url, now=380), 'at most max_backoff'
+    h.record(url, 60, 0.1, True, now=380)
+    assert h.allow(url, now=381) and h.open(now=381) == 0
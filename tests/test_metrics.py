@@ -0,0 +1,66 @@
+"""Tests for the metrics and their endpoint."""
+
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+
+from ae.bb import metrics
+
+
+def test_counter_and_gauge():
+    """Counters add up per label, gauges can read a function."""
+    r = metrics.Registry()
+    c = metrics.Counter('c_total', 'A counter', ('code',), registry=r)
+    g = metrics.Gauge('g', 'A gauge', registry=r)
+    c.labels('a"b').inc()
+    c.labels('a"b').inc(2)
+    g.labels().set_function(lambda: 7)
+    text = r.render()
+    assert '# TYPE c_total counter' in text
+    assert 'c_total{code="a\\"b"} 3\n' in text, 'label value escaped'
+    assert 'g 7\n' in text
+    with pytest.raises(ValueError):
+        c.labels()
+    with pytest.raises(ValueError):
+        metrics.Counter('c_total', 'Again', registry=r)
+
+
+def test_histogram_and_summary():
+    """Histogram buckets are cumulative and inclusive, summaries have sum and count."""
+    r = metrics.Registry()
+    h = metrics.Histogram('h_seconds', 'A histogram', buckets=(0.1, 1), registry=r)
+    s = metrics.Summary('s_seconds', 'A summary', ('target',), registry=r)
+    for v in (0.05, 0.1, 0.5, 2):
+        h.labels().observe(v)
+    s.labels('x').observe(1.5)
+    lines = r.render().splitlines()
+    assert lines[2:7] == ['h_seconds_bucket{le="0.1"} 2',
+                          'h_seconds_bucket{le="1"} 3',
+                          'h_seconds_bucket{le="+Inf"} 4',
+                          'h_seconds_sum 2.65',
+                          'h_seconds_count 4']
+    assert 's_seconds_sum{target="x"} 1.5' in lines and 's_seconds_count{target="x"} 1' in lines
+
+
+def test_serve():
+    """The endpoint serves the registry in the text format."""
+    r = metrics.Registry()
+    metrics.Counter('served_total', 'Served', registry=r).labels().inc()
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    async def run():
+        runner = await metrics.serve(port, r, host='127.0.0.1')
+        try:
+            async with aiohttp.ClientSession() as client:
+                async with client.get('http://127.0.0.1:{0}/metrics'.format(port)) as resp:
+                    return resp.headers['Content-Type'], await resp.text()
+        finally:
+            await runner.cleanup()
+
+    content_type, text = asyncio.run(run())
+    assert content_type.startswith('text/plain; version=0.0.4')
+    assert 'served_total 1\n' in text
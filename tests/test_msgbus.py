@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_msgbus
+.. moduleauthor:: Michael Lausch <mick.lausch@gmail.com>
+
+Tests for the Kafka producer and consumer, with the broker faked.
+"""
+
+import asyncio
+import collections
+
+import ae.bb.msgbus as msgbus
+from ae.bb.data import RemoteServerResult
+
+
+Message = collections.namedtuple('Message', 'offset value')
+
+
+def _msg(offset, tstamp=0):
+    r = RemoteServerResult(url='http://www.example.com', http_status=200, tstamp=tstamp)
+    return Message(offset, r.json())
+
+
+class FakeKafkaConsumer:
+    """Hands out prepared getmany() results, then blocks."""
+
+    def __init__(self, batches):
+        self._batches = list(batches)
+        self._paused = set()
+        self.commits = []
+        self.highwaters = {}
+
+    async def getmany(self, timeout_ms):
+        if self._batches:
+            return self._batches.pop(0)
+        await asyncio.sleep(timeout_ms / 1000)
+        return {}
+
+    async def commit(self, offsets):
+        self.commits.append(offsets)
+
+    def pause(self, tp):
+        self._paused.add(tp)
+
+    def resume(self, tp):
+        self._paused.discard(tp)
+
+    def paused(self):
+        return set(self._paused)
+
+    def highwater(self, tp):
+        return self.highwaters.get(tp)
+
+
+class FakeDB:
+    """Records stored batches, partition 'slow' takes longer."""
+
+    def __init__(self):
+        self.stored = []
+
+    async def connect(self):
+        pass
+
+    async def store_many(self, results):
+        results = list(results)
+        await asyncio.sleep(0.05 if results[0].tstamp < 0 else 0)
+        self.stored.append(results)
+        return len(results)
+
+
+def _run_consumer(batches, window=4, duration=0.3):
+    db = FakeDB()
+    c = msgbus.Consumer('localhost:9092', 'topic', db, window)
+    fake = FakeKafkaConsumer(batches)
+
+    async def init():
+        c._consumer = fake
+
+    c._init_me = init
+
+    async def run():
+        try:
+            await asyncio.wait_for(c.run(), duration)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(run())
+    return db, fake
+
+
+def test_consumer_commits_partitions_in_order():
+    """Offsets are committed per partition in fetch order."""
+    batches = [{'p0': [_msg(0), _msg(1)], 'p1': [_msg(10)]},
+               {'p0': [_msg(2)], 'p1': [_msg(11), _msg(12)]}]
+    db, fake = _run_consumer(batches)
+    p0 = [o['p0'] for o in fake.commits if 'p0' in o]
+    p1 = [o['p1'] for o in fake.commits if 'p1' in o]
+    assert p0 == [2, 3], 'partition 0 offsets in order'
+    assert p1 == [11, 13], 'partition 1 offsets in order'
+    assert sum(len(b) for b in db.stored) == 6, 'all messages stored'
+
+
+def test_consumer_slow_partition_does_not_block_others():
+    """A slow partition does not hold back the commits of a fast one."""
+    batches = [{'slow': [_msg(0, tstamp=-1)], 'fast': [_msg(0)]},
+               {'fast': [_msg(1)]}]
+    _, fake = _run_consumer(batches)
+    order = [next(iter(o)) for o in fake.commits]
+    assert order.index('slow') > order.index('fast'), 'fast partition committed first'
+    assert order.count('fast') == 2, 'fast partition kept going'
+
+
+def test_consumer_pauses_full_partition():
+    """A partition with a full window is paused until its worker catches up."""
+    batches = [{'slow': [_msg(i, tstamp=-1)]} for i in range(3)]
+    _, fake = _run_consumer(batches, window=1)
+    assert [o['slow'] for o in fake.commits] == [1, 2, 3], 'all batches committed'
+    assert not fake.paused(), 'resumed after catching up'
+
+
+class FakeKafkaProducer:
+    """Returns delivery futures, the first `fail` deliveries fail."""
+
+    def __init__(self, fail=0):
+        self._fail = fail
+        self.sent = []
+        self.pending = []
+
+    async def send(self, topic, value):
+        fut = asyncio.get_running_loop().create_future()
+        self.sent.append(value)
+        self.pending.append(fut)
+        return fut
+
+    def deliver(self):
+        for fut in self.pending:
+            if self._fail:
+                self._fail -= 1
+                fut.set_exception(RuntimeError('broker gone'))
+            else:
+                fut.set_result(None)
+        self.pending = []
+
+
+def _run_producer(fake, count, rounds=5):
+    async def run():
+        q = asyncio.Queue()
+        p = msgbus.Producer('localhost:9092', 1, 'topic', q, in_flight=count)
+        p._window = asyncio.Semaphore(count)
+        p._kafka = fake
+        p._retry_backoff = 0
+        task = asyncio.create_task(p._send(0))
+        for i in range(count):
+            q.put_nowait(RemoteServerResult(url='http://www.example.com', tstamp=i))
+        unfinished = []
+        for _ in range(rounds):
+            await asyncio.sleep(0.01)
+            unfinished.append(q._unfinished_tasks)
+            fake.deliver()
+        await asyncio.sleep(0.01)
+        task.cancel()
+        return p, unfinished, q._unfinished_tasks
+
+    return asyncio.run(run())
+
+
+def test_producer_pipelines_sends():
+    """All messages are in flight before the first delivery report."""
+    fake = FakeKafkaProducer()
+    p, unfinished, left = _run_producer(fake, 5)
+    assert unfinished[0] == 5 and len(fake.sent) >= 5, 'sent without waiting, not yet done'
+    assert left == 0 and p.delivered == 5, 'done after delivery'
+
+
+def test_producer_retries_failed_delivery():
+    """A failed delivery is retried and marked done after success."""
+    fake = FakeKafkaProducer(fail=2)
+    p, _, left = _run_producer(fake, 3)
+    assert len(fake.sent) == 5, 'two resends'
+    assert left == 0 and p.delivered == 3 and p.failed == 0
+
+
+def test_producer_batch_format():
+    """In batch format queued results go out as one message."""
+    from ae.bb.data import BATCH, ResultBatch
+
+    sent = []
+
+    class Kafka:
+        async def send_and_wait(self, topic, value):
+            sent.append(value)
+
+    async def run():
+        q = asyncio.Queue()
+        p = msgbus.Producer('localhost:9092', 1, 'topic', q, wire_format=BATCH)
+        p._kafka = Kafka()
+        for i in range(5):
+            q.put_nowait(RemoteServerResult(url='http://www.example.com', tstamp=i, target_id=1))
+        task = asyncio.create_task(p._send(0))
+        await asyncio.wait_for(q.join(), 1)
+        task.cancel()
+
+    asyncio.run(run())
+    assert len(sent) == 1 and len(ResultBatch.decode(sent[0])) == 5, 'one batch message'
+
+
+def test_consumer_stores_batch_messages():
+    """Batch messages are decoded and stored with store_batch."""
+    from ae.bb.data import ResultBatch
+
+    stored = []
+
+    class DB(FakeDB):
+        async def store_batch(self, batch, targets):
+            stored.append(list(batch.rows(targets)))
+
+    r = RemoteServerResult(url='http://www.example.com', tstamp=1, target_id=1)
+    value = ResultBatch.from_results([r, r]).encode()
+    c = msgbus.Consumer('localhost:9092', 'topic', DB(), targets={1: 'http://www.example.com'})
+    c._consumer = FakeKafkaConsumer([])
+    asyncio.run(c._store('p0', [Message(0, value), Message(1, value)]))
+    assert len(stored) == 1 and len(stored[0]) == 4, 'batches merged into one transaction'
+    assert c._consumer.commits == [{'p0': 2}]
+
+
+def test_consumer_unknown_target_ids():
+    """A batch with unknown target ids is neither stored nor committed."""
+    import pytest
+
+    from ae.bb.data import ResultBatch, UnknownTargetError
+
+    class DB(FakeDB):
+        async def store_batch(self, batch, targets):
+            self.stored.append(batch)
+
+    batch = ResultBatch.from_results([
+        RemoteServerResult(url='http://a', tstamp=1, target_id=1),
+        RemoteServerResult(url='http://b', tstamp=1, target_id=2)])
+    binary = RemoteServerResult(url='http://b', tstamp=2, target_id=2).binary()
+    db = DB()
+    c = msgbus.Consumer('localhost:9092', 'topic', db, targets={1: 'http://a'})
+    c._consumer = FakeKafkaConsumer([])
+    before = msgbus.UNKNOWN_TARGETS.labels().value
+    with pytest.raises(UnknownTargetError):
+        asyncio.run(c._store('p0', [Message(0, batch.encode()), Message(1, binary)]))
+    assert msgbus.UNKNOWN_TARGETS.labels().value - before == 2, 'counted'
+    assert db.stored == [] and c._consumer.commits == [], 'not stored, not committed'
+
+
+def test_consumer_lag_metric():
+    """The lag of a partition is set after its commit."""
+    from aiokafka import TopicPartition
+
+    tp = TopicPartition('topic', 3)
+    c = msgbus.Consumer('localhost:9092', 'topic', FakeDB())
+    c._consumer = FakeKafkaConsumer([])
+    c._consumer.highwaters[tp] = 10
+    asyncio.run(c._store(tp, [_msg(5), _msg(6)]))
+    assert msgbus.CONSUMER_LAG.labels(3).value == 3, 'offsets 7 to 9 not stored yet'
+
+
+def test_producer_series_format():
+    """In series format a message is sent per full window, the rest on flush."""
+    from ae.bb import series
+    from ae.bb.data import SERIES
+
+    sent = []
+
+    class Kafka:
+        async def send_and_wait(self, topic, value):
+            sent.append(value)
+
+    async def run():
+        q = asyncio.Queue()
+        p = msgbus.Producer('localhost:9092', 1, 'topic', q, wire_format=SERIES, series_window=2)
+        p._kafka = Kafka()
+        for i in range(5):
+            q.put_nowait(RemoteServerResult(url='http://www.example.com', tstamp=i, target_id=1))
+        task = asyncio.create_task(p._send(0))
+        await asyncio.wait_for(q.join(), 1)
+        task.cancel()
+        assert len(sent) == 2, 'two full windows'
+        await p.flush()
+
+    asyncio.run(run())
+    assert [len(series.decode(m)) for m in sent] == [2, 2, 1]
+
+
+def test_producer_spools_while_kafka_is_down(tmp_path):
+    """Undeliverable messages are spooled and replayed in order."""
+    from ae.bb.spool import Spool
+
+    sent = []
+
+    class Kafka:
+        up = False
+
+        async def send_and_wait(self, topic, value):
+            if not self.up:
+                raise ConnectionError('down')
+            sent.append(value)
+
+        async def send(self, topic, value):
+            fut = asyncio.get_running_loop().create_future()
+            try:
+                await self.send_and_wait(topic, value)
+                fut.set_result(None)
+            except ConnectionError as exc:
+                fut.set_exception(exc)
+            return fut
+
+    async def run():
+        q = asyncio.Queue()
+        spool = Spool(str(tmp_path))
+        p = msgbus.Producer('localhost:9092', 1, 'topic', q, spool=spool)
+        p._window = asyncio.Semaphore(1)
+        p._kafka = kafka = Kafka()
+        p._retry_backoff = 10
+        tasks = await p.kafka_producers()
+        for i in range(3):
+            q.put_nowait(RemoteServerResult(url='http://www.example.com', tstamp=i))
+        await asyncio.wait_for(q.join(), 1)
+        assert sent == [] and not spool.empty(), 'spooled while down'
+        kafka.up = True
+        q.put_nowait(RemoteServerResult(url='http://www.example.com', tstamp=3))
+        await asyncio.wait_for(q.join(), 1)
+        for _ in range(100):
+            if spool.empty():
+                break
+            await asyncio.sleep(0.01)
+        for t in tasks:
+            t.cancel()
+        assert p.stats()['spool_replayed'] == 4
+
+    asyncio.run(run())
+    assert [RemoteServerResult.from_json(m).tstamp for m in sent] == [0, 1, 2, 3], 'in order'
+
+
+def test_producer_replays_spool_pipelined(tmp_path):
+    """Spooled messages fill the in flight window and leave the spool on delivery."""
+    from ae.bb.spool import Spool
+
+    async def run():
+        spool = Spool(str(tmp_path))
+        for i in range(6):
+            spool.append(RemoteServerResult(url='http://www.example.com', tstamp=i).json())
+        fake = FakeKafkaProducer()
+        p = msgbus.Producer('localhost:9092', 1, 'topic', asyncio.Queue(), in_flight=4, spool=spool)
+        p._window = asyncio.Semaphore(4)
+        p._kafka = fake
+        p._retry_backoff = 10
+        assert p._spooling(), 'old spool content first'
+        task = asyncio.create_task(p._replay())
+        await asyncio.sleep(0.05)
+        in_flight = len(fake.sent)
+        unacked = not spool.empty()
+        for _ in range(10):
+            fake.deliver()
+            await asyncio.sleep(0.02)
+        task.cancel()
+        await p.close()
+        return fake, spool, in_flight, unacked
+
+    fake, spool, in_flight, unacked = asyncio.run(run())
+    assert in_flight == 4 and unacked, 'window full before the first delivery, nothing acked'
+    assert [RemoteServerResult.from_json(m).tstamp for m in fake.sent] == list(range(6))
+    assert spool.replayed == 6 and spool.empty()
+
+
+def test_producer_spools_when_kafka_is_slow(tmp_path):
+    """With the queue full and all send slots busy, messages overflow to the spool."""
+    from ae.bb.spool import Spool
+
+    async def run():
+        q = asyncio.Queue(4)
+        spool = Spool(str(tmp_path))
+        fake = FakeKafkaProducer()
+        p = msgbus.Producer('localhost:9092', 1, 'topic', q, in_flight=2, spool=spool)
+        p._window = asyncio.Semaphore(2)
+        p._kafka = fake
+        task = asyncio.create_task(p._send(0))
+        for i in range(12):
+            await q.put(RemoteServerResult(url='http://www.example.com', tstamp=i))
+        await asyncio.wait_for(q.join(), 1)
+        task.cancel()
+        await p.close()
+        return fake, spool, p
+
+    fake, spool, p = asyncio.run(run())
+    assert len(fake.sent) == 2, 'window full, Kafka never answers'
+    assert spool.spooled == 10 and not p._down, 'the rest spooled, Kafka not down'
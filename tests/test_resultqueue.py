@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_resultqueue
+.. moduleauthor:: Michael Lausch <mick.lausch@gmail.com>
+
+Tests for the bounded result queue and its overflow policies.
+"""
+
+import asyncio
+
+import pytest
+
+from ae.bb import resultqueue
+from ae.bb.data import RemoteServerResult
+
+
+def _r(url, tstamp=0):
+    return RemoteServerResult(url=url, http_status=200, tstamp=tstamp)
+
+
+def _drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait())
+        q.task_done()
+    return items
+
+
+def test_queue_invalid_policy():
+    with pytest.raises(ValueError):
+        resultqueue.ResultQueue(1, 'nope')
+
+
+def test_queue_block_waits_when_full():
+    async def run():
+        q = resultqueue.ResultQueue(1, resultqueue.BLOCK)
+        await q.put(_r('http://a'))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(q.put(_r('http://b')), 0.05)
+        return q
+
+    q = asyncio.run(run())
+    assert q.stats()['dropped'] == 0, 'nothing dropped'
+
+
+def test_queue_drop_oldest():
+    async def run():
+        q = resultqueue.ResultQueue(2, resultqueue.DROP_OLDEST)
+        for url in ('http://a', 'http://b', 'http://c'):
+            await q.put(_r(url))
+        return q
+
+    q = asyncio.run(run())
+    assert q.stats()['dropped'] == 1, 'one result dropped'
+    assert [r.url for r in _drain(q)] == ['http://b', 'http://c'], 'oldest one dropped'
+    assert q._unfinished_tasks == 0, 'dropped results are marked done'
+
+
+def test_queue_coalesce_keeps_latest_per_url():
+    async def run():
+        q = resultqueue.ResultQueue(4, resultqueue.COALESCE)
+        await q.put(_r('http://a', 1))
+        await q.put(_r('http://b', 1))
+        await q.put(_r('http://a', 2))
+        return q
+
+    q = asyncio.run(run())
+    stats = q.stats()
+    assert stats['depth'] == 2 and stats['coalesced'] == 1, 'one result coalesced'
+    items = _drain(q)
+    assert [(r.url, r.tstamp) for r in items] == [('http://a', 2), ('http://b', 1)], \
+        'latest result, original position'
+    assert q._unfinished_tasks == 0, 'join does not wait for coalesced results'
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_scheduler
+.. moduleauthor:: Michael Lausch <mick.lausch@gmail.com>
+
+Tests for the fixed rate scrape scheduler.
+"""
+
+import asyncio
+
+import pytest
+
+from ae.bb import scheduler
+from ae.bb.data import ServerConfig, ServerConfigError
+
+
+def _servers(n, interval=None):
+    return [ServerConfig('http://h{0}.example.com'.format(i), interval=interval) for i in range(n)]
+
+
+def test_offsets_spread_evenly():
+    """Every target gets its own slot of the interval."""
+    servers = _servers(100)
+    offs = scheduler.offsets(servers, 60)
+    slots = sorted(int(o // 0.6) for o in offs)
+    assert slots == list(range(100)), 'one target per slot'
+    assert offs == scheduler.offsets(servers, 60), 'deterministic'
+
+
+def test_offsets_per_target_interval():
+    """Targets with their own interval are spread across that interval."""
+    servers = _servers(10) + _servers(10, interval=5)
+    offs = scheduler.offsets(servers, 60)
+    assert max(offs[10:]) < 5, 'short interval group'
+    assert max(offs[:10]) > 5, 'default interval group'
+
+
+def test_invalid_interval():
+    with pytest.raises(ServerConfigError):
+        ServerConfig('http://www.example.com', interval=0)
+
+
+def test_scheduler_fixed_rate_no_drift():
+    """Fetches follow the grid even if each fetch takes a while."""
+    servers = _servers(2)
+    calls = {s.url: [] for s in servers}
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def fetch(server):
+            calls[server.url].append(loop.time() - start)
+            await asyncio.sleep(0.3)
+
+        sched = scheduler.Scheduler(servers, 0.1)
+        try:
+            await asyncio.wait_for(sched.run(fetch), 1.05)
+        except asyncio.TimeoutError:
+            pass
+        return sched
+
+    sched = asyncio.run(run())
+    for times in calls.values():
+        assert len(times) >= 9, 'fixed rate despite slow fetches'
+        first = times[0]
+        for i, t in enumerate(times):
+            assert abs(t - (first + i * 0.1)) < 0.05, 'no drift'
+    assert sched.skipped == 0
+
+
+def test_scheduler_caps_in_flight():
+    """No more than max_in_flight fetches run at once."""
+    servers = _servers(20, interval=1)
+    running = []
+
+    async def run():
+        async def fetch(server):
+            running.append(1)
+            assert len(running) <= 3
+            await asyncio.sleep(0.05)
+            running.pop()
+
+        try:
+            await asyncio.wait_for(scheduler.Scheduler(servers, 60, max_in_flight=3).run(fetch), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(run())
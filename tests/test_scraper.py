@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_scraper
+.. moduleauthor:: Michael Lausch <mick.lausch@gmail.com>
+
+Tests for the scraper, against a local aiohttp server.
+"""
+
+import asyncio
+import re
+import socket
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from ae.bb import scraper
+from ae.bb.data import Config, ServerConfig
+
+
+def _serve(handler, coro):
+    """Run `coro(base_url)` while a local server answers with `handler`."""
+    async def run():
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', handler)
+        async with TestServer(app) as server:
+            return await coro(str(server.make_url('/')))
+
+    return asyncio.run(run())
+
+
+async def _ok(request):
+    return web.Response(text='hello internet')
+
+
+def test_session_reuses_connections():
+    """The second request to a host reuses the connection of the first."""
+    stats = scraper.ConnStats()
+
+    async def fetch_twice(base):
+        async with scraper.session(Config(), stats) as client:
+            for _ in range(2):
+                async with client.get(base) as resp:
+                    await resp.read()
+        return stats.stats()
+
+    s = _serve(_ok, fetch_twice)
+    assert s['created'] == 1 and s['reused'] == 1, 'one handshake saved'
+    assert stats.stats()['reused'] == 0, 'counters reset when reported'
+
+
+def _match(handler, pattern, max_body=1024 * 1024, overlap=scraper.OVERLAP):
+    async def fetch(base):
+        async with scraper.session(Config(), scraper.ConnStats()) as client:
+            async with client.get(base) as resp:
+                return await scraper.stream_match(resp, re.compile(pattern), max_body, overlap)
+
+    return _serve(handler, fetch)
+
+
+async def _big(request):
+    """Two chunks of filler with 'needle' across the chunk boundary."""
+    resp = web.StreamResponse()
+    await resp.prepare(request)
+    await resp.write(b'x' * (scraper.CHUNK_SIZE - 3) + b'nee')
+    await asyncio.sleep(0.01)
+    await resp.write(b'dle' + b'y' * 1000)
+    return resp
+
+
+async def _endless(request):
+    """Match early, then never finish the body."""
+    resp = web.StreamResponse()
+    await resp.prepare(request)
+    await resp.write(b'internet ' * 100)
+    while True:
+        await asyncio.sleep(0.01)
+        await resp.write(b'x' * 1000)
+
+
+def test_stream_match_across_chunks():
+    assert _match(_big, 'needle'), 'match across the chunk boundary'
+    assert not _match(_big, 'nomatch'), 'no match'
+
+
+def test_stream_match_stops_early():
+    assert asyncio.run(asyncio.wait_for(asyncio.to_thread(_match, _endless, 'internet'), 2)), \
+        'returns on the first match'
+
+
+def test_stream_match_max_body():
+    assert not _match(_big, 'needle', max_body=1000), 'match beyond max_body'
+    assert not _match(_endless, 'nomatch', max_body=5000), 'endless body cut off'
+
+
+def test_fetch_reuses_connection_after_large_body():
+    """Bodies not read to the end are drained up to max_body, so connections are reused."""
+    async def large(request):
+        return web.Response(body=b'internet ' + b'x' * 2 * 1024 * 1024)
+
+    def fetch(max_body, pattern):
+        async def run(base):
+            c = Config()
+            c.servers = [ServerConfig(base, pattern=pattern, max_body=max_body)]
+            stats = scraper.ConnStats()
+            s = scraper.Scraper(c, asyncio.Queue())
+            async with scraper.session(c, stats) as client:
+                for _ in range(5):
+                    await s._fetch(client, c.servers[0])
+            return stats.stats()
+
+        return _serve(large, run)
+
+    for pattern in ('internet', None):
+        s = fetch(4 * 1024 * 1024, pattern)
+        assert s['created'] == 1 and s['reused'] == 4, 'drained below max_body'
+    s = fetch(1024 * 1024, 'internet')
+    assert s['created'] == 5 and s['reused'] == 0, 'closed above max_body'
+
+
+def test_change_filter():
+    """Unchanged results are held back, ranges are closed on a change."""
+    from ae.bb.data import RemoteServerResult
+
+    f = scraper.ChangeFilter(heartbeat=3)
+
+    def scrape(t, status=200):
+        return [(r.tstamp, r.http_status, r.unchanged_since)
+                for r in f.filter(RemoteServerResult(url='http://h', http_status=status, tstamp=t))]
+
+    assert scrape(0) == [(0, 200, None)], 'first result is sent'
+    assert scrape(1) == [] and scrape(2) == [], 'unchanged results are held back'
+    assert scrape(3) == [(3, 200, 0)], 'heartbeat'
+    assert scrape(4) == []
+    assert scrape(5, 500) == [(4, 200, 3), (5, 500, None)], 'range closed before the change'
+    assert scrape(6) == [(6, 200, None)], 'nothing held back, nothing to close'
+    assert f.suppressed == 3
+
+
+def test_fetch_metrics():
+    """Every fetch is timed by outcome and target."""
+    async def fetch(base):
+        c = Config()
+        c.servers = [ServerConfig(base)]
+        s = scraper.Scraper(c, asyncio.Queue())
+        async with scraper.session(c, scraper.ConnStats()) as client:
+            await s._fetch(client, c.servers[0])
+        return base
+
+    before = scraper.FETCH_SECONDS.labels('ok').count
+    base = _serve(_ok, fetch)
+    assert scraper.FETCH_SECONDS.labels('ok').count == before + 1
+    assert scraper.TARGET_FETCH_SECONDS.labels(base, 'ok').count == 1
+
+
+def test_breaker_skips_dead_target():
+    """After the failures in a row, the target is not contacted until the pause is over."""
+    async def run():
+        c = Config()
+        c.breaker_failures = 2
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        c.servers = [ServerConfig('http://127.0.0.1:{0}/'.format(port))]
+        q = asyncio.Queue()
+        s = scraper.Scraper(c, q)
+        async with scraper.session(c, scraper.ConnStats()) as client:
+            for _ in range(3):
+                await s._fetch(client, c.servers[0])
+        return [q.get_nowait().nw_status for _ in range(3)], s.stats()
+
+    statuses, stats = asyncio.run(run())
+    assert statuses[0] and statuses[0] != scraper.CIRCUIT_OPEN, 'connection refused'
+    assert statuses[2] == scraper.CIRCUIT_OPEN
+    assert stats['breakers_open'] == 1 and stats['breakers_short_circuited'] == 1
+
+
+def test_adaptive_timeout_cuts_hanging_target():
+    """A target hanging after fast answers is given up after the adaptive timeout."""
+    calls = []
+
+    async def handler(request):
+        calls.append(1)
+        if len(calls) > 3:
+            await asyncio.sleep(5)
+        return web.Response(text='hello internet')
+
+    async def fetch(base):
+        c = Config()
+        c.http_timeout = 5
+        c.adaptive_timeouts = True
+        c.min_timeout = 0.2
+        c.servers = [ServerConfig(base)]
+        q = asyncio.Queue()
+        s = scraper.Scraper(c, q)
+        async with scraper.session(c, scraper.ConnStats()) as client:
+            for _ in range(3):
+                await s._fetch(client, c.servers[0])
+            t0 = time.perf_counter()
+            await s._fetch(client, c.servers[0])
+            elapsed = time.perf_counter() - t0
+        return elapsed, [q.get_nowait().nw_status for _ in range(4)]
+
+    elapsed, statuses = _serve(handler, fetch)
+    assert statuses[:3] == [''] * 3 and statuses[3] == 'Timeout'
+    assert elapsed < 1, 'not the full HTTP timeout'
+
+
+def test_conditional_get():
+    """A 304 reuses the status and match of the last full response."""
+    seen = []
+
+    async def handler(request):
+        seen.append((request.method, request.headers.get('If-None-Match'),
+                     request.headers.get('If-Modified-Since')))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text='hello internet', headers={
+            'ETag': '"v1"', 'Last-Modified': 'Sun, 18 Oct 2026 10:00:00 GMT'})
+
+    async def fetch(base):
+        c = Config()
+        c.servers = [ServerConfig(base, pattern='internet'), ServerConfig(base, method='HEAD')]
+        q = asyncio.Queue()
+        s = scraper.Scraper(c, q)
+        async with scraper.session(c, scraper.ConnStats()) as client:
+            for server in (c.servers[0], c.servers[0], c.servers[1]):
+                await s._fetch(client, server)
+        return [q.get_nowait() for _ in range(3)]
+
+    before = scraper.NOT_MODIFIED.labels().value
+    results = _serve(handler, fetch)
+    assert seen[0] == ('GET', None, None), 'first fetch unconditional'
+    assert seen[1] == ('GET', '"v1"', 'Sun, 18 Oct 2026 10:00:00 GMT'), 'validators sent back'
+    assert seen[2][0] == 'HEAD'
+    assert [(r.http_status, r.match) for r in results[:2]] == [(200, True), (200, True)]
+    assert scraper.NOT_MODIFIED.labels().value == before + 1
+
+
+def test_stream_match_several_patterns():
+    """A negated pattern in the second chunk is found, also when searched in a thread."""
+    from ae.bb.data import Matcher
+
+    matcher = Matcher(['nee', ('yyy', True)])
+
+    async def fetch(base, offload):
+        async with scraper.session(Config(), scraper.ConnStats()) as client:
+            async with client.get(base) as resp:
+                return await scraper.stream_match(resp, matcher, 1024 * 1024, offload=offload)
+
+    assert not _serve(_big, lambda base: fetch(base, 0))
+    assert not _serve(_big, lambda base: fetch(base, 1000))
+    assert _serve(_big, lambda base: fetch(base, 0)) == matcher.match(
+        'x' * (scraper.CHUNK_SIZE - 3) + 'needle' + 'y' * 1000)
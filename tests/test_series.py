@@ -0,0 +1,59 @@
+"""Tests for the compressed series wire format."""
+
+import pytest
+
+from ae.bb import series
+from ae.bb.data import RemoteServerResult
+
+
+def _steady(n, start=1600000000.0, interval=60):
+    return [RemoteServerResult(url='http://www.example.com', nw_status='', http_status=200,
+                               match=True, tstamp=start + i * interval + (i % 3) * 0.013,
+                               target_id=42)
+            for i in range(n)]
+
+
+def test_series_roundtrip():
+    """A window with status changes decodes to the same rows."""
+    results = _steady(10)
+    results[4] = RemoteServerResult(url='http://www.example.com', nw_status='Timeout',
+                                    http_status=None, match=False, tstamp=results[4].tstamp, target_id=42)
+    results[5] = RemoteServerResult(url='http://www.example.com', http_status=503,
+                                    tstamp=results[5].tstamp, target_id=42)
+    b = series.encode(results)
+    assert series.is_series(b)
+    rows = list(series.decode(b).rows({42: 'http://www.example.com'}))
+    assert rows == [(r.url, round(r.tstamp * 1000) / 1000, r.nw_status, r.http_status, r.match, None)
+                    for r in results], 'roundtrip with millisecond timestamps'
+
+
+def test_series_steady_target_is_small():
+    """A target with constant results needs about a byte per point."""
+    results = _steady(60)
+    b = series.encode(results)
+    assert len(b) < 2 * len(results), 'less than two bytes per point'
+    assert len(b) * 10 < sum(len(r.json()) for r in results), 'order of magnitude below JSON'
+
+
+def test_series_malformed():
+    """Truncated and foreign messages are rejected."""
+    b = series.encode(_steady(5))
+    with pytest.raises(ValueError):
+        series.decode(b[:-1])
+    with pytest.raises(ValueError):
+        series.decode(b'{"url": "x"}')
+    with pytest.raises(ValueError):
+        RemoteServerResult.decode(b)
+
+
+def test_series_windows():
+    """Windows are per target and flushed on demand."""
+    w = series.Windows(3)
+    a = _steady(3)
+    other = RemoteServerResult(url='http://b.example.com', tstamp=1, target_id=7)
+    assert w.add(a[0]) is None and w.add(other) is None and w.add(a[1]) is None
+    msgs, payload = w.add(a[2])
+    assert msgs == a and len(series.decode(payload)) == 3, 'full window encoded'
+    assert len(w) == 1
+    [(msgs, payload)] = w.flush()
+    assert msgs == [other] and len(w) == 0, 'partial windows flushed'
@@ -0,0 +1,77 @@
+"""Tests for the disk spool."""
+
+import os
+
+import pytest
+
+from ae.bb.spool import Spool
+
+
+def _drain(spool):
+    out = []
+    while True:
+        message = spool.peek()
+        if message is None:
+            return out
+        out.append(message)
+        spool.pop()
+
+
+def test_spool_fifo_across_segments(tmp_path):
+    """Messages come back in order, read segments are deleted."""
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    messages = [b'message %d' % i for i in range(20)]
+    for m in messages[:10]:
+        spool.append(m)
+    assert spool.stats()['segments'] > 1
+    first = []
+    for _ in range(5):
+        first.append(spool.peek())
+        spool.pop()
+    for m in messages[10:]:
+        spool.append(m)
+    assert first + _drain(spool) == messages, 'appended while reading'
+    assert spool.empty() and len(os.listdir(str(tmp_path))) == 1, 'only the active segment left'
+
+
+def test_spool_survives_restart(tmp_path):
+    """Unread messages are read again after reopening, torn records are skipped."""
+    spool = Spool(str(tmp_path), segment_bytes=64, fsync='always')
+    for i in range(5):
+        spool.append(b'm%d' % i)
+    spool.close()
+    with open(os.path.join(str(tmp_path), sorted(os.listdir(str(tmp_path)))[-1]), 'ab') as f:
+        f.write(b'\x10\x00\x00\x00torn')
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    assert _drain(spool) == [b'm%d' % i for i in range(5)]
+    spool.append(b'new')
+    assert _drain(spool) == [b'new']
+
+
+def test_spool_size_limit(tmp_path):
+    """The oldest segment is dropped when the spool is full."""
+    spool = Spool(str(tmp_path), max_bytes=400, segment_bytes=100, fsync='never')
+    for i in range(50):
+        spool.append(b'%08d' % i)
+    assert len(spool) <= 400 and spool.dropped_segments > 0
+    messages = _drain(spool)
+    assert messages[-1] == b'%08d' % 49 and messages == sorted(messages), 'newest kept in order'
+    with pytest.raises(ValueError):
+        Spool(str(tmp_path), fsync='sometimes')
+
+
+def test_spool_read_ahead_ack(tmp_path):
+    """Read ahead messages stay until acknowledged, in any order."""
+    spool = Spool(str(tmp_path), segment_bytes=32)
+    for i in range(6):
+        spool.append(b'message %d' % i)
+    read = [spool.read() for _ in range(6)]
+    assert [m for _, m in read] == [b'message %d' % i for i in range(6)]
+    assert spool.read() is None and not spool.empty()
+    segments = spool.stats()['segments']
+    for token, _ in reversed(read[:4]):
+        spool.ack(token)
+    assert spool.stats()['segments'] < segments, 'acknowledged segments deleted'
+    spool.close()
+    spool = Spool(str(tmp_path), segment_bytes=32)
+    assert _drain(spool) == [b'message 4', b'message 5'], 'unacknowledged ones read again'
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_storage
+.. moduleauthor:: Michael Lausch <mick.lausch@gmail.com>
+
+Tests for the postgres storage writer.
+"""
+
+import asyncio
+import datetime
+
+import ae.bb.storage as storage
+from ae.bb.data import RemoteServerResult
+
+
+def _result(url='http://www.example.com', nw_status='', http_status=200, match=True, tstamp=0):
+    return RemoteServerResult(url=url, nw_status=nw_status, http_status=http_status,
+                              match=match, tstamp=tstamp)
+
+
+def test_copy_row_escapes_and_nulls():
+    """Special characters are escaped, missing http status is NULL."""
+    r = _result(nw_status='a\tb\nc\\d', http_status=None, match=False)
+    row = storage._copy_row(r.url, r.tstamp, r.nw_status, r.http_status, r.match)
+    fields = row.rstrip('\n').split('\t')
+    assert fields[0] == 'http://www.example.com', 'url'
+    assert fields[2] == 'a\\tb\\nc\\\\d', 'escaped nw_status'
+    assert fields[3] == '\\N', 'NULL http status'
+    assert fields[4] == 'f', 'match'
+    assert fields[5] == '\\N', 'NULL unchanged since'
+    row = storage._copy_row(r.url, 60, r.nw_status, r.http_status, r.match, 0)
+    assert row.rstrip('\n').split('\t')[5] == datetime.datetime.fromtimestamp(0).isoformat(' ')
+
+
+def _db(mocker, conn):
+    mocker.patch('psycopg2.connect', return_value=conn)
+    db = storage.DB(password='x', dsn='host=nowhere', pool_size=2)
+    asyncio.run(db.connect())
+    conn.reset_mock()
+    return db
+
+
+def test_store_many_one_transaction(mocker):
+    """A batch is copied and merged in one transaction."""
+    conn = mocker.MagicMock()
+    conn.staged = False
+    conn.prepared = set()
+    cursor = conn.cursor.return_value.__enter__.return_value
+    copied = []
+    cursor.copy_expert.side_effect = lambda stmt, f: copied.append(f.read())
+    cursor.rowcount = 1
+
+    db = _db(mocker, conn)
+    inserted = asyncio.run(db.store_many([_result(tstamp=1), _result(tstamp=2)]))
+
+    assert inserted == 1, 'rows inserted, one duplicate skipped'
+    assert len(copied) == 1 and copied[0].count('\n') == 2, 'one COPY with two rows'
+    assert conn.commit.call_count == 1, 'one commit per batch'
+    executed = [c[0][0] for c in cursor.execute.call_args_list]
+    assert executed[-2].startswith('prepare ae_merge') and 'on conflict' in executed[-2], \
+        'merge skips duplicates'
+    assert executed[-1] == 'execute ae_merge'
+    assert conn.staged, 'staging table created once per connection'
+
+    cursor.execute.reset_mock()
+    asyncio.run(db.store_many([_result(tstamp=3)]))
+    assert [c[0][0] for c in cursor.execute.call_args_list] == ['execute ae_merge'], \
+        'statement prepared once per connection'
+
+
+class OldTableCursor:
+    """Cursor of a ``webservers`` table created before ``unchanged_since``."""
+
+    def __init__(self):
+        self.columns = {'url', 'tstamp', 'match', 'http_status', 'nw_status'}
+        self.rowcount = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _check(self, stmt):
+        import psycopg2.errors
+
+        if 'unchanged_since' in stmt and 'unchanged_since' not in self.columns:
+            raise psycopg2.errors.UndefinedColumn('column "unchanged_since" does not exist')
+
+    def execute(self, stmt, args=None):
+        if stmt.startswith('alter table webservers add column if not exists unchanged_since'):
+            self.columns.add('unchanged_since')
+        elif not stmt.startswith('execute'):
+            self._check(stmt)
+
+    def copy_expert(self, stmt, buf):
+        self._check(stmt)
+
+
+def test_store_upgrades_old_table(mocker):
+    """A table of the old schema gets the unchanged_since column on connect."""
+    conn = mocker.MagicMock()
+    conn.staged = False
+    conn.prepared = set()
+    cursor = conn.cursor.return_value = OldTableCursor()
+    db = _db(mocker, conn)
+    assert 'unchanged_since' in cursor.columns, 'column added'
+    assert asyncio.run(db.store_many([_result(tstamp=1)])) == 1
+    asyncio.run(db.store(_result(tstamp=2)))
+    assert not conn.rollback.called, 'written without errors'
+
+
+def test_store_many_empty_batch(mocker):
+    """An empty batch does not touch the database."""
+    conn = mocker.MagicMock()
+    db = _db(mocker, conn)
+    assert asyncio.run(db.store_many([])) == 0
+    assert not conn.cursor.called
+
+
+def test_store_many_replaces_broken_connection(mocker):
+    """A connection error closes the broken connection and retries."""
+    import psycopg2
+
+    conn = mocker.MagicMock()
+    conn.staged = True
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.copy_expert.side_effect = [psycopg2.OperationalError('gone'), None]
+    cursor.rowcount = 1
+    db = _db(mocker, conn)
+    db._backoff_time = 0
+    assert asyncio.run(db.store_many([_result()])) == 1
+    assert conn.close.called, 'broken connection closed'
+
+
+def test_store_many_keeps_rows_of_refused_batch(mocker):
+    """A batch refused for a bad row is inserted row by row without that row."""
+    import psycopg2
+
+    conn = mocker.MagicMock()
+    conn.staged = True
+    conn.prepared = set()
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.copy_expert.side_effect = psycopg2.errors.StringDataRightTruncation('too long')
+
+    def execute(stmt, args=None):
+        if args and len(args[2]) > 256:
+            raise psycopg2.errors.StringDataRightTruncation('too long')
+
+    cursor.execute.side_effect = execute
+    db = _db(mocker, conn)
+    before = storage.REJECTED.labels().value
+    results = [_result(tstamp=1), _result(tstamp=2, nw_status='x' * 300), _result(tstamp=3)]
+    assert asyncio.run(db.store_many(results)) == 2, 'good rows kept'
+    assert storage.REJECTED.labels().value - before == 1, 'bad row dropped'
+
+
+def test_store_prepared_statement(mocker):
+    """Single inserts run prepared, a failed transaction drops the prepared statements."""
+    import psycopg2
+
+    conn = mocker.MagicMock()
+    conn.prepared = set()
+    cursor = conn.cursor.return_value.__enter__.return_value
+    db = _db(mocker, conn)
+    asyncio.run(db.store(_result(tstamp=1)))
+    assert cursor.execute.call_args_list[0][0][0].startswith('prepare ae_insert as insert')
+    sql, args = cursor.execute.call_args_list[1][0]
+    assert sql == 'execute ae_insert (%s, %s, %s, %s, %s, %s)'
+    assert args[0] == 'http://www.example.com' and args[3:] == (200, True, None)
+
+    cursor.execute.side_effect = [psycopg2.errors.UniqueViolation(), None]
+    asyncio.run(db.store(_result(tstamp=1)))
+    assert conn.rollback.called and conn.prepared == set(), 'prepared statements forgotten'
+    assert cursor.execute.call_args_list[-1][0][0] == 'deallocate all'
+
+
+class FakeDB:
+    """Records the batches handed to store_many."""
+
+    def __init__(self):
+        self.batches = []
+
+    async def store_many(self, results):
+        self.batches.append(list(results))
+        return len(results)
+
+
+def test_sink_batches_and_marks_done():
+    """Queued results are stored in batches and marked done afterwards."""
+    async def run():
+        db = FakeDB()
+        q = asyncio.Queue()
+        sink = storage.Sink(db, q, count=1, batch_size=3, linger=0.01)
+        sink.sinks()
+        for i in range(5):
+            q.put_nowait(_result(tstamp=i))
+        await asyncio.wait_for(q.join(), 1)
+        return db, sink
+
+    db, sink = asyncio.run(run())
+    assert [len(b) for b in db.batches] == [3, 2], 'batch size respected'
+    assert sink.stats()['stored'] == 5
+
+
+def test_store_batch_copies_columns(mocker):
+    """A ResultBatch is stored with one COPY, target ids mapped to URLs."""
+    from ae.bb.data import ResultBatch
+
+    conn = mocker.MagicMock()
+    conn.staged = True
+    cursor = conn.cursor.return_value.__enter__.return_value
+    copied = []
+    cursor.copy_expert.side_effect = lambda stmt, f: copied.append(f.read())
+    cursor.rowcount = 2
+    db = _db(mocker, conn)
+    batch = ResultBatch.from_results([
+        RemoteServerResult(url='x', http_status=200, tstamp=1, target_id=1),
+        RemoteServerResult(url='x', nw_status='Timeout', http_status=None, tstamp=2, target_id=2)])
+    assert asyncio.run(db.store_batch(batch, {1: 'http://a', 2: 'http://b'})) == 2
+    lines = copied[0].splitlines()
+    assert lines[0].startswith('http://a\t') and lines[1].startswith('http://b\t'), 'urls'
+    assert lines[1].split('\t')[2:4] == ['Timeout', '\\N'], 'status columns'
+
+
+def test_store_many_normalized_schema(mocker):
+    """With a normalized schema rows carry cached target ids instead of URLs."""
+    from ae.bb import schema
+
+    conn = mocker.MagicMock()
+    conn.staged = True
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [('http://a', 7), ('http://b', 8)]
+    copied = []
+    cursor.copy_expert.side_effect = lambda stmt, f: copied.append((stmt, f.read()))
+    cursor.rowcount = 2
+    mocker.patch('psycopg2.connect', return_value=conn)
+    db = storage.DB(password='x', dsn='host=nowhere', pool_size=2, schema=schema.Normalized())
+    asyncio.run(db.connect())
+    executed = [c[0][0] for c in cursor.execute.call_args_list]
+    assert any('create table if not exists measurements' in stmt for stmt in executed), 'created'
+
+    asyncio.run(db.store_many([_result(url='http://a', tstamp=1), _result(url='http://b', tstamp=1)]))
+    asyncio.run(db.store_many([_result(url='http://b', tstamp=2)]))
+    assert cursor.fetchall.call_count == 1, 'target ids cached'
+    assert 'measurements_stage' in copied[0][0]
+    assert [line.split('\t')[0] for line in copied[0][1].splitlines()] == ['7', '8']
+    assert copied[1][1].startswith('8\t')
+
+
+def test_timescale_schema(mocker):
+    """The hypertable gets policies, without the extension it falls back."""
+    from ae.bb import schema
+
+    cursor = mocker.MagicMock()
+    cursor.fetchone.side_effect = [(1,), (False,)]
+    s = schema.get(schema.TIMESCALE, retention_days=30, compress_days=2)
+    assert s.create(None, cursor) is s
+    executed = ' '.join(c[0][0] for c in cursor.execute.call_args_list)
+    for part in ('create_hypertable', 'timescaledb.compress', 'add_compression_policy',
+                 'add_retention_policy'):
+        assert part in executed, part
+
+    cursor = mocker.MagicMock()
+    cursor.fetchone.return_value = None
+    assert s.create(None, cursor).name == schema.PARTITIONED, 'fallback without timescaledb'
+
+
+def test_partitioned_schema_maintenance(mocker):
+    """Partitions are created ahead and dropped after the retention."""
+    from ae.bb import schema
+
+    cursor = mocker.MagicMock()
+    cursor.fetchall.return_value = [('measurements_p20260101',), ('measurements_p20261018',),
+                                    ('measurements_default',)]
+    s = schema.Partitioned(retention_days=30, ahead_days=1)
+    days = s.maintain(None, cursor, datetime.date(2026, 10, 18))
+    executed = [c[0][0] for c in cursor.execute.call_args_list]
+    created = [stmt.split()[5] for stmt in executed if stmt.startswith('create table')]
+    assert created == ['measurements_p20261018', 'measurements_p20261019']
+    assert 'drop table if exists measurements_p20260101' in executed, 'expired partition dropped'
+    assert days == {datetime.date(2026, 10, 18)}
+
+
+def test_store_many_partitioned_schema(mocker):
+    """Missing partitions are created once, expired rows are dropped."""
+    from ae.bb import schema
+
+    conn = mocker.MagicMock()
+    conn.staged = True
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = []
+    cursor.rowcount = 1
+    mocker.patch('psycopg2.connect', return_value=conn)
+    now = datetime.datetime.now().timestamp()
+
+    async def run():
+        db = storage.DB(password='x', dsn='host=nowhere', pool_size=2,
+                        schema=schema.Partitioned(retention_days=30))
+        await db.connect()
+        cursor.fetchall.return_value = [('http://a', 1)]
+        cursor.execute.reset_mock()
+        await db.store_many([_result(url='http://a', tstamp=now - 86400 * 5),
+                             _result(url='http://a', tstamp=now - 86400 * 60)])
+        await db.store_many([_result(url='http://a', tstamp=now - 86400 * 5 + 1)])
+        await db.close()
+
+    asyncio.run(run())
+    created = [c[0][1][0] for c in cursor.execute.call_args_list
+               if c[0][0].startswith('create table if not exists measurements_p')]
+    assert created == [datetime.date.fromtimestamp(now - 86400 * 5)], 'old day created once'
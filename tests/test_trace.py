@@ -0,0 +1,59 @@
+"""Tests for the sampled tracing."""
+
+import logging
+
+import pytest
+
+from ae.bb import trace
+
+
+class Expensive:
+    """Counts how often it is formatted."""
+
+    formatted = 0
+
+    def __str__(self):
+        Expensive.formatted += 1
+        return 'expensive'
+
+
+@pytest.fixture
+def tracer():
+    yield trace.Tracer('test_trace')
+    trace.configure(0.0)
+
+
+def _emit(t, n=100):
+    for _ in range(n):
+        if t.on():
+            t.log('point %s', Expensive())
+
+
+def test_trace_off_by_default(tracer, caplog):
+    """Without a rate nothing is logged, not even at DEBUG."""
+    caplog.set_level(logging.DEBUG, 'test_trace')
+    formatted = Expensive.formatted
+    _emit(tracer)
+    assert not caplog.records and trace.rate() == 0.0
+    assert Expensive.formatted == formatted, 'arguments not formatted'
+
+
+def test_trace_needs_debug(tracer, caplog):
+    """With a rate, trace points are logged only if the logger is enabled for DEBUG."""
+    trace.configure(1.0)
+    caplog.set_level(logging.INFO, 'test_trace')
+    _emit(tracer)
+    assert not caplog.records
+    caplog.set_level(logging.DEBUG, 'test_trace')
+    _emit(tracer)
+    assert len(caplog.records) == 100 and caplog.records[0].getMessage() == 'point expensive'
+
+
+def test_trace_sampling(tracer, caplog):
+    """About the share of the rate is logged."""
+    trace.configure(0.1)
+    caplog.set_level(logging.DEBUG, 'test_trace')
+    _emit(tracer, 2000)
+    assert 100 < len(caplog.records) < 300
+    with pytest.raises(ValueError):
+        trace.configure(2)
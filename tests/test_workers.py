@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_workers
+.. moduleauthor:: Michael Lausch <mick.lausch@gmail.com>
+
+Tests for sharding the scraper across processes.
+"""
+
+import asyncio
+import os
+import signal
+import time
+
+from ae.bb import workers
+from ae.bb.data import Config, ServerConfig
+
+
+def _servers(n):
+    return [ServerConfig('http://h{0}.example.com/'.format(i)) for i in range(n)]
+
+
+def test_shard_covers_all_servers():
+    servers = _servers(1000)
+    shards = workers.shard(servers, 4)
+    assert sorted(s.url for shard in shards for s in shard) == sorted(s.url for s in servers), \
+        'every server in exactly one shard'
+    assert all(150 < len(shard) < 350 for shard in shards), 'roughly balanced'
+
+
+def test_shard_consistent():
+    """Adding a worker moves only the servers the new worker takes over."""
+    servers = _servers(1000)
+    before = {s.url: i for i, shard in enumerate(workers.shard(servers, 4)) for s in shard}
+    after = {s.url: i for i, shard in enumerate(workers.shard(servers, 5)) for s in shard}
+    moved = [url for url in before if before[url] != after[url]]
+    assert all(after[url] == 4 for url in moved), 'moved servers go to the new worker'
+    assert len(moved) < 350, 'about 1/5 moved'
+
+
+def test_merge_stats():
+    merged = workers.merge([{'queue': {'depth': 3, 'high_water': 5}},
+                            {'queue': {'depth': 4, 'high_water': 2}, 'sink': {'max_latency': 1.5}}])
+    assert merged == {'queue': {'depth': 7, 'high_water': 5}, 'sink': {'max_latency': 1.5}}
+
+
+def _sleep(*args):
+    time.sleep(60)
+
+
+def test_supervisor_restarts_dead_worker(monkeypatch):
+    """A killed worker is started again after its backoff."""
+    monkeypatch.setattr(workers, '_worker', _sleep)
+    c = Config()
+    c.servers = _servers(10)
+    sup = workers.Supervisor(c, 2)
+    sup._backoff = [0, 0]
+    try:
+        for idx in range(2):
+            sup._start(idx)
+        pid = sup._procs[0].pid
+        os.kill(pid, signal.SIGKILL)
+        sup._procs[0].join(5)
+        sup._watch()
+        assert sup.restarts == 1 and sup._procs[0] is None, 'death noticed'
+        sup._watch()
+        assert sup._procs[0].is_alive() and sup._procs[0].pid != pid, 'restarted'
+        assert sup._procs[1].is_alive(), 'other worker untouched'
+    finally:
+        for p in sup._procs:
+            if p is not None:
+                p.kill()
+                p.join()
+
+
+def test_worker_flushes_on_sigterm(monkeypatch):
+    """SIGTERM cancels the scraper of a worker, so its cleanup runs."""
+    from ae.bb import scraper
+
+    cleaned = []
+
+    async def run(c, publish):
+        try:
+            await asyncio.sleep(60)
+        finally:
+            cleaned.append(True)
+
+    monkeypatch.setattr(scraper, 'run', run)
+
+    async def main():
+        asyncio.get_running_loop().call_later(0.05, os.kill, os.getpid(), signal.SIGTERM)
+        await workers._run(Config(), None)
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+    assert cleaned == [True]
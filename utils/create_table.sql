@@ -20,13 +20,19 @@ CREATE TABLE public.webservers
     tstamp timestamp without time zone,
     match boolean,
     http_status integer,
-    nw_status character varying(256) COLLATE pg_catalog."default"
+    nw_status character varying(256) COLLATE pg_catalog."default",
+    unchanged_since timestamp without time zone
 )
 
 TABLESPACE pg_default;
 
 ALTER TABLE public.webservers
     OWNER to aiven;
+
+-- A row with unchanged_since stands for all scrapes from unchanged_since up
+-- to its tstamp, which had the same result. ae store adds the column to
+-- tables of older versions when it connects:
+-- ALTER TABLE public.webservers ADD COLUMN IF NOT EXISTS unchanged_since timestamp without time zone;
 -- Index: ws
 
 -- DROP INDEX public.ws;